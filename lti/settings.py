@@ -77,6 +77,26 @@ DATABASES = {
     }
 }
 
+# ----------------------------------------------------
+# CACHE
+# Shared across worker processes. The database cache needs no extra
+# services; point CACHE_BACKEND/CACHE_LOCATION at Redis or Memcached
+# for larger deployments.
+# ----------------------------------------------------
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"),
+        'LOCATION': os.getenv("CACHE_LOCATION", "tool_cache"),
+    }
+}
+# Dashboard payloads, context caches and locks share one cache; the culling
+# backends' default of 300 entries would evict them every few turns.
+# (Redis and memcached manage their own memory and reject this option.)
+if CACHES["default"]["BACKEND"].split(".")[-2] in ("db", "locmem", "filebased"):
+    CACHES["default"]["OPTIONS"] = {"MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "20000"))}
+
+DASHBOARD_CACHE_TIMEOUT = int(os.getenv("DASHBOARD_CACHE_TIMEOUT", "3600"))
+
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {"NAME": 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -134,3 +154,81 @@ LTI_DEPLOYMENT_ID = os.getenv("LTI_DEPLOYMENT_ID", "")
 LTI_PLATFORM_JWKS_URL = os.getenv("LTI_PLATFORM_JWKS_URL", "")
 LTI_PLATFORM_AUTHORIZE_URL = os.getenv("LTI_PLATFORM_AUTHORIZE_URL", "")
 LTI_REDIRECT_URI = os.getenv("LTI_REDIRECT_URI", "")
+LTI_PRIVATE_KEY_PATH = os.getenv("LTI_PRIVATE_KEY_PATH", "lti_keys/private.pem")
+
+# Platform JWKS cache: key sets are reused for the TTL, and an unknown kid
+# triggers at most one forced refetch per REFRESH_INTERVAL per JWKS URL.
+LTI_JWKS_TTL = int(os.getenv("LTI_JWKS_TTL", "3600"))
+LTI_JWKS_REFRESH_INTERVAL = int(os.getenv("LTI_JWKS_REFRESH_INTERVAL", "60"))
+LTI_JWKS_TIMEOUT = int(os.getenv("LTI_JWKS_TIMEOUT", "10"))
+
+# NRPS roster cache: entries older than the TTL are served while a
+# background refresh runs; MAX_AGE bounds how long they are kept at all.
+NRPS_ROSTER_TTL = int(os.getenv("NRPS_ROSTER_TTL", "300"))
+NRPS_ROSTER_MAX_AGE = int(os.getenv("NRPS_ROSTER_MAX_AGE", "86400"))
+NRPS_TIMEOUT = int(os.getenv("NRPS_TIMEOUT", "15"))
+
+# ----------------------------------------------------
+# LLM client pool (shared OpenAI clients, see tool/llm.py)
+# ----------------------------------------------------
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+# Resilience policy (see LLMClientRegistry.complete): viva turns must finish
+# within the deadline, retries back off exponentially with jitter, and after
+# BREAKER_FAILURES consecutive outage errors calls fail fast for BREAKER_RESET
+# seconds.
+LLM_TURN_DEADLINE = float(os.getenv("LLM_TURN_DEADLINE", "30"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Request and token budgets per minute shared by all workers (see
+# tool/ratelimit.py); 0 turns a limit off. Calls over budget queue for up to
+# QUEUE_TIMEOUT seconds (less if their deadline is sooner). Each call
+# reserves its prompt tokens plus max_tokens, or COMPLETION_TOKENS_ESTIMATE
+# when it sets none.
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", "300"))
+
+# Request hedging for viva turns: when VIVA_HEDGE_MODEL is set and the primary
+# model has not answered by the HEDGE_PERCENTILE latency of recent turns
+# (HEDGE_AFTER_MS until enough turns are recorded, never below MIN_MS), the
+# same prompt goes to the hedge model and the first good answer wins.
+# Streamed turns race on time to first token instead.
+VIVA_HEDGE_MODEL = os.getenv("VIVA_HEDGE_MODEL", "")
+VIVA_HEDGE_PERCENTILE = float(os.getenv("VIVA_HEDGE_PERCENTILE", "95"))
+VIVA_HEDGE_AFTER_MS = int(os.getenv("VIVA_HEDGE_AFTER_MS", "8000"))
+VIVA_HEDGE_MIN_MS = int(os.getenv("VIVA_HEDGE_MIN_MS", "2000"))
+
+# Generate the first viva question in the background at viva start, so it is
+# ready when the student answers the guidance message.
+VIVA_PREGENERATE_OPENING = os.getenv("VIVA_PREGENERATE_OPENING", "true").lower() == "true"
+
+# Question bank: after each upload, generate QUESTION_BANK_SIZE ranked
+# candidate questions per submission from up to SOURCE_TOKENS of its text.
+# Turns for submissions with a bank show the model BANK_CANDIDATES unused
+# candidates and cut materials to BANK_MATERIALS_TOKENS.
+VIVA_QUESTION_BANK = os.getenv("VIVA_QUESTION_BANK", "true").lower() == "true"
+VIVA_QUESTION_BANK_SIZE = int(os.getenv("VIVA_QUESTION_BANK_SIZE", "10"))
+VIVA_QUESTION_BANK_SOURCE_TOKENS = int(os.getenv("VIVA_QUESTION_BANK_SOURCE_TOKENS", "6000"))
+VIVA_BANK_CANDIDATES = int(os.getenv("VIVA_BANK_CANDIDATES", "5"))
+VIVA_BANK_MATERIALS_TOKENS = int(os.getenv("VIVA_BANK_MATERIALS_TOKENS", "1000"))
+
+# ----------------------------------------------------
+# Viva prompt budget (tokens per turn, see build_chat_messages)
+# ----------------------------------------------------
+# Total prompt size, the most that submission materials may take of it
+# (resources capped separately), and the history kept even when that
+# squeezes materials.
+VIVA_PROMPT_TOKENS = int(os.getenv("VIVA_PROMPT_TOKENS", "6000"))
+VIVA_MATERIALS_TOKENS = int(os.getenv("VIVA_MATERIALS_TOKENS", "2500"))
+VIVA_RESOURCE_TOKENS = int(os.getenv("VIVA_RESOURCE_TOKENS", "1000"))
+VIVA_MIN_HISTORY_TOKENS = int(os.getenv("VIVA_MIN_HISTORY_TOKENS", "1000"))
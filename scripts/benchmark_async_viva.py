@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Compare viva turn throughput with sync-style workers and a single async loop.
+
+Usage:
+  python scripts/benchmark_async_viva.py [--students 200] [--latency 0.5]
+                                         [--workers 8] [--turns 1]
+                                         [--rpm 0] [--tpm 0]
+
+Runs against a throwaway SQLite test database (never the configured one) and
+a local mock of the OpenAI chat completions API that answers after
+--latency seconds. The same /viva/send/ requests are sent twice:
+
+  sync   a pool of --workers threads through the WSGI test client, the way a
+         gunicorn deployment with that many sync workers would serve them
+  async  every request at once through the ASGI handler on one event loop
+
+and the report shows wall time, turns per second, latency percentiles and
+the peak number of completions the mock LLM saw in flight. --rpm/--tpm set
+the shared LLM rate limit (tool/ratelimit.py); the report then also shows
+how many calls queued for budget and their average wait.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lti.settings")
+
+import django  # noqa: E402
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import AsyncClient, Client  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from tool import metrics  # noqa: E402
+from tool.models import Assignment, LLMRateBucket, Submission, VivaSession, VivaSessionSubmission  # noqa: E402
+from tool.ratelimit import METRIC_LLM_QUEUE_WAIT_MS, METRIC_LLM_QUEUED, RATE_LIMIT_METRICS  # noqa: E402
+
+
+# ---------------------------------------------------------
+# Mock LLM
+# ---------------------------------------------------------
+class MockLLM:
+    """OpenAI-compatible /v1/chat/completions that sleeps before answering."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+        llm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                llm.enter()
+                try:
+                    time.sleep(llm.latency)
+                finally:
+                    llm.leave()
+                body = json.dumps({
+                    "id": "chatcmpl-benchmark",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "benchmark",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": '{"question": "Why did you choose that approach?"}'},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {"prompt_tokens": 500, "completion_tokens": 12, "total_tokens": 512},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def enter(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.peak = 0
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+def seed(students):
+    assignment = Assignment.objects.create(slug="benchmark-async", title="Async benchmark")
+    subs = Submission.objects.bulk_create([
+        Submission(assignment=assignment, user_id=f"bench-{i}", comment="Benchmark essay text.")
+        for i in range(students)
+    ])
+    sessions = VivaSession.objects.bulk_create([VivaSession(submission=sub) for sub in subs])
+    VivaSessionSubmission.objects.bulk_create([
+        VivaSessionSubmission(session=sess, submission=sub) for sub, sess in zip(subs, sessions)
+    ])
+    return [sess.id for sess in sessions]
+
+
+def turn_body(session_id):
+    return json.dumps({"session_id": session_id, "sender": "student", "text": "My answer."})
+
+
+def run_sync(session_ids, turns, workers):
+    def student(session_id):
+        client = Client()
+        latencies = []
+        try:
+            for _ in range(turns):
+                start = time.perf_counter()
+                resp = client.post("/viva/send/", turn_body(session_id), content_type="application/json")
+                latencies.append((time.perf_counter() - start, resp.status_code))
+        finally:
+            connection.close()
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [row for rows in pool.map(student, session_ids) for row in rows]
+
+
+def run_async(session_ids, turns):
+    async def student(session_id):
+        client = AsyncClient()
+        latencies = []
+        for _ in range(turns):
+            start = time.perf_counter()
+            resp = await client.post("/viva/send/", turn_body(session_id), content_type="application/json")
+            latencies.append((time.perf_counter() - start, resp.status_code))
+        return latencies
+
+    async def everyone():
+        results = await asyncio.gather(*(student(sid) for sid in session_ids))
+        return [row for rows in results for row in rows]
+
+    return asyncio.run(everyone())
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def reset_rate_limit():
+    LLMRateBucket.objects.all().delete()
+    metrics.reset(RATE_LIMIT_METRICS)
+    connection.close()
+
+
+def report(label, rows, wall_time, llm):
+    ok = sorted(latency * 1000 for latency, status in rows if status == 200)
+    errors = len(rows) - len(ok)
+    queued = metrics.snapshot(RATE_LIMIT_METRICS)
+    avg_wait = queued[METRIC_LLM_QUEUE_WAIT_MS] / queued[METRIC_LLM_QUEUED] if queued[METRIC_LLM_QUEUED] else 0
+    print(
+        f"{label:<6}{wall_time:>9.2f} s{len(ok) / wall_time:>10.1f}/s"
+        f"{percentile(ok, 50):>10.0f}{percentile(ok, 95):>10.0f}{percentile(ok, 99):>10.0f}"
+        f"{llm.peak:>8d}{errors:>7d}{queued[METRIC_LLM_QUEUED]:>8d}{avg_wait:>10.0f}"
+    )
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync vs async viva turns.")
+    parser.add_argument("--students", type=int, default=200, help="Concurrent students (one session each).")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock LLM latency in seconds.")
+    parser.add_argument("--workers", type=int, default=8, help="Sync worker threads.")
+    parser.add_argument("--turns", type=int, default=1, help="Turns per student.")
+    parser.add_argument("--rpm", type=int, default=0, help="LLM requests per minute across workers (0 = no limit).")
+    parser.add_argument("--tpm", type=int, default=0, help="LLM tokens per minute across workers (0 = no limit).")
+    args = parser.parse_args()
+    settings.LLM_REQUESTS_PER_MINUTE = args.rpm
+    settings.LLM_TOKENS_PER_MINUTE = args.tpm
+
+    setup_test_environment()
+    llm = MockLLM(args.latency)
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_BASE_URL"] = llm.base_url
+
+    # SQLite's deferred transactions fail with "database is locked" when many
+    # threads upgrade to writes at once; take the write lock up front instead
+    # (what Django 5.1+ offers as OPTIONS["transaction_mode"] = "IMMEDIATE").
+    if connection.vendor == "sqlite":
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        DatabaseWrapper._start_transaction_under_autocommit = (
+            lambda self: self.cursor().execute("BEGIN IMMEDIATE")
+        )
+
+    workdir = tempfile.TemporaryDirectory()
+    db = connection.settings_dict
+    old_name = db["NAME"]
+    db.setdefault("TEST", {})["NAME"] = str(Path(workdir.name) / "benchmark.sqlite3")
+    db.setdefault("OPTIONS", {})["timeout"] = 60
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        session_ids = seed(args.students)
+        connection.close()
+
+        print(f"{args.students} students x {args.turns} turn(s), mock LLM latency {args.latency * 1000:.0f} ms")
+        print(
+            f"{'mode':<6}{'wall':>11}{'turns':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak':>8}{'err':>7}"
+            f"{'queued':>8}{'wait ms':>10}"
+        )
+
+        errors = 0
+        reset_rate_limit()
+        start = time.perf_counter()
+        rows = run_sync(session_ids, args.turns, args.workers)
+        errors += report("sync", rows, time.perf_counter() - start, llm)
+
+        llm.reset()
+        reset_rate_limit()
+        start = time.perf_counter()
+        rows = run_async(session_ids, args.turns)
+        errors += report("async", rows, time.perf_counter() - start, llm)
+        if errors:
+            sys.exit(1)
+    finally:
+        llm.close()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
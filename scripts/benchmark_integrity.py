@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-session integrity flag computation against the bulk aggregate engine.
+
+Usage:
+  python scripts/benchmark_integrity.py [--students 200] [--events 40] [--messages 12]
+
+Runs against a throwaway test database (never the configured one). Seeds one
+assignment with a completed viva per student, then times
+compute_integrity_flags() for every session and aggregate_integrity_counts()
+for the whole assignment, checks both produce the same flags, and reports
+wall time and query counts.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lti.settings")
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.utils.timezone import now  # noqa: E402
+
+from tool.models import (  # noqa: E402
+    Assignment,
+    Submission,
+    VivaSession,
+    VivaMessage,
+    InteractionLog,
+)
+from tool.views.dashboard import aggregate_integrity_counts  # noqa: E402
+from tool.views.viva import compute_integrity_flags, render_integrity_flags  # noqa: E402
+
+EVENT_TYPES = ["blur", "focus", "paste", "copy", "typing_cadence", "arrhythmic_typing"]
+
+
+def seed(students: int, events: int, messages: int) -> Assignment:
+    rng = random.Random(42)
+    assignment = Assignment.objects.create(slug="benchmark-integrity", title="Integrity benchmark")
+    started = now() - timedelta(hours=1)
+
+    subs = Submission.objects.bulk_create([
+        Submission(assignment=assignment, user_id=f"bench-{i}", comment="Benchmark essay")
+        for i in range(students)
+    ])
+    sessions = VivaSession.objects.bulk_create([
+        VivaSession(
+            submission=sub,
+            ended_at=started + timedelta(minutes=10),
+            duration_seconds=rng.choice([60, 300, 600]),
+        )
+        for sub in subs
+    ])
+    VivaSession.objects.filter(submission__assignment=assignment).update(started_at=started)
+
+    logs, msgs = [], []
+    for sub, sess in zip(subs, sessions):
+        for _ in range(events):
+            event_type = rng.choice(EVENT_TYPES)
+            data = {"session_id": sess.id}
+            if event_type == "paste":
+                data["length"] = rng.randint(1, 80)
+            if event_type == "copy":
+                data["source"] = rng.choice(["ai", "student"])
+            logs.append(InteractionLog(submission=sub, event_type=event_type, event_data=data))
+        for i in range(messages):
+            msgs.append(VivaMessage(
+                session=sess,
+                sender="ai" if i % 2 else "student",
+                text="Benchmark message",
+            ))
+    InteractionLog.objects.bulk_create(logs, batch_size=2000)
+    VivaMessage.objects.bulk_create(msgs, batch_size=2000)
+
+    # auto_now_add ignores explicit timestamps, so spread messages out afterwards
+    for sess in sessions:
+        ids = list(VivaMessage.objects.filter(session=sess).order_by("id").values_list("id", flat=True))
+        offset = 0
+        for msg_id in ids:
+            offset += rng.choice([20, 45, 90, 150])
+            VivaMessage.objects.filter(id=msg_id).update(timestamp=started + timedelta(seconds=offset))
+
+    return assignment
+
+
+def timed(fn):
+    with CaptureQueriesContext(connection) as ctx:
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+    return result, elapsed, len(ctx.captured_queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark integrity flag computation.")
+    parser.add_argument("--students", type=int, default=200, help="Number of seeded students/sessions.")
+    parser.add_argument("--events", type=int, default=40, help="Interaction logs per session.")
+    parser.add_argument("--messages", type=int, default=12, help="Viva messages per session.")
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        assignment = seed(args.students, args.events, args.messages)
+        sessions_qs = VivaSession.objects.filter(submission__assignment=assignment)
+
+        per_session, per_session_time, per_session_queries = timed(
+            lambda: {
+                sess.id: compute_integrity_flags(sess)
+                for sess in sessions_qs.select_related("submission__assignment")
+            }
+        )
+        (sessions, counts), bulk_time, bulk_queries = timed(
+            lambda: aggregate_integrity_counts(sessions_qs)
+        )
+        bulk = {
+            sess.id: render_integrity_flags(sess, assignment, counts[sess.id])
+            for sess in sessions
+        }
+
+        mismatches = [sid for sid, flags in per_session.items() if bulk.get(sid) != flags]
+        print(f"Sessions: {len(per_session)} ({args.events} events, {args.messages} messages each)")
+        print(f"Per-session: {per_session_time * 1000:9.1f} ms  {per_session_queries:6d} queries")
+        print(f"Aggregate:   {bulk_time * 1000:9.1f} ms  {bulk_queries:6d} queries")
+        if bulk_time:
+            print(f"Speed-up:    {per_session_time / bulk_time:9.1f}x")
+        print(f"Mismatched sessions: {len(mismatches)}")
+        if mismatches:
+            sys.exit(1)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Launch-storm load test: drive lti_login -> lti_launch -> assignment_view for
+many concurrent synthetic users against a local stand-in for Canvas.
+
+Usage:
+  python scripts/benchmark_launch.py [--users 300] [--concurrency 30]
+                                     [--instructors 2] [--roster 300]
+
+Runs against a throwaway SQLite test database (never the configured one).
+The fake platform serves the OIDC authorize endpoint, JWKS, the OAuth2 token
+endpoint and a paged NRPS memberships endpoint on 127.0.0.1. Reports overall
+throughput plus p50/p95/p99 latency and query counts for each tool step, and
+how often the tool called each platform endpoint.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import secrets
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lti.settings")
+
+import django  # noqa: E402
+django.setup()
+
+import jwt  # noqa: E402
+import requests  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+
+from tool.models import ToolConfig  # noqa: E402
+from tool.service_tokens import service_tokens  # noqa: E402
+
+CLIENT_ID = "benchmark-client"
+DEPLOYMENT_ID = "benchmark-deployment"
+RESOURCE_LINK_ID = "benchmark-launch"
+STEPS = ["login", "launch", "assignment"]
+
+LTI = "https://purl.imsglobal.org/spec/lti/claim/"
+INSTRUCTOR_ROLE = "http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor"
+LEARNER_ROLE = "http://purl.imsglobal.org/vocab/lis/v2/membership#Learner"
+
+
+def pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+# ---------------------------------------------------------
+# Canvas stand-in
+# ---------------------------------------------------------
+class FakePlatform:
+    """
+    Minimal LTI 1.3 platform. The authorize endpoint answers with JSON
+    ({"id_token", "state"}) rather than Canvas's auto-posting form so the
+    harness does not need to parse HTML.
+    """
+
+    def __init__(self, roster_size, page_size=100):
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.kid = "benchmark-platform"
+        self.roster_size = roster_size
+        self.page_size = page_size
+        self.hits = {"authorize": 0, "jwks": 0, "token": 0, "nrps": 0}
+        self._hits_lock = threading.Lock()
+
+        platform = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                if parsed.path == "/authorize":
+                    platform.count("authorize")
+                    self.reply(platform.authorize(query))
+                elif parsed.path == "/jwks":
+                    platform.count("jwks")
+                    self.reply(platform.jwks())
+                elif parsed.path == "/nrps":
+                    platform.count("nrps")
+                    body, link = platform.memberships(int(query.get("page", 1)))
+                    self.reply(body, headers={"Link": link} if link else None)
+                else:
+                    self.reply({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                if urlparse(self.path).path == "/token":
+                    platform.count("token")
+                    self.reply({
+                        "access_token": secrets.token_urlsafe(16),
+                        "token_type": "Bearer",
+                        "expires_in": 3600,
+                    })
+                else:
+                    self.reply({"error": "not found"}, status=404)
+
+            def reply(self, payload, status=200, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint):
+        with self._hits_lock:
+            self.hits[endpoint] += 1
+
+    def authorize(self, query):
+        user_id = query["login_hint"]
+        now = int(time.time())
+        claims = {
+            "iss": self.base_url,
+            "aud": query["client_id"],
+            "sub": user_id,
+            "iat": now,
+            "exp": now + 300,
+            "nonce": query["nonce"],
+            "name": f"Synthetic {user_id}",
+            LTI + "deployment_id": DEPLOYMENT_ID,
+            LTI + "message_type": "LtiResourceLinkRequest",
+            LTI + "version": "1.3.0",
+            LTI + "roles": [INSTRUCTOR_ROLE if user_id.startswith("instructor") else LEARNER_ROLE],
+            LTI + "resource_link": {"id": RESOURCE_LINK_ID, "title": "Launch benchmark"},
+            LTI + "context": {"id": "benchmark-course", "title": "Benchmark course"},
+            "https://purl.imsglobal.org/spec/lti-nrps/claim/namesroleservice": {
+                "context_memberships_url": self.base_url + "/nrps",
+                "service_versions": ["2.0"],
+            },
+        }
+        id_token = jwt.encode(claims, pem(self.key), algorithm="RS256", headers={"kid": self.kid})
+        return {"id_token": id_token, "state": query["state"]}
+
+    def jwks(self):
+        public = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.key.public_key()))
+        public.update({"kid": self.kid, "alg": "RS256", "use": "sig"})
+        return {"keys": [public]}
+
+    def memberships(self, page):
+        start = (page - 1) * self.page_size
+        end = min(start + self.page_size, self.roster_size)
+        members = [
+            {"user_id": f"student-{i}", "name": f"Synthetic student-{i}", "roles": ["Learner"]}
+            for i in range(start, end)
+        ]
+        link = None
+        if end < self.roster_size:
+            link = f'<{self.base_url}/nrps?page={page + 1}>; rel="next"'
+        return {"id": self.base_url + "/nrps", "members": members}, link
+
+
+# ---------------------------------------------------------
+# Synthetic users
+# ---------------------------------------------------------
+def timed_step(results, step, fn):
+    with CaptureQueriesContext(connection) as ctx:
+        start = time.perf_counter()
+        response = fn()
+        elapsed = time.perf_counter() - start
+    results.append((step, elapsed, len(ctx.captured_queries), response.status_code))
+    return response
+
+
+def launch_user(platform, user_id):
+    results = []
+    client = Client()
+    try:
+        resp = timed_step(results, "login", lambda: client.get("/login/", {
+            "iss": platform.base_url,
+            "login_hint": user_id,
+            "lti_message_hint": "benchmark",
+        }))
+        if resp.status_code != 302:
+            return results
+
+        # Browser round-trip through the platform's authorize endpoint
+        form = requests.get(resp["Location"], timeout=10).json()
+
+        resp = timed_step(results, "launch", lambda: client.post("/launch/", form))
+        if resp.status_code != 302:
+            return results
+
+        timed_step(results, "assignment", lambda: client.get(resp["Location"]))
+        return results
+    finally:
+        connection.close()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def report(all_results, wall_time, users, hits):
+    print(f"Users: {users}  wall time: {wall_time:.2f} s  throughput: {users / wall_time:.1f} launches/s")
+    print(f"{'step':<11}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'avg q':>8}{'max q':>7}")
+    failed = False
+    for step in STEPS:
+        rows = [r for r in all_results if r[0] == step]
+        expected = 200 if step == "assignment" else 302
+        ok = [r for r in rows if r[3] == expected]
+        failed = failed or len(ok) != users
+        latencies = sorted(r[1] * 1000 for r in ok)
+        queries = [r[2] for r in ok] or [0]
+        print(
+            f"{step:<11}{len(ok):>6}{users - len(ok):>6}"
+            f"{percentile(latencies, 50):>10.1f}{percentile(latencies, 95):>10.1f}"
+            f"{percentile(latencies, 99):>10.1f}{statistics.mean(queries):>8.1f}{max(queries):>7d}"
+        )
+    print("Platform calls: " + ", ".join(f"{name}={count}" for name, count in hits.items()))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent LTI launches.")
+    parser.add_argument("--users", type=int, default=300, help="Synthetic users to launch.")
+    parser.add_argument("--concurrency", type=int, default=30, help="Users launching at once.")
+    parser.add_argument("--instructors", type=int, default=2, help="How many of the users are instructors.")
+    parser.add_argument("--roster", type=int, default=300, help="NRPS roster size served by the platform.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the tool's debug output.")
+    args = parser.parse_args()
+
+    setup_test_environment()
+    workdir = tempfile.TemporaryDirectory()
+    key_path = Path(workdir.name) / "tool.pem"
+    key_path.write_bytes(pem(rsa.generate_private_key(public_exponent=65537, key_size=2048)))
+    service_tokens.private_key_path = str(key_path)
+
+    # A file-backed test database so worker threads share it
+    db = connection.settings_dict
+    old_name = db["NAME"]
+    db.setdefault("TEST", {})["NAME"] = str(Path(workdir.name) / "benchmark.sqlite3")
+    db.setdefault("OPTIONS", {})["timeout"] = 30
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    platform = FakePlatform(args.roster)
+    try:
+        ToolConfig.objects.all().delete()
+        ToolConfig.objects.create(
+            platform="Canvas",
+            issuer=platform.base_url,
+            client_id=CLIENT_ID,
+            deployment_id=DEPLOYMENT_ID,
+            jwks_url=platform.base_url + "/jwks",
+            authorize_url=platform.base_url + "/authorize",
+            token_url=platform.base_url + "/token",
+            redirect_uri="http://testserver/launch/",
+        )
+        connection.close()
+
+        user_ids = [f"instructor-{i}" for i in range(args.instructors)]
+        user_ids += [f"student-{i}" for i in range(args.users - len(user_ids))]
+
+        output = io.StringIO()
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(output)
+        with quiet, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            start = time.perf_counter()
+            per_user = list(pool.map(lambda uid: launch_user(platform, uid), user_ids))
+            wall_time = time.perf_counter() - start
+
+        all_results = [row for rows in per_user for row in rows]
+        failed = report(all_results, wall_time, len(user_ids), platform.hits)
+        if failed:
+            sys.exit(1)
+    finally:
+        platform.close()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
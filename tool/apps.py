@@ -7,6 +7,7 @@ class ToolConfig(AppConfig):
     name = 'tool'
 
     def ready(self):
+        from . import signals  # noqa: F401
         from .models import ToolConfig as PlatformConfig
         from django.db.utils import OperationalError, ProgrammingError
 
@@ -0,0 +1,170 @@
+import hashlib
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+
+class JwksError(RuntimeError):
+    """No platform key could be found to verify a launch token."""
+
+
+class JwksCache:
+    """
+    Process-wide cache of platform signing keys, keyed by JWKS URL.
+
+    Key sets are kept for LTI_JWKS_TTL seconds. A token signed with a kid we
+    have not seen forces a refetch (the platform may have rotated keys), but
+    at most once per LTI_JWKS_REFRESH_INTERVAL per URL so a stream of bad
+    tokens cannot turn into a stream of requests to the platform.
+
+    With persist=True the raw key set is also written to the Django cache, so
+    other workers and freshly started processes skip the first fetch, and the
+    last good set is still usable if the platform is unreachable.
+    """
+
+    def __init__(self, ttl=None, refresh_interval=None, timeout=None, persist=True):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.persist = persist
+        self._entries = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    # ---------------------------------------------------------
+    # Public API
+    # ---------------------------------------------------------
+    def get_signing_key(self, jwks_url, token):
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError as e:
+            raise JwksError(f"Unreadable token header: {e}") from e
+
+        entry = self._entry(jwks_url)
+        key = self._match(entry, kid)
+        if key is not None:
+            return key
+
+        # Unknown kid: the platform may have rotated its keys
+        entry = self._refresh(jwks_url, seen=entry, force=True)
+        key = self._match(entry, kid)
+        if key is None:
+            raise JwksError(f"Unable to find a signing key that matches: {kid!r}")
+        return key
+
+    def invalidate(self, jwks_url=None):
+        with self._guard:
+            if jwks_url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(jwks_url, None)
+
+    # ---------------------------------------------------------
+    # Internals
+    # ---------------------------------------------------------
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else settings.LTI_JWKS_TTL
+
+    def _refresh_interval(self):
+        if self.refresh_interval is not None:
+            return self.refresh_interval
+        return settings.LTI_JWKS_REFRESH_INTERVAL
+
+    def _lock_for(self, jwks_url):
+        with self._guard:
+            return self._locks.setdefault(jwks_url, threading.Lock())
+
+    def _is_fresh(self, entry):
+        return entry is not None and time.time() - entry["fetched_at"] < self._ttl()
+
+    def _entry(self, jwks_url):
+        entry = self._entries.get(jwks_url)
+        if self._is_fresh(entry):
+            return entry
+        return self._refresh(jwks_url, seen=entry)
+
+    def _match(self, entry, kid):
+        keys = entry["keys"]
+        if kid is None:
+            # Platforms with a single key sometimes omit the kid header
+            return next(iter(keys.values())) if len(keys) == 1 else None
+        return keys.get(kid)
+
+    def _refresh(self, jwks_url, seen, force=False):
+        with self._lock_for(jwks_url):
+            current = self._entries.get(jwks_url)
+            # Another thread refreshed while we waited for the lock
+            if current is not None and current is not seen and (force or self._is_fresh(current)):
+                return current
+
+            if not force:
+                stored = self._load(jwks_url)
+                if self._is_fresh(stored):
+                    self._entries[jwks_url] = stored
+                    return stored
+                current = current or stored
+
+            # Rate-limit refetches, including retries while the platform is down
+            if current is not None and time.time() - current["checked_at"] < self._refresh_interval():
+                return current
+
+            try:
+                data = self._download(jwks_url)
+            except JwksError as e:
+                if current is None:
+                    raise
+                print("DEBUG: JWKS refresh failed, using last known keys:", e)
+                current["checked_at"] = time.time()
+                self._entries[jwks_url] = current
+                return current
+
+            entry = self._build(data, time.time())
+            self._entries[jwks_url] = entry
+            self._store(jwks_url, data, entry["fetched_at"])
+            return entry
+
+    def _download(self, jwks_url):
+        timeout = self.timeout if self.timeout is not None else settings.LTI_JWKS_TIMEOUT
+        try:
+            resp = requests.get(jwks_url, timeout=timeout)
+            resp.raise_for_status()
+            return resp.json()
+        except (requests.RequestException, ValueError) as e:
+            raise JwksError(f"Failed to fetch JWKS from {jwks_url}: {e}") from e
+
+    def _build(self, data, fetched_at):
+        try:
+            key_set = jwt.PyJWKSet.from_dict(data)
+        except jwt.PyJWTError as e:
+            raise JwksError(f"Invalid JWKS: {e}") from e
+        keys = {
+            k.key_id: k.key
+            for k in key_set.keys
+            if k.public_key_use in ("sig", None)
+        }
+        return {"keys": keys, "fetched_at": fetched_at, "checked_at": fetched_at}
+
+    def _cache_key(self, jwks_url):
+        return "lti:jwks:" + hashlib.sha1(jwks_url.encode()).hexdigest()
+
+    def _load(self, jwks_url):
+        if not self.persist:
+            return None
+        stored = cache.get(self._cache_key(jwks_url))
+        if not stored:
+            return None
+        try:
+            return self._build(stored["jwks"], stored["fetched_at"])
+        except (JwksError, KeyError, TypeError):
+            return None
+
+    def _store(self, jwks_url, data, fetched_at):
+        if self.persist:
+            cache.set(self._cache_key(jwks_url), {"jwks": data, "fetched_at": fetched_at}, None)
+
+
+jwks_cache = JwksCache()
@@ -0,0 +1,505 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from openai import APIConnectionError, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from tool import metrics
+from tool.ratelimit import call_cost, llm_rate_limiter
+
+
+# Per-call HTTP attempt counter, set by LLMClientRegistry.track()
+_call_attempts = contextvars.ContextVar("llm_call_attempts", default=None)
+
+# Statuses worth another attempt; only outage-like ones count towards the breaker
+RETRYABLE_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+BREAKER_STATUSES = frozenset({500, 502, 503, 504})
+
+METRIC_LLM_RETRIES = "llm_retries"
+METRIC_BREAKER_OPENED = "llm_breaker_opened"
+METRIC_BREAKER_REJECTED = "llm_breaker_rejected"
+BREAKER_METRICS = [METRIC_LLM_RETRIES, METRIC_BREAKER_OPENED, METRIC_BREAKER_REJECTED]
+
+# Last breaker transition in any process, for viva_metrics
+BREAKER_STATE_KEY = "llm:breaker:last"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the provider while the breaker is open."""
+
+    def __init__(self, retry_in):
+        self.retry_in = max(1, int(retry_in + 0.999))
+        super().__init__(f"LLM provider unavailable; retry in {self.retry_in}s")
+
+
+def is_retryable(exc):
+    if isinstance(exc, (APIConnectionError, asyncio.TimeoutError)):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUSES
+
+
+def is_outage(exc):
+    # httpx errors surface unwrapped when a stream breaks mid-response
+    if isinstance(exc, (APIConnectionError, asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    return getattr(exc, "status_code", None) in BREAKER_STATUSES
+
+
+def retry_delay(attempt):
+    """Exponential backoff with jitter: half the capped delay plus a random half."""
+    cap = min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * 2 ** attempt)
+    return cap / 2 + random.uniform(0, cap / 2)
+
+
+class CircuitBreaker:
+    """
+    Process-wide breaker for the LLM provider. After LLM_BREAKER_FAILURES
+    consecutive outage errors (timeouts, connection errors, 5xx) it opens and
+    every call fails fast with CircuitOpenError for LLM_BREAKER_RESET
+    seconds. Then one trial call is let through (half-open): success closes
+    the breaker, failure opens it again.
+
+    State is in memory only, so it is safe to use from async code; the
+    registry reports transitions (see LLMClientRegistry._report).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return self.CLOSED
+        if now - self._opened_at < settings.LLM_BREAKER_RESET:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == self.CLOSED:
+                return
+            trial_running = self._trial_at is not None and now - self._trial_at < settings.LLM_BREAKER_RESET
+            if state == self.HALF_OPEN and not trial_running:
+                self._trial_at = now
+                return
+            retry_in = settings.LLM_BREAKER_RESET - (now - (self._trial_at or self._opened_at))
+        raise CircuitOpenError(retry_in)
+
+    def record_success(self):
+        """Returns True if this closed an open breaker."""
+        with self._lock:
+            was_open = self._opened_at is not None
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+        return was_open
+
+    def record_failure(self):
+        """Returns True if this opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            trial_failed = self._trial_at is not None
+            opened = trial_failed or (
+                self._opened_at is None and self._failures >= settings.LLM_BREAKER_FAILURES
+            )
+            if opened:
+                self._opened_at = time.monotonic()
+                self._trial_at = None
+        return opened
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            retry_in = 0
+            if state == self.OPEN:
+                retry_in = settings.LLM_BREAKER_RESET - (now - self._opened_at)
+            return {"state": state, "failures": self._failures, "retry_in": round(retry_in, 1)}
+
+
+class LLMClientRegistry:
+    """
+    Process-wide OpenAI clients with keep-alive connection pooling.
+
+    client() returns one shared synchronous client per API key/base URL; its
+    httpx pool is thread-safe, so every worker thread reuses the same TLS
+    connections. Async callers go through arun(): the async client lives on
+    a single background event loop owned by the registry, so its pool
+    survives the short-lived loops Django creates for async views under WSGI
+    and is shared by every request under ASGI.
+
+    complete() and acomplete() wrap chat completions in the resilience
+    policy: a per-call deadline, jittered exponential retries for retryable
+    errors and the process-wide circuit breaker (self.breaker). Every
+    attempt also takes its share of the cross-worker request and token
+    budget first (llm_rate_limiter), queueing briefly when it is spent.
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = {}
+        self._http = {}
+        self._requests = {"sync": 0, "async": 0}
+        self._loop = None
+
+    # ---------------------------------------------------------
+    # Configuration
+    # ---------------------------------------------------------
+    def _key(self):
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("Missing OPENAI_API_KEY")
+        return api_key, os.getenv("OPENAI_BASE_URL") or None
+
+    def _limits(self):
+        return httpx.Limits(
+            max_connections=settings.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+        )
+
+    def _timeout(self):
+        return httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT)
+
+    def _count(self, kind):
+        with self._lock:
+            self._requests[kind] += 1
+        tracker = _call_attempts.get()
+        if tracker is not None:
+            tracker["attempts"] += 1
+
+    @contextmanager
+    def track(self):
+        """
+        Count the HTTP attempts made by completions inside the block, so
+        callers can see the SDK's retries: tracker["attempts"] - 1.
+        """
+        tracker = {"attempts": 0}
+        token = _call_attempts.set(tracker)
+        try:
+            yield tracker
+        finally:
+            _call_attempts.reset(token)
+
+    # ---------------------------------------------------------
+    # Sync client
+    # ---------------------------------------------------------
+    def client(self):
+        key = self._key()
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                http_client = DefaultHttpxClient(
+                    limits=self._limits(),
+                    timeout=self._timeout(),
+                    event_hooks={"request": [lambda request: self._count("sync")]},
+                )
+                client = OpenAI(
+                    api_key=key[0],
+                    base_url=key[1],
+                    timeout=self._timeout(),
+                    max_retries=0,  # retried by complete()/acomplete()
+                    http_client=http_client,
+                )
+                self._http[("sync", key)] = http_client
+                self._clients[key] = client
+        return client
+
+    # ---------------------------------------------------------
+    # Async client (runs on the registry's own event loop)
+    # ---------------------------------------------------------
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-client-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _async_client(self, key):
+        # Only ever called on the registry loop, so no locking is needed
+        client = self._async_clients.get(key)
+        if client is None:
+            async def count(request):
+                self._count("async")
+
+            http_client = DefaultAsyncHttpxClient(
+                limits=self._limits(),
+                timeout=self._timeout(),
+                event_hooks={"request": [count]},
+            )
+            client = AsyncOpenAI(
+                api_key=key[0],
+                base_url=key[1],
+                timeout=self._timeout(),
+                max_retries=0,
+                http_client=http_client,
+            )
+            self._http[("async", key)] = http_client
+            self._async_clients[key] = client
+        return client
+
+    async def arun(self, call, tracker=None):
+        """
+        Await call(client) on the pooled async client, e.g.
+        await llm_clients.arun(lambda c: c.chat.completions.create(...)).
+        Pass a tracker dict ({"attempts": 0}) to count HTTP attempts.
+        """
+        key = self._key()
+
+        async def run():
+            # Runs as its own task on the registry loop, so this is task-local
+            _call_attempts.set(tracker)
+            return await call(self._async_client(key))
+
+        return await self._on_loop(run)
+
+    async def _on_loop(self, make):
+        """Await the coroutine make() on the registry loop; cancelling the caller cancels it."""
+        future = asyncio.run_coroutine_threadsafe(make(), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    # ---------------------------------------------------------
+    # Resilient completions
+    # ---------------------------------------------------------
+    def _attempt_timeout(self, deadline_at):
+        """Seconds the next attempt may take, or None once the deadline has passed."""
+        if deadline_at is None:
+            return settings.LLM_TIMEOUT
+        remaining = deadline_at - time.monotonic()
+        return min(settings.LLM_TIMEOUT, remaining) if remaining > 0 else None
+
+    def _report(self, event):
+        """Shared counters and last breaker state (Django cache, so sync only)."""
+        if event == "rejected":
+            metrics.incr(METRIC_BREAKER_REJECTED)
+        elif event == "retry":
+            metrics.incr(METRIC_LLM_RETRIES)
+        else:
+            print(f"DEBUG: LLM circuit breaker {event} (pid {os.getpid()})")
+            if event == CircuitBreaker.OPEN:
+                metrics.incr(METRIC_BREAKER_OPENED)
+            cache.set(BREAKER_STATE_KEY, {"state": event, "pid": os.getpid(), "at": time.time()}, None)
+
+    def _queue_time(self, deadline_at):
+        """Longest an attempt may wait for rate-limit budget."""
+        if deadline_at is None:
+            return settings.LLM_QUEUE_TIMEOUT
+        return max(0.0, min(settings.LLM_QUEUE_TIMEOUT, deadline_at - time.monotonic()))
+
+    def _after_failure(self, exc, attempt, deadline_at):
+        """
+        Note a failed attempt with the breaker and return how long to sleep
+        before retrying, or None if the error should be raised.
+        """
+        if is_outage(exc) and self.breaker.record_failure():
+            self._report(CircuitBreaker.OPEN)
+        if not is_retryable(exc) or attempt >= settings.LLM_MAX_RETRIES:
+            return None
+        delay = retry_delay(attempt)
+        if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+            return None
+        self._report("retry")
+        print(f"DEBUG: LLM call failed ({exc.__class__.__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def complete(self, client=None, deadline=None, **kwargs):
+        """
+        client.chat.completions.create(**kwargs) under the resilience policy.
+        `deadline` (seconds) bounds the whole call including retries and
+        time queued for rate-limit budget; each attempt's timeout is cut to
+        what is left of it. Streams count as successful once the response
+        starts and are returned wrapped in _bounded_stream, so the deadline
+        also covers reading them.
+        """
+        client = client or self.client()
+        deadline_at = time.monotonic() + deadline if deadline else None
+        cost = call_cost(kwargs)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self._report("rejected")
+                raise
+            llm_rate_limiter.acquire(cost, self._queue_time(deadline_at))
+            timeout = self._attempt_timeout(deadline_at)
+            if timeout is None:
+                raise TimeoutError("LLM call deadline exceeded")
+            try:
+                response = client.chat.completions.create(timeout=timeout, **kwargs)
+            except Exception as exc:
+                delay = self._after_failure(exc, attempt, deadline_at)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if self.breaker.record_success():
+                self._report(CircuitBreaker.CLOSED)
+            if kwargs.get("stream"):
+                return self._bounded_stream(response, deadline_at)
+            return response
+
+    def _bounded_stream(self, stream, deadline_at):
+        """
+        Chunks of a streamed completion until it ends or the deadline
+        passes; then the stream is closed and TimeoutError raised, so a
+        provider trickling tokens cannot hold the worker. Failures mid-stream
+        count towards the breaker like failed calls.
+        """
+        try:
+            for chunk in stream:
+                if deadline_at is not None and time.monotonic() >= deadline_at:
+                    raise TimeoutError("LLM call deadline exceeded while streaming")
+                yield chunk
+        except Exception as exc:
+            if is_outage(exc) and self.breaker.record_failure():
+                self._report(CircuitBreaker.OPEN)
+            raise
+        finally:
+            stream.close()
+
+    async def acomplete(self, deadline=None, tracker=None, **kwargs):
+        """
+        Async complete() on the pooled async client; the deadline is enforced
+        with wait_for. Reporting touches the database cache, so it goes
+        through sync_to_async, but only when something went wrong. Streams
+        are returned wrapped in _abounded_stream.
+        """
+        deadline_at = time.monotonic() + deadline if deadline else None
+        cost = call_cost(kwargs)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                await sync_to_async(self._report)("rejected")
+                raise
+            await llm_rate_limiter.aacquire(cost, self._queue_time(deadline_at))
+            timeout = self._attempt_timeout(deadline_at)
+            if timeout is None:
+                raise TimeoutError("LLM call deadline exceeded")
+            try:
+                response = await asyncio.wait_for(
+                    self.arun(
+                        lambda client: client.chat.completions.create(timeout=timeout, **kwargs),
+                        tracker=tracker,
+                    ),
+                    timeout,
+                )
+            except Exception as exc:
+                delay = await sync_to_async(self._after_failure)(exc, attempt, deadline_at)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if self.breaker.record_success():
+                await sync_to_async(self._report)(CircuitBreaker.CLOSED)
+            if kwargs.get("stream"):
+                return self._abounded_stream(response, deadline_at)
+            return response
+
+    async def _abounded_stream(self, stream, deadline_at):
+        """
+        Async _bounded_stream(). The stream belongs to the registry loop, so
+        each chunk is read there; waiting for a chunk is cut off at the
+        deadline rather than only checked between chunks.
+        """
+        chunks = aiter(stream)
+
+        async def next_chunk():
+            return await anext(chunks, None)
+
+        try:
+            while True:
+                timeout = self._attempt_timeout(deadline_at)
+                if timeout is None:
+                    raise TimeoutError("LLM call deadline exceeded while streaming")
+                try:
+                    chunk = await asyncio.wait_for(self._on_loop(next_chunk), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("LLM call deadline exceeded while streaming")
+                if chunk is None:
+                    return
+                yield chunk
+        except Exception as exc:
+            if is_outage(exc) and self.breaker.record_failure():
+                await sync_to_async(self._report)(CircuitBreaker.OPEN)
+            raise
+        finally:
+            await self._on_loop(stream.close)
+
+    # ---------------------------------------------------------
+    # Introspection / lifecycle
+    # ---------------------------------------------------------
+    def stats(self):
+        """Pool usage per client: requests sent and open/idle connections."""
+        limits = self._limits()
+        rows = []
+        for (kind, key), http_client in list(self._http.items()):
+            pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", None) or [])
+            rows.append({
+                "kind": kind,
+                "base_url": key[1] or "https://api.openai.com/v1",
+                "requests": self._requests[kind],
+                "connections": len(connections),
+                "idle_connections": sum(1 for c in connections if c.is_idle()),
+                "max_connections": limits.max_connections,
+                "max_keepalive_connections": limits.max_keepalive_connections,
+            })
+        return rows
+
+    def reset(self):
+        """Close every pooled client (used by tests and after key rotation)."""
+        with self._lock:
+            clients = list(self._clients.values())
+            async_clients = list(self._async_clients.values())
+            loop = self._loop
+            self._clients.clear()
+            self._async_clients.clear()
+            self._http.clear()
+            self._requests = {"sync": 0, "async": 0}
+            self._loop = None
+        self.breaker.reset()
+
+        for client in clients:
+            client.close()
+        if loop is not None and not loop.is_closed():
+            async def close_all():
+                for client in async_clients:
+                    try:
+                        await client.close()
+                    except Exception:
+                        pass
+
+            asyncio.run_coroutine_threadsafe(close_all(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+
+
+llm_clients = LLMClientRegistry()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from tool.models import Assignment, VivaSession
+from tool.views.dashboard import materialise_integrity_flags, recompute_integrity_flags
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Populate materialised integrity flags for existing viva sessions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--slug", help="Only backfill this assignment (resource_link_id).")
+        parser.add_argument("--force", action="store_true", help="Recompute records that already exist.")
+
+    def handle(self, *args, **options):
+        assignments = Assignment.objects.all().order_by("id")
+        if options.get("slug"):
+            assignments = assignments.filter(slug=options["slug"])
+
+        total = 0
+        for assignment in assignments:
+            if options.get("force"):
+                count = recompute_integrity_flags(assignment)
+            else:
+                sessions = list(
+                    VivaSession.objects.filter(
+                        submission__assignment=assignment,
+                        integrity__isnull=True,
+                    ).order_by("id")
+                )
+                for start in range(0, len(sessions), BATCH_SIZE):
+                    materialise_integrity_flags(assignment, sessions[start:start + BATCH_SIZE])
+                count = len(sessions)
+            if count:
+                self.stdout.write(f"{assignment.slug}: {count} session(s) backfilled")
+            total += count
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled integrity flags for {total} session(s)."))
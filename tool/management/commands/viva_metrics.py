@@ -0,0 +1,84 @@
+from datetime import datetime
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from tool import metrics
+from tool.llm import BREAKER_METRICS, BREAKER_STATE_KEY
+from tool.ratelimit import (
+    METRIC_LLM_QUEUE_WAIT_MS,
+    METRIC_LLM_QUEUED,
+    RATE_LIMIT_METRICS,
+    llm_rate_limiter,
+)
+from tool.views.viva import (
+    METRIC_CACHE_HIT_MS,
+    METRIC_CACHE_HIT_TURNS,
+    METRIC_CACHE_MISS_MS,
+    METRIC_CACHE_MISS_TURNS,
+    METRIC_CACHED_PROMPT_TOKENS,
+    METRIC_MODEL_ANSWER_CALLS,
+    METRIC_PAYLOAD_REPAIRS,
+    METRIC_PROMPT_TOKENS,
+    METRIC_TURN_ESTIMATED_TOKENS,
+    METRIC_TURN_PROMPT_TOKENS,
+    METRIC_VIVA_TURNS,
+    VIVA_METRICS,
+)
+
+
+class Command(BaseCommand):
+    help = "Show viva LLM call counters (turns, deferred model-answer calls, local repairs, prompt caching, retries, the circuit breaker and the rate-limit queue)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Zero the counters after printing.")
+
+    def handle(self, *args, **options):
+        counts = metrics.snapshot(VIVA_METRICS)
+        turns = counts[METRIC_VIVA_TURNS]
+        for name in VIVA_METRICS:
+            self.stdout.write(f"{name}: {counts[name]}")
+        if turns:
+            answers = counts[METRIC_MODEL_ANSWER_CALLS] / turns
+            repairs = counts[METRIC_PAYLOAD_REPAIRS] / turns
+            self.stdout.write(f"model-answer calls per turn: {answers:.2f}  repair rate: {repairs:.1%}")
+
+        prompt_tokens = counts[METRIC_PROMPT_TOKENS]
+        if prompt_tokens:
+            share = counts[METRIC_CACHED_PROMPT_TOKENS] / prompt_tokens
+            self.stdout.write(f"prompt tokens served from provider cache: {share:.1%}")
+        if counts[METRIC_TURN_PROMPT_TOKENS]:
+            ratio = counts[METRIC_TURN_ESTIMATED_TOKENS] / counts[METRIC_TURN_PROMPT_TOKENS]
+            self.stdout.write(f"budgeted / actual turn prompt tokens: {ratio:.2f}")
+        for label, turns_name, ms_name in (
+            ("cache hit", METRIC_CACHE_HIT_TURNS, METRIC_CACHE_HIT_MS),
+            ("cache miss", METRIC_CACHE_MISS_TURNS, METRIC_CACHE_MISS_MS),
+        ):
+            if counts[turns_name]:
+                avg = counts[ms_name] / counts[turns_name]
+                self.stdout.write(f"avg turn latency ({label}): {avg:.0f} ms over {counts[turns_name]} turns")
+
+        for name, value in metrics.snapshot(BREAKER_METRICS).items():
+            self.stdout.write(f"{name}: {value}")
+        last = cache.get(BREAKER_STATE_KEY)
+        if last:
+            at = datetime.fromtimestamp(last["at"]).isoformat(timespec="seconds")
+            self.stdout.write(f"circuit breaker last went {last['state']} at {at} (pid {last['pid']})")
+
+        queue = metrics.snapshot(RATE_LIMIT_METRICS)
+        for name, value in queue.items():
+            self.stdout.write(f"{name}: {value}")
+        if queue[METRIC_LLM_QUEUED]:
+            avg = queue[METRIC_LLM_QUEUE_WAIT_MS] / queue[METRIC_LLM_QUEUED]
+            self.stdout.write(f"avg queue wait: {avg:.0f} ms over {queue[METRIC_LLM_QUEUED]} queued calls")
+        if llm_rate_limiter.enabled():
+            budget = llm_rate_limiter.snapshot()
+            self.stdout.write(
+                f"rate limit: {budget['requests_available']}/{budget['requests_per_minute']} requests and "
+                f"{budget['tokens_available']}/{budget['tokens_per_minute']} tokens available, "
+                f"{budget['waiting']} calls queued"
+            )
+
+        if options.get("reset"):
+            metrics.reset(VIVA_METRICS + BREAKER_METRICS + RATE_LIMIT_METRICS)
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
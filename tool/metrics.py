@@ -0,0 +1,41 @@
+from django.db.models import BigIntegerField, Case, F, Value, When
+
+from tool.models import Counter
+
+PREFIX = "metrics:"
+
+
+def incr_many(amounts):
+    """
+    Bump several process-shared counters (Counter rows, never expire) in two
+    queries: create any missing rows, then add every amount in one UPDATE,
+    so increments from concurrent workers are never lost.
+    """
+    amounts = {PREFIX + name: amount for name, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    Counter.objects.bulk_create([Counter(name=name) for name in amounts], ignore_conflicts=True)
+    Counter.objects.filter(name__in=amounts).update(
+        value=F("value") + Case(
+            *[When(name=name, then=Value(amount)) for name, amount in amounts.items()],
+            default=Value(0),
+            output_field=BigIntegerField(),
+        )
+    )
+
+
+def incr(name, amount=1):
+    incr_many({name: amount})
+
+
+def get(name):
+    return snapshot([name])[name]
+
+
+def snapshot(names):
+    values = dict(Counter.objects.filter(name__in=[PREFIX + name for name in names]).values_list("name", "value"))
+    return {name: values.get(PREFIX + name, 0) for name in names}
+
+
+def reset(names):
+    Counter.objects.filter(name__in=[PREFIX + name for name in names]).delete()
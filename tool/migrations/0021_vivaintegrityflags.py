@@ -0,0 +1,31 @@
+# Generated by Django 5.0 on 2026-10-17 00:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0020_vivasessionresource'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VivaIntegrityFlags',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blur_count', models.IntegerField(default=0)),
+                ('paste_count', models.IntegerField(default=0)),
+                ('large_paste_count', models.IntegerField(default=0)),
+                ('ai_copy_count', models.IntegerField(default=0)),
+                ('long_gap_count', models.IntegerField(default=0)),
+                ('arrhythmic_count', models.IntegerField(default=0)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('flags', models.JSONField(default=list)),
+                ('finalized', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='integrity', to='tool.vivasession')),
+            ],
+        ),
+    ]
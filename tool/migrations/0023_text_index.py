@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-17 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0022_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignmentresource',
+            name='text_index',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='text_index',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-17 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0023_text_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vivasession',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='vivasession',
+            name='summary_upto_message_id',
+            field=models.IntegerField(default=0),
+        ),
+    ]
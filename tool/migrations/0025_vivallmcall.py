@@ -0,0 +1,33 @@
+# Generated by Django 5.0 on 2026-10-17 01:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0024_vivasession_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VivaLLMCall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('purpose', models.CharField(default='turn', max_length=20)),
+                ('model', models.CharField(max_length=100)),
+                ('prompt_tokens', models.IntegerField(blank=True, null=True)),
+                ('completion_tokens', models.IntegerField(blank=True, null=True)),
+                ('cached_tokens', models.IntegerField(blank=True, null=True)),
+                ('first_token_ms', models.IntegerField(blank=True, null=True)),
+                ('latency_ms', models.IntegerField(blank=True, null=True)),
+                ('retries', models.IntegerField(default=0)),
+                ('fallback', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='llm_calls', to='tool.vivamessage')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='llm_calls', to='tool.vivasession')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-17 01:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0025_vivallmcall'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vivallmcall',
+            name='won',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-17 01:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0026_vivallmcall_won'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vivamessage',
+            name='pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-17 01:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0027_vivamessage_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='question_bank',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
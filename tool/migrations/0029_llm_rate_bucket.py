@@ -0,0 +1,24 @@
+# Generated by Django 5.0 on 2026-10-17 01:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0028_submission_question_bank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMRateBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('requests', models.FloatField(default=0)),
+                ('tokens', models.FloatField(default=0)),
+                ('updated_at', models.FloatField(default=0)),
+                ('waiting', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
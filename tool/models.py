@@ -58,6 +58,11 @@ class Submission(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     file = models.FileField(upload_to="submissions/")
     comment = models.TextField(blank=True)
+    text_index = models.JSONField(default=dict, blank=True)  # chunk/term index of comment, see tool.retrieval
+    # Ranked candidate viva questions with exemplar answers, generated after
+    # upload: {"hash": ..., "resources": ..., "questions": [{"question", "model_answer"}, ...]}
+    # where the hashes identify the text and resource set it was built from
+    question_bank = models.JSONField(default=dict, blank=True)
     is_placeholder = models.BooleanField(default=False)
 
     # Optional: store grade if using AGS later
@@ -71,6 +76,7 @@ class AssignmentResource(models.Model):
     assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name="resources")
     file = models.FileField(upload_to="assignment_resources/")
     comment = models.TextField(blank=True)
+    text_index = models.JSONField(default=dict, blank=True)  # chunk/term index of comment, see tool.retrieval
     included = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -85,6 +91,9 @@ class VivaSession(models.Model):
     duration_seconds = models.IntegerField(null=True, blank=True)  # optional
     feedback_text = models.TextField(blank=True)
     rating = models.IntegerField(null=True, blank=True)
+    # Rolling summary of older turns; covers messages with id <= summary_upto_message_id
+    summary = models.TextField(blank=True)
+    summary_upto_message_id = models.IntegerField(default=0)
 
     def __str__(self):
         return f"Viva for {self.submission.user_id} (session {self.id})"
@@ -96,6 +105,63 @@ class VivaMessage(models.Model):
     text = models.TextField()
     model_answer = models.TextField(blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Opening question generated at viva start, not yet shown to the student
+    # (see claim_opening_question); left out of transcripts and prompts
+    pending = models.BooleanField(default=False)
+
+
+class VivaLLMCall(models.Model):
+    """
+    Telemetry for one completion made for a viva: the AI turn that produced
+    a message, the hedged duplicate of a slow turn, the pre-generated
+    opening question, a deferred model answer, or a summary refresh.
+    """
+    session = models.ForeignKey(VivaSession, on_delete=models.CASCADE, related_name="llm_calls")
+    message = models.ForeignKey(VivaMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name="llm_calls")
+    purpose = models.CharField(max_length=20, default="turn")  # "turn", "hedge", "opening", "model_answer" or "summary"
+    model = models.CharField(max_length=100)
+    prompt_tokens = models.IntegerField(null=True, blank=True)
+    completion_tokens = models.IntegerField(null=True, blank=True)
+    cached_tokens = models.IntegerField(null=True, blank=True)
+    first_token_ms = models.IntegerField(null=True, blank=True)  # streaming calls only
+    latency_ms = models.IntegerField(null=True, blank=True)
+    retries = models.IntegerField(default=0)
+    fallback = models.BooleanField(default=False)  # canned text was used instead of the model's
+    won = models.BooleanField(default=True)  # False for a hedged attempt whose answer was not used
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.purpose} call for session {self.session_id}"
+
+
+class Counter(models.Model):
+    """
+    Named counter shared by every worker and bumped with a single atomic
+    UPDATE (value = value + 1): the dashboard cache versions and the
+    metrics counters (tool/metrics.py).
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class LLMRateBucket(models.Model):
+    """
+    Shared token buckets for LLM calls across every worker process (see
+    tool/ratelimit.py): request and token levels as of updated_at (epoch
+    seconds), and how many calls are currently queued waiting for budget.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    requests = models.FloatField(default=0)
+    tokens = models.FloatField(default=0)
+    updated_at = models.FloatField(default=0)
+    waiting = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"LLM rate bucket {self.name}"
 
 
 class VivaSessionSubmission(models.Model):
@@ -164,3 +230,26 @@ class VivaFeedback(models.Model):
 
     def __str__(self):
         return f"Feedback for session {self.session.id}"
+
+
+class VivaIntegrityFlags(models.Model):
+    """
+    Materialised integrity flag inputs for a viva session.
+    Updated as logs and messages arrive; finalised when the session ends.
+    """
+    session = models.OneToOneField(VivaSession, on_delete=models.CASCADE, related_name="integrity")
+
+    blur_count = models.IntegerField(default=0)
+    paste_count = models.IntegerField(default=0)
+    large_paste_count = models.IntegerField(default=0)
+    ai_copy_count = models.IntegerField(default=0)
+    long_gap_count = models.IntegerField(default=0)
+    arrhythmic_count = models.IntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    flags = models.JSONField(default=list)  # rendered flag strings
+    finalized = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Integrity flags for session {self.session_id}"
@@ -0,0 +1,214 @@
+import asyncio
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+from django.db.models.lookups import GreaterThanOrEqual
+
+from tool import metrics
+from tool.models import LLMRateBucket
+from tool.tokens import count_message_tokens
+
+BUCKET_NAME = "default"
+
+# Waiting calls re-check the bucket at least this often (seconds), so they
+# notice budget freed up by settings changes as well as by refill
+MAX_POLL = 1.0
+
+METRIC_LLM_QUEUED = "llm_queued"
+METRIC_LLM_QUEUE_WAIT_MS = "llm_queue_wait_ms"
+METRIC_LLM_QUEUE_TIMEOUTS = "llm_queue_timeouts"
+RATE_LIMIT_METRICS = [METRIC_LLM_QUEUED, METRIC_LLM_QUEUE_WAIT_MS, METRIC_LLM_QUEUE_TIMEOUTS]
+
+
+class RateLimitTimeout(RuntimeError):
+    """Raised when a call could not get LLM budget within its queue time."""
+
+    def __init__(self, retry_in):
+        self.retry_in = max(1, int(retry_in + 0.999))
+        super().__init__(f"LLM request budget exhausted; retry in {self.retry_in}s")
+
+
+def call_cost(kwargs, model=None):
+    """Tokens to reserve for a completion: the prompt plus its reply allowance."""
+    reply = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or settings.LLM_COMPLETION_TOKENS_ESTIMATE
+    return count_message_tokens(kwargs.get("messages") or [], model or kwargs.get("model")) + reply
+
+
+class LLMRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets shared by every worker
+    process, as two token buckets on one LLMRateBucket row. Each bucket
+    holds up to a minute's budget and refills continuously; a call takes one
+    request and its estimated tokens (call_cost) in a single conditional
+    UPDATE, so concurrent workers can never overspend.
+
+    A call that does not fit waits (queues) until the buckets have refilled
+    enough, up to its max_wait, then fails with RateLimitTimeout. Waiters
+    poll rather than line up, so the queue is not strictly first-come
+    first-served. With LLM_REQUESTS_PER_MINUTE and LLM_TOKENS_PER_MINUTE
+    both 0 (the default) the limiter is off and costs nothing.
+    """
+
+    def enabled(self):
+        return settings.LLM_REQUESTS_PER_MINUTE > 0 or settings.LLM_TOKENS_PER_MINUTE > 0
+
+    def _budgets(self, cost):
+        """(capacity, cost) per bucket; a disabled bucket has both at zero."""
+        rpm = max(0, settings.LLM_REQUESTS_PER_MINUTE)
+        tpm = max(0, settings.LLM_TOKENS_PER_MINUTE)
+        # A call larger than the whole bucket would otherwise never fit
+        return (rpm, 1 if rpm else 0), (tpm, min(cost, tpm))
+
+    # ---------------------------------------------------------
+    # Bucket row
+    # ---------------------------------------------------------
+    def _levels(self, row, now):
+        """Bucket levels refilled up to `now`."""
+        elapsed = max(0.0, now - row["updated_at"])
+        (rpm, _), (tpm, _) = self._budgets(0)
+        return (
+            min(rpm, row["requests"] + elapsed * rpm / 60),
+            min(tpm, row["tokens"] + elapsed * tpm / 60),
+        )
+
+    def try_acquire(self, cost):
+        """
+        Take budget for one call of `cost` tokens if it is there. Returns 0
+        when granted, otherwise the estimated seconds until it will be.
+        """
+        (rpm, need_requests), (tpm, need_tokens) = self._budgets(cost)
+        now = time.time()
+        elapsed = Greatest(Value(0.0), Value(now) - F("updated_at"))
+        requests = Least(Value(float(rpm)), F("requests") + elapsed * Value(rpm / 60))
+        tokens = Least(Value(float(tpm)), F("tokens") + elapsed * Value(tpm / 60))
+
+        granted = LLMRateBucket.objects.filter(
+            GreaterThanOrEqual(requests, Value(float(need_requests))),
+            GreaterThanOrEqual(tokens, Value(float(need_tokens))),
+            name=BUCKET_NAME,
+        ).update(
+            requests=requests - Value(float(need_requests)),
+            tokens=tokens - Value(float(need_tokens)),
+            updated_at=Greatest(F("updated_at"), Value(now)),
+        )
+        if granted:
+            return 0
+
+        row = LLMRateBucket.objects.filter(name=BUCKET_NAME).values("requests", "tokens", "updated_at").first()
+        if row is None:
+            # First call anywhere: start with full buckets
+            LLMRateBucket.objects.get_or_create(
+                name=BUCKET_NAME, defaults={"requests": rpm, "tokens": tpm, "updated_at": now},
+            )
+            return self.try_acquire(cost)
+
+        have_requests, have_tokens = self._levels(row, now)
+        wait = 0.0
+        if need_requests > have_requests:
+            wait = max(wait, (need_requests - have_requests) / (rpm / 60))
+        if need_tokens > have_tokens:
+            wait = max(wait, (need_tokens - have_tokens) / (tpm / 60))
+        # Another worker may have taken the budget between the two queries
+        return max(wait, 0.01)
+
+    def _queue(self, delta):
+        LLMRateBucket.objects.filter(name=BUCKET_NAME).update(waiting=Greatest(Value(0), F("waiting") + delta))
+
+    # ---------------------------------------------------------
+    # Waiting for budget
+    # ---------------------------------------------------------
+    def _next_sleep(self, wait, started, max_wait):
+        """How long to sleep before trying again, or None to give up."""
+        remaining = max_wait - (time.monotonic() - started)
+        if wait > remaining:
+            return None
+        return min(wait, MAX_POLL) * random.uniform(1, 1.2)
+
+    def _enter(self):
+        self._queue(1)
+        metrics.incr(METRIC_LLM_QUEUED)
+
+    def _leave(self, started, timed_out):
+        self._queue(-1)
+        metrics.incr_many({
+            METRIC_LLM_QUEUE_WAIT_MS: int((time.monotonic() - started) * 1000),
+            METRIC_LLM_QUEUE_TIMEOUTS: int(timed_out),
+        })
+        if timed_out:
+            print(f"DEBUG: LLM rate limit, gave up after {time.monotonic() - started:.1f}s in the queue")
+
+    def acquire(self, cost, max_wait):
+        """
+        Block until a call of `cost` tokens fits the budget, for at most
+        max_wait seconds. Returns the seconds spent queued.
+        """
+        if not self.enabled():
+            return 0.0
+        started = time.monotonic()
+        wait = self.try_acquire(cost)
+        if not wait:
+            return 0.0
+
+        self._enter()
+        timed_out = False
+        try:
+            while wait:
+                delay = self._next_sleep(wait, started, max_wait)
+                if delay is None:
+                    timed_out = True
+                    break
+                time.sleep(delay)
+                wait = self.try_acquire(cost)
+        finally:
+            self._leave(started, timed_out)
+        if timed_out:
+            raise RateLimitTimeout(wait)
+        return time.monotonic() - started
+
+    async def aacquire(self, cost, max_wait):
+        """acquire() for async callers: queries run via sync_to_async, waits on the loop."""
+        if not self.enabled():
+            return 0.0
+        started = time.monotonic()
+        wait = await sync_to_async(self.try_acquire)(cost)
+        if not wait:
+            return 0.0
+
+        await sync_to_async(self._enter)()
+        timed_out = False
+        try:
+            while wait:
+                delay = self._next_sleep(wait, started, max_wait)
+                if delay is None:
+                    timed_out = True
+                    break
+                await asyncio.sleep(delay)
+                wait = await sync_to_async(self.try_acquire)(cost)
+        finally:
+            await sync_to_async(self._leave)(started, timed_out)
+        if timed_out:
+            raise RateLimitTimeout(wait)
+        return time.monotonic() - started
+
+    # ---------------------------------------------------------
+    # Introspection
+    # ---------------------------------------------------------
+    def snapshot(self):
+        """Current budgets, bucket levels and queue depth (for viva_metrics)."""
+        row = LLMRateBucket.objects.filter(name=BUCKET_NAME).values("requests", "tokens", "updated_at", "waiting").first()
+        (rpm, _), (tpm, _) = self._budgets(0)
+        requests, tokens = self._levels(row, time.time()) if row else (rpm, tpm)
+        return {
+            "requests_per_minute": rpm,
+            "tokens_per_minute": tpm,
+            "requests_available": int(requests),
+            "tokens_available": int(tokens),
+            "waiting": row["waiting"] if row else 0,
+        }
+
+
+llm_rate_limiter = LLMRateLimiter()
@@ -0,0 +1,141 @@
+import hashlib
+import math
+import re
+from collections import Counter
+
+from .tokens import count_tokens
+
+# Target chunk size; paragraphs are packed together up to this length
+CHUNK_CHARS = 1200
+
+# BM25 parameters (the usual defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have having
+he her here hers herself him himself his how i if in into is it its itself just me more most my myself no
+nor not now of off on once only or other our ours ourselves out over own same she should so some such than
+that the their theirs them themselves then there these they this those through to too under until up very
+was we were what when where which while who whom why will with would you your yours yourself yourselves
+""".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def text_hash(text):
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------
+# Chunking / indexing
+# ---------------------------------------------------------
+def _split_long(text, start, end):
+    """Split an over-long paragraph at whitespace, CHUNK_CHARS at a time."""
+    spans = []
+    while end - start > CHUNK_CHARS:
+        cut = text.rfind(" ", start, start + CHUNK_CHARS)
+        if cut <= start:
+            cut = start + CHUNK_CHARS
+        spans.append((start, cut))
+        start = cut + 1 if text[cut] == " " else cut
+    spans.append((start, end))
+    return spans
+
+
+def chunk_spans(text):
+    """(start, end) offsets of paragraph-aligned chunks covering the text."""
+    paragraphs = []
+    for match in re.finditer(r"\S(?:.*?\S)?(?=\s*\n\s*\n|\s*$)", text or "", re.DOTALL):
+        paragraphs.extend(_split_long(text, match.start(), match.end()))
+
+    spans = []
+    for start, end in paragraphs:
+        if spans and end - spans[-1][0] <= CHUNK_CHARS:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return spans
+
+
+def build_index(text):
+    """
+    Chunk offsets and term frequencies for a file's extracted text. Stored
+    as JSON on the row (see text_index) so turns never re-tokenise files.
+    """
+    chunks = []
+    for start, end in chunk_spans(text):
+        terms = tokenize(text[start:end])
+        chunks.append({"start": start, "end": end, "len": len(terms), "tf": dict(Counter(terms))})
+    return {"hash": text_hash(text), "chunks": chunks}
+
+
+def current_index(text, index):
+    """The stored index if it still matches the text, otherwise a fresh one."""
+    if isinstance(index, dict) and index.get("hash") == text_hash(text):
+        return index
+    return build_index(text)
+
+
+# ---------------------------------------------------------
+# Retrieval
+# ---------------------------------------------------------
+def bm25_scores(chunks, query_terms):
+    if not chunks or not query_terms:
+        return [0.0] * len(chunks)
+    n = len(chunks)
+    avg_len = sum(c["len"] for c in chunks) / n or 1.0
+    scores = [0.0] * n
+    for term in set(query_terms):
+        df = sum(1 for c in chunks if term in c["tf"])
+        if not df:
+            continue
+        idf = math.log((n - df + 0.5) / (df + 0.5) + 1)
+        for i, chunk in enumerate(chunks):
+            tf = chunk["tf"].get(term)
+            if tf:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk["len"] / avg_len)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+def select_chunks(documents, query, max_tokens):
+    """
+    Pick the chunks most relevant to `query` across `documents` (each a dict
+    with "name", "text" and "chunks" from build_index) until max_tokens is
+    spent. Without a query, or when nothing matches, chunks are taken in
+    reading order, alternating between documents.
+
+    Returns [(document, [chunk text, ...])] with chunks in document order.
+    """
+    candidates = [
+        (doc_index, position, chunk)
+        for doc_index, doc in enumerate(documents)
+        for position, chunk in enumerate(doc["chunks"])
+    ]
+    scores = bm25_scores([c for _, _, c in candidates], tokenize(query))
+    order = sorted(
+        range(len(candidates)),
+        key=lambda i: (-scores[i], candidates[i][1], candidates[i][0]),
+    )
+
+    picked = {}
+    remaining = max_tokens
+    for i in order:
+        doc_index, position, chunk = candidates[i]
+        text = documents[doc_index]["text"][chunk["start"]:chunk["end"]]
+        cost = count_tokens(text)
+        if cost > remaining:
+            continue
+        remaining -= cost
+        picked.setdefault(doc_index, []).append((position, text))
+
+    return [
+        (documents[doc_index], [text for _, text in sorted(picked[doc_index])])
+        for doc_index in sorted(picked)
+    ]
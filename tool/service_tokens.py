@@ -0,0 +1,125 @@
+import secrets
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+
+NRPS_SCOPE = "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly"
+
+# Refresh this many seconds before the platform says a token expires
+EXPIRY_MARGIN_SECONDS = 60
+
+
+class ServiceTokenError(RuntimeError):
+    """The platform token endpoint did not return an access token."""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+class ServiceTokenManager:
+    """
+    OAuth2 client-credentials tokens for LTI Advantage services (NRPS, AGS).
+
+    The tool's private key is read once per process. Access tokens are cached
+    per platform and scope set until shortly before they expire, and
+    concurrent callers needing the same token share a single refresh.
+    """
+
+    def __init__(self, private_key_path=None, timeout=None):
+        self.private_key_path = private_key_path
+        self.timeout = timeout
+        self._private_key = None
+        self._tokens = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def private_key(self):
+        if self._private_key is None:
+            with self._guard:
+                if self._private_key is None:
+                    with open(self.private_key_path or settings.LTI_PRIVATE_KEY_PATH, "rb") as f:
+                        self._private_key = f.read()
+        return self._private_key
+
+    def _lock_for(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _cached(self, key):
+        cached = self._tokens.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+        return None
+
+    def get_token(self, platform, scopes):
+        if isinstance(scopes, str):
+            scopes = [scopes]
+        key = (platform.token_url, platform.client_id, tuple(sorted(set(scopes))))
+
+        token = self._cached(key)
+        if token:
+            return token
+
+        with self._lock_for(key):
+            # Another thread may have refreshed while we waited
+            token = self._cached(key)
+            if token:
+                return token
+            token, expires_in = self._request_token(platform, key[2])
+            self._tokens[key] = (token, time.time() + max(0, expires_in - EXPIRY_MARGIN_SECONDS))
+            return token
+
+    def invalidate(self, platform=None):
+        with self._guard:
+            if platform is None:
+                self._tokens.clear()
+                return
+            for key in [k for k in self._tokens if k[:2] == (platform.token_url, platform.client_id)]:
+                self._tokens.pop(key, None)
+
+    def _request_token(self, platform, scopes):
+        now = int(time.time())
+        client_assertion = jwt.encode(
+            {
+                "iss": platform.client_id,
+                "sub": platform.client_id,
+                "aud": platform.token_url,  # MUST match the platform token endpoint
+                "iat": now,
+                "exp": now + 60,
+                "jti": secrets.token_urlsafe(16),
+            },
+            self.private_key(),
+            algorithm="RS256",
+        )
+
+        try:
+            resp = requests.post(
+                platform.token_url,
+                data={
+                    "grant_type": "client_credentials",
+                    "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+                    "client_assertion": client_assertion,
+                    "scope": " ".join(scopes),
+                },
+                timeout=self.timeout or settings.NRPS_TIMEOUT,
+            )
+            token_json = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            raise ServiceTokenError(f"Token request failed: {e}") from e
+
+        access_token = token_json.get("access_token") if isinstance(token_json, dict) else None
+        if not access_token:
+            raise ServiceTokenError("Failed to obtain access token", details=token_json)
+
+        try:
+            expires_in = int(token_json.get("expires_in", 3600))
+        except (TypeError, ValueError):
+            expires_in = 3600
+        return access_token, expires_in
+
+
+service_tokens = ServiceTokenManager()
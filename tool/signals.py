@@ -0,0 +1,101 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import (
+    Assignment,
+    AssignmentResource,
+    InteractionLog,
+    Submission,
+    VivaFeedback,
+    VivaMessage,
+    VivaSession,
+    VivaSessionResource,
+    VivaSessionSubmission,
+)
+from .retrieval import current_index, text_hash
+from .views.dashboard import bump_dashboard_version
+from .views.viva import bump_context_version
+
+
+# ---------------------------------------------------------------
+# Dashboard cache invalidation: any write that can change the
+# instructor dashboard bumps its assignment's version counter once
+# the write commits (see bump_dashboard_version).
+# ---------------------------------------------------------------
+def _assignment_id_for(instance):
+    if isinstance(instance, Assignment):
+        return instance.id
+    if isinstance(instance, (Submission, AssignmentResource)):
+        return instance.assignment_id
+    if isinstance(instance, VivaSession):
+        return instance.submission.assignment_id
+    if isinstance(instance, InteractionLog):
+        return instance.submission.assignment_id
+    if isinstance(instance, (VivaMessage, VivaFeedback)):
+        # One query rather than lazily loading the session and its submission
+        return (
+            VivaSession.objects.filter(id=instance.session_id)
+            .values_list("submission__assignment_id", flat=True)
+            .first()
+        )
+    return None
+
+
+# LLM call telemetry is left out: the dashboard's usage figures can wait
+# for the next other write or DASHBOARD_CACHE_TIMEOUT, and every call would
+# otherwise bump the version. So are integrity flag records: they are
+# written alongside a message, log or session save that already bumps it,
+# and bulk rewrites bump it themselves (see rerender_integrity_flags).
+DASHBOARD_MODELS = (
+    Assignment,
+    AssignmentResource,
+    InteractionLog,
+    Submission,
+    VivaFeedback,
+    VivaMessage,
+    VivaSession,
+)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_dashboard_cache(sender, instance, **kwargs):
+    if sender not in DASHBOARD_MODELS:
+        return
+    try:
+        assignment_id = _assignment_id_for(instance)
+    except Exception:
+        # Parent rows may already be gone during cascading deletes
+        return
+    bump_dashboard_version(assignment_id)
+
+
+# ---------------------------------------------------------------
+# Submission context cache invalidation: session file toggles bump
+# the session's context version; resource or submission edits bump
+# the assignment's, which covers every session using them.
+# ---------------------------------------------------------------
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_submission_context(sender, instance, **kwargs):
+    if sender in (VivaSessionSubmission, VivaSessionResource):
+        bump_context_version(session_id=instance.session_id)
+    elif sender in (AssignmentResource, Submission):
+        bump_context_version(assignment_id=instance.assignment_id)
+
+
+# ---------------------------------------------------------------
+# Retrieval index: re-chunk extracted text whenever it changes, so
+# uploads are indexed once instead of on every viva turn.
+# ---------------------------------------------------------------
+@receiver(pre_save, sender=Submission)
+@receiver(pre_save, sender=AssignmentResource)
+def refresh_text_index(sender, instance, **kwargs):
+    instance.text_index = current_index(instance.comment, instance.text_index)
+
+
+@receiver(pre_save, sender=Submission)
+def drop_stale_question_bank(sender, instance, **kwargs):
+    bank = instance.question_bank or {}
+    if bank.get("hash") and bank["hash"] != text_hash(instance.comment):
+        instance.question_bank = {}
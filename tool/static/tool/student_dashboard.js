@@ -82,6 +82,9 @@ document.addEventListener("DOMContentLoaded", () => {
     const keystrokeTracking = pageEl?.dataset.keystrokeTracking === "true";
     const arrhythmicTracking = pageEl?.dataset.arrhythmicTyping === "true";
     const modelAnswersEnabled = pageEl?.dataset.modelAnswersEnabled === "true";
+    const MODEL_ANSWER_POLL_MS = 2000;
+    const MODEL_ANSWER_POLL_ATTEMPTS = 30;
+    const modelAnswerPolls = new Set();
     const summaryCard = document.querySelector("[data-viva-summary-card]");
     const summaryPanel = summaryCard;
     const chatCard = document.querySelector("[data-viva-chat-card]");
@@ -348,6 +351,7 @@ document.addEventListener("DOMContentLoaded", () => {
                     sender: isAi ? "ai" : "student",
                     text,
                     model_answer: isAi ? modelAnswer : "",
+                    model_answer_pending: isAi && modelAnswersEnabled && !modelAnswer,
                 };
             });
     };
@@ -565,6 +569,7 @@ document.addEventListener("DOMContentLoaded", () => {
         }
         vivaChatWindow.appendChild(bubble);
         scrollVivaChat();
+        return bubble;
     };
 
     const showVivaThinking = () => {
@@ -755,6 +760,7 @@ document.addEventListener("DOMContentLoaded", () => {
             text,
             ts: new Date().toISOString(),
             model_answer: modelAnswer || "",
+            model_answer_pending: sender === "ai" && modelAnswersEnabled && !modelAnswer,
         });
     };
 
@@ -841,6 +847,71 @@ document.addEventListener("DOMContentLoaded", () => {
         });
     };
 
+    const parseSseFrame = (frame) => {
+        let event = "message";
+        const dataLines = [];
+        frame.split("\n").forEach((line) => {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) dataLines.push(line.slice(5).trimStart());
+        });
+        if (!dataLines.length) return null;
+        try {
+            return { event, data: JSON.parse(dataLines.join("\n")) };
+        } catch (err) {
+            return null;
+        }
+    };
+
+    // Streams the AI reply over server-sent events, calling onDelta with each
+    // piece of question text. Falls back to the JSON endpoint if streaming is
+    // unavailable before anything has been shown.
+    const requestAiReplyStream = async (sessionId, text, onDelta) => {
+        if (!sessionId) return null;
+        const body = JSON.stringify({ session_id: sessionId, sender: "student", text });
+        let res;
+        try {
+            res = await fetch("/viva/send/stream/", {
+                method: "POST",
+                headers: {
+                    "Accept": "text/event-stream",
+                    "Content-Type": "application/json",
+                },
+                credentials: "same-origin",
+                body,
+            });
+        } catch (err) {
+            console.warn("Streaming unavailable, falling back", err);
+            return await requestAiReply(sessionId, text);
+        }
+        const contentType = res.headers.get("content-type") || "";
+        if (!res.ok || !res.body || !contentType.includes("text/event-stream")) {
+            return await res.json().catch(() => ({ status: "error" }));
+        }
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let done = null;
+        try {
+            while (!done) {
+                const { value, done: finished } = await reader.read();
+                if (finished) break;
+                buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, "\n");
+                let split = buffer.indexOf("\n\n");
+                while (split !== -1) {
+                    const frame = parseSseFrame(buffer.slice(0, split));
+                    buffer = buffer.slice(split + 2);
+                    if (frame?.event === "delta") onDelta(frame.data.text || "");
+                    if (frame?.event === "done") done = frame.data;
+                    split = buffer.indexOf("\n\n");
+                }
+            }
+        } catch (err) {
+            console.warn("Viva reply stream interrupted", err);
+        }
+        return done || { status: "error", error: "Stream ended early" };
+    };
+
     const enterSubmitMode = () => {
         vivaExpired = true;
         setVivaInputDisabled(false);
@@ -902,17 +973,35 @@ document.addEventListener("DOMContentLoaded", () => {
         vivaInput.value = "";
         const thinking = showVivaThinking();
         setVivaInputDisabled(true);
-        const response = await requestAiReply(activeId, text);
+        let streamBubble = null;
+        let streamed = "";
+        const response = await requestAiReplyStream(activeId, text, (delta) => {
+            if (!streamBubble) {
+                thinking?.remove();
+                streamBubble = addVivaBubble("ai", "");
+            }
+            streamed += delta;
+            const content = streamBubble?.querySelector(".bubble-text");
+            if (content) content.textContent = streamed;
+            scrollVivaChat();
+        });
         if (response?.status === "error") {
             console.warn("AI reply error:", response?.error || "Unknown error");
         }
         thinking?.remove();
-        let reply = response?.ai_text || "";
+        let reply = response?.ai_text || streamed;
         const modelAnswer = response?.ai_model_answer || "";
         if (!reply) {
             reply = "Thanks. Could you clarify that point a little more?";
         }
-        addVivaBubble("ai", reply, { modelAnswer });
+        if (streamBubble) {
+            // The saved reply is authoritative; it replaces the streamed text
+            const content = streamBubble.querySelector(".bubble-text");
+            if (content) content.textContent = reply;
+            if (modelAnswer) streamBubble.dataset.modelAnswer = modelAnswer;
+        } else {
+            addVivaBubble("ai", reply, { modelAnswer });
+        }
         addHistoryEntry(activeId, "ai", reply, modelAnswer);
         if (!vivaTimerStarted) startVivaTimer();
         setVivaInputDisabled(false);
@@ -933,7 +1022,46 @@ document.addEventListener("DOMContentLoaded", () => {
 
     const historyHasModelAnswers = (sessionId) => {
         const history = sessionHistories[String(sessionId)] || [];
-        return history.some((m) => (m.model_answer || "").trim());
+        return history.some((m) => (m.model_answer || "").trim() || m.model_answer_pending);
+    };
+
+    // Model answers are generated in the background once the viva ends, so
+    // poll until every missing one has arrived, calling onUpdate each time.
+    const loadModelAnswers = async (sessionId, onUpdate) => {
+        const key = String(sessionId);
+        const history = sessionHistories[key] || [];
+        if (modelAnswerPolls.has(key)) return;
+        modelAnswerPolls.add(key);
+        try {
+            for (let attempt = 0; attempt < MODEL_ANSWER_POLL_ATTEMPTS; attempt += 1) {
+                if (!history.some((m) => m.model_answer_pending)) return;
+                if (attempt) {
+                    await new Promise((resolve) => setTimeout(resolve, MODEL_ANSWER_POLL_MS));
+                }
+                const res = await fetch(`/viva/model_answers/${sessionId}/`, {
+                    credentials: "same-origin",
+                });
+                const data = await res.json();
+                if (!["ok", "pending", "disabled"].includes(data.status)) return;
+                const done = data.status !== "pending";
+                const byText = new Map();
+                (data.model_answers || []).forEach((entry) => {
+                    if (entry.model_answer) byText.set(entry.text, entry.model_answer);
+                });
+                history.forEach((m) => {
+                    if (!m.model_answer_pending) return;
+                    const answer = byText.get(m.text);
+                    if (answer) m.model_answer = answer;
+                    // Still-missing answers stay pending so a later toggle polls again
+                    if (answer || done) m.model_answer_pending = false;
+                });
+                if (onUpdate) onUpdate();
+            }
+        } catch (err) {
+            console.warn("Failed to load model answers", err);
+        } finally {
+            modelAnswerPolls.delete(key);
+        }
     };
 
     const updateModelToggle = (sessionId) => {
@@ -1024,9 +1152,17 @@ document.addEventListener("DOMContentLoaded", () => {
     if (modelToggleBtn) {
         modelToggleBtn.addEventListener("click", () => {
             if (!activeHistorySessionId) return;
+            const sessionId = activeHistorySessionId;
             showModelAnswers = !showModelAnswers;
-            updateModelToggle(activeHistorySessionId);
-            renderHistory(activeHistorySessionId);
+            if (showModelAnswers) {
+                loadModelAnswers(sessionId, () => {
+                    if (activeHistorySessionId !== sessionId || !showModelAnswers) return;
+                    updateModelToggle(sessionId);
+                    renderHistory(sessionId);
+                });
+            }
+            updateModelToggle(sessionId);
+            renderHistory(sessionId);
         });
     }
 
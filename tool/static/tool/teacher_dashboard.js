@@ -11,6 +11,7 @@ document.addEventListener("DOMContentLoaded", () => {
     const tablePane = document.querySelector("[data-dash-pane='table']");
     const tableNote = document.querySelector("[data-table-note]");
     const tableNoteTop = document.querySelector("[data-table-note-top]");
+    const llmUsageNote = document.querySelector("[data-llm-usage]");
     const filterInput = document.querySelector("[data-student-filter]");
     const transcriptSelect = document.querySelector("[data-transcript-select]");
     const attemptSelect = document.querySelector("[data-attempt-select]");
@@ -60,6 +61,24 @@ document.addEventListener("DOMContentLoaded", () => {
         tableNoteTop.textContent = `Roster: ${completed}/${total} completed · ${flagged} flagged · click a student to review.`;
     }
 
+    const turnUsage = data.llm_usage && data.llm_usage.turn;
+    if (llmUsageNote && turnUsage && turnUsage.calls) {
+        const secs = (ms) => (ms == null ? "—" : `${(ms / 1000).toFixed(1)} s`);
+        const perTurn = Math.round((turnUsage.prompt_tokens + turnUsage.completion_tokens) / turnUsage.calls);
+        const cachedShare = turnUsage.prompt_tokens
+            ? Math.round((100 * turnUsage.cached_tokens) / turnUsage.prompt_tokens)
+            : 0;
+        llmUsageNote.textContent = `AI turns: ${turnUsage.calls} · avg ${secs(turnUsage.avg_latency_ms)}`
+            + ` (first token ${secs(turnUsage.avg_first_token_ms)}, slowest ${secs(turnUsage.max_latency_ms)})`
+            + ` · ${perTurn} tokens/turn, ${cachedShare}% cached`
+            + ` · ${turnUsage.retries} retries · ${turnUsage.fallbacks} fallbacks`;
+        const hedgeUsage = data.llm_usage.hedge;
+        if (hedgeUsage && hedgeUsage.calls) {
+            llmUsageNote.textContent += ` · ${hedgeUsage.calls} hedged (${hedgeUsage.won} answered first)`;
+        }
+        llmUsageNote.hidden = false;
+    }
+
     const startCountdowns = () => {
         document.querySelectorAll("[data-remaining]").forEach(el => {
             let secs = parseInt(el.dataset.remaining, 10);
@@ -467,15 +486,48 @@ document.addEventListener("DOMContentLoaded", () => {
     const getAttempts = (student) => {
         if (!student) return [];
         if (Array.isArray(student.vivas) && student.vivas.length) return student.vivas;
-        if (student.viva) return [student.viva];
         return [];
     };
 
+    const loadAttempts = async (student) => {
+        if (!student || Array.isArray(student.vivas)) return;
+        if (!student.attempt_count) {
+            student.vivas = [];
+            return;
+        }
+        if (transcriptChat) {
+            transcriptChat.innerHTML = `<div class="bubble system">Loading transcript…</div>`;
+        }
+        try {
+            const res = await fetch(`/assignment/students/${encodeURIComponent(student.user_id)}/`, {
+                headers: { "Accept": "application/json" },
+                credentials: "same-origin",
+            });
+            if (!res.ok) {
+                const text = await res.text();
+                throw new Error(text || "Unable to load attempts");
+            }
+            const detail = await res.json();
+            student.vivas = detail.vivas || [];
+        } catch (err) {
+            console.warn("Failed to load attempts", err);
+        }
+    };
+
+    const openStudent = async (student) => {
+        if (!student) return;
+        activeStudent = student;
+        await loadAttempts(student);
+        if (activeStudent !== student) return;
+        const firstSession = populateAttemptSelect(student);
+        renderTranscript(student, firstSession);
+    };
+
     const populateSelect = () => {
         if (!transcriptSelect) return;
         transcriptSelect.innerHTML = `<option value="" disabled selected>Select a student</option>`;
         students
-            .filter(s => getAttempts(s).length)
+            .filter(s => s.attempt_count)
             .forEach(s => {
                 const opt = document.createElement("option");
                 opt.value = s.user_id;
@@ -560,13 +612,11 @@ document.addEventListener("DOMContentLoaded", () => {
                 const uid = link.dataset.viewTranscript;
                 const student = findStudent(uid);
                 if (!student) return;
-                activeStudent = student;
-                const firstSession = populateAttemptSelect(student);
-                renderTranscript(student, firstSession);
                 showPane("dashboard");
                 if (tablePane) tablePane.classList.remove("active");
                 if (transcriptPane) transcriptPane.classList.add("active");
                 scrollTranscriptTop();
+                openStudent(student);
             });
         });
     };
@@ -594,12 +644,10 @@ document.addEventListener("DOMContentLoaded", () => {
         transcriptSelect.addEventListener("change", (e) => {
             const student = findStudent(e.target.value);
             if (student) {
-                activeStudent = student;
-                const firstSession = populateAttemptSelect(student);
-                renderTranscript(student, firstSession);
                 if (tablePane) tablePane.classList.remove("active");
                 if (transcriptPane) transcriptPane.classList.add("active");
                 scrollTranscriptTop();
+                openStudent(student);
             }
         });
     }
@@ -1,3 +1,1777 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs
+
+import httpx
+import jwt
+import openai
+import requests
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.db import connection
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import now
+
+from .models import (
+    Assignment,
+    AssignmentResource,
+    InteractionLog,
+    LLMRateBucket,
+    Submission,
+    ToolConfig,
+    VivaFeedback,
+    VivaIntegrityFlags,
+    VivaLLMCall,
+    VivaMessage,
+    VivaSession,
+    VivaSessionResource,
+    VivaSessionSubmission,
+)
+from .views.dashboard import (
+    aggregate_integrity_counts,
+    build_dashboard_data,
+    build_student_attempts,
+    cached_dashboard_data,
+    get_dashboard_version,
+    recompute_integrity_flags,
+)
+from .jwks import JwksCache, JwksError
+from .llm import BREAKER_STATE_KEY, CircuitOpenError, llm_clients
+from .ratelimit import (
+    METRIC_LLM_QUEUE_TIMEOUTS,
+    METRIC_LLM_QUEUE_WAIT_MS,
+    METRIC_LLM_QUEUED,
+    RateLimitTimeout,
+    call_cost,
+    llm_rate_limiter,
+)
+from .retrieval import CHUNK_CHARS, build_index, select_chunks, text_hash
+from .tokens import count_message_tokens
+from .service_tokens import NRPS_SCOPE, ServiceTokenManager
+from .views import helpers
+from . import metrics
+from .views.viva import (
+    HEDGE_FIRST_TOKEN_THRESHOLD_KEY,
+    HEDGE_THRESHOLD_KEY,
+    METRIC_CACHE_HIT_TURNS,
+    METRIC_CACHE_MISS_TURNS,
+    METRIC_CACHED_PROMPT_TOKENS,
+    METRIC_MODEL_ANSWER_CALLS,
+    METRIC_PAYLOAD_REPAIRS,
+    METRIC_PROMPT_TOKENS,
+    METRIC_VIVA_TURNS,
+    QuestionStreamParser,
+    build_turn_messages,
+    refresh_viva_summary,
+    cached_submission_context,
+    compute_integrity_flags,
+    fill_model_answers,
+    build_question_bank,
+    generate_question_bank,
+    hedge_threshold_ms,
+    model_answers_lock_key,
+    pregenerate_opening_question,
+    record_integrity_message,
+    repair_viva_payload,
+    rerender_integrity_flags,
+)
+
+
+def seed_cohort(assignment, count, start=0):
+    """Create `count` students, each with a submission and a completed viva."""
+    started = now() - timedelta(minutes=30)
+    subs = Submission.objects.bulk_create([
+        Submission(assignment=assignment, user_id=f"student-{i}", comment=f"Essay {i}")
+        for i in range(start, start + count)
+    ])
+    sessions = VivaSession.objects.bulk_create([
+        VivaSession(
+            submission=sub,
+            ended_at=started + timedelta(minutes=10),
+            duration_seconds=60,
+        )
+        for sub in subs
+    ])
+    VivaSession.objects.filter(id__in=[s.id for s in sessions]).update(started_at=started)
+    resource = AssignmentResource.objects.filter(assignment=assignment).first()
+
+    links, resource_links, messages, logs, feedback = [], [], [], [], []
+    for sub, sess in zip(subs, sessions):
+        links.append(VivaSessionSubmission(session=sess, submission=sub))
+        if resource:
+            resource_links.append(VivaSessionResource(session=sess, resource=resource))
+        messages.append(VivaMessage(session=sess, sender="student", text="Hello"))
+        messages.append(VivaMessage(session=sess, sender="ai", text="Why?"))
+        for _ in range(3):
+            logs.append(InteractionLog(submission=sub, event_type="blur", event_data={"session_id": sess.id}))
+        logs.append(InteractionLog(
+            submission=sub,
+            event_type="paste",
+            event_data={"session_id": sess.id, "length": 40},
+        ))
+        feedback.append(VivaFeedback(session=sess, strengths="Clear argument"))
+
+    VivaSessionSubmission.objects.bulk_create(links)
+    VivaSessionResource.objects.bulk_create(resource_links)
+    VivaMessage.objects.bulk_create(messages)
+    InteractionLog.objects.bulk_create(logs)
+    VivaFeedback.objects.bulk_create(feedback)
+    return sessions
+
+
+class DashboardLoaderTests(TestCase):
+    def setUp(self):
+        self.assignment = Assignment.objects.create(slug="dash", title="Dashboard viva")
+        AssignmentResource.objects.create(assignment=self.assignment, comment="Brief")
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            build_dashboard_data(self.assignment, [])
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant_across_cohort_sizes(self):
+        counts = []
+        seeded = 0
+        for size in (10, 100, 1000):
+            seed_cohort(self.assignment, size - seeded, start=seeded)
+            seeded = size
+            build_dashboard_data(self.assignment, [])  # materialises missing flags
+            counts.append(self.count_queries())
+        self.assertEqual(len(set(counts)), 1, counts)
+        self.assertLessEqual(counts[0], 2)
+
+    def test_summary_rows_match_per_session_flags(self):
+        sessions = seed_cohort(self.assignment, 3)
+        data = build_dashboard_data(self.assignment, [])
+
+        self.assertEqual(data["stats"]["total"], 3)
+        self.assertEqual(data["stats"]["completed"], 3)
+        by_user = {s["user_id"]: s for s in data["students"]}
+        for sess in sessions:
+            sess.refresh_from_db()
+            student = by_user[sess.submission.user_id]
+            self.assertEqual(student["flags"], compute_integrity_flags(sess))
+            self.assertEqual(student["attempt_count"], 1)
+            self.assertNotIn("vivas", student)
+
+    def test_student_attempts_carry_transcript_and_events(self):
+        sess = seed_cohort(self.assignment, 2)[0]
+        attempts = build_student_attempts(self.assignment, sess.submission.user_id, [])
+
+        self.assertEqual(len(attempts), 1)
+        attempt = attempts[0]
+        self.assertEqual(attempt["session_id"], sess.id)
+        self.assertEqual(len(attempt["messages"]), 2)
+        self.assertEqual(len(attempt["events"]), 4)
+        self.assertEqual(attempt["feedback"]["strengths"], "Clear argument")
+        self.assertEqual(len(attempt["files"]), 2)
+
+    def test_student_detail_endpoint_requires_instructor(self):
+        sess = seed_cohort(self.assignment, 1)[0]
+        client = Client()
+        session = client.session
+        session["lti_resource_link_id"] = self.assignment.slug
+        session["lti_roles"] = ["Learner"]
+        session.save()
+        url = f"/assignment/students/{sess.submission.user_id}/"
+        self.assertEqual(client.get(url).status_code, 403)
+
+        session["lti_roles"] = ["Instructor"]
+        session.save()
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["vivas"][0]["session_id"], sess.id)
+
+
+class IntegrityFlagRecordTests(TestCase):
+    def setUp(self):
+        self.assignment = Assignment.objects.create(slug="flags", title="Flags viva")
+        self.sub = Submission.objects.create(assignment=self.assignment, user_id="learner")
+        self.session = VivaSession.objects.create(submission=self.sub)
+        self.client = Client()
+
+    def post(self, url, payload):
+        import json
+        return self.client.post(url, json.dumps(payload), content_type="application/json")
+
+    def test_log_ingestion_updates_counts_incrementally(self):
+        for _ in range(2):
+            self.post("/viva/log/", {
+                "session_id": self.session.id,
+                "events": [
+                    {"event_type": "blur", "event_data": {}},
+                    {"event_type": "paste", "event_data": {"length": 50}},
+                    {"event_type": "copy", "event_data": {"source": "ai"}},
+                ],
+            })
+        record = VivaIntegrityFlags.objects.get(session=self.session)
+        self.assertEqual(record.blur_count, 2)
+        self.assertEqual(record.paste_count, 2)
+        self.assertEqual(record.large_paste_count, 2)
+        self.assertEqual(record.ai_copy_count, 2)
+        self.assertFalse(record.finalized)
+        self.assertEqual(record.flags, compute_integrity_flags(self.session))
+
+    def test_session_end_finalises_record(self):
+        VivaMessage.objects.create(session=self.session, sender="student", text="Hi")
+        VivaMessage.objects.filter(session=self.session).update(timestamp=now() - timedelta(minutes=5))
+        self.post("/viva/send/", {"session_id": self.session.id, "sender": "ai", "text": "Question?"})
+        record = VivaIntegrityFlags.objects.get(session=self.session)
+        self.assertEqual(record.long_gap_count, 1)
+
+        with mock.patch("tool.views.viva._fill_model_answers_in_background"):
+            self.post("/viva/send/", {"session_id": self.session.id, "ended": True, "duration_seconds": 30})
+        record.refresh_from_db()
+        self.session.refresh_from_db()
+        self.assertTrue(record.finalized)
+        self.assertEqual(record.flags, compute_integrity_flags(self.session))
+        self.assertIn("Viva ended unusually early (<25% of time).", record.flags)
+
+    def test_backfill_command_populates_missing_records(self):
+        sessions = seed_cohort(self.assignment, 5, start=10)
+        call_command("backfill_integrity_flags", slug=self.assignment.slug, stdout=StringIO())
+        self.assertEqual(VivaIntegrityFlags.objects.count(), 6)
+        for sess in sessions:
+            sess.refresh_from_db()
+            self.assertEqual(sess.integrity.flags, compute_integrity_flags(sess))
+
+
+class AggregateIntegrityEngineTests(TestCase):
+    def setUp(self):
+        self.assignment = Assignment.objects.create(slug="bulk", title="Bulk viva")
+
+    def seed_edge_cases(self):
+        sessions = seed_cohort(self.assignment, 4)
+        first, second, third, _ = sessions
+        # Long gap between messages and an AI copy
+        VivaMessage.objects.filter(session=first, sender="ai").update(timestamp=now() + timedelta(minutes=5))
+        InteractionLog.objects.create(
+            submission=first.submission,
+            event_type="copy",
+            event_data={"session_id": first.id, "source": "ai"},
+        )
+        # Paste measured by its text rather than a length field
+        InteractionLog.objects.create(
+            submission=second.submission,
+            event_type="paste",
+            event_data={"session_id": second.id, "text": "x" * 30},
+        )
+        InteractionLog.objects.bulk_create([
+            InteractionLog(submission=second.submission, event_type="arrhythmic_typing", event_data={"session_id": second.id})
+            for _ in range(8)
+        ])
+        # Legacy logs without a session id fall back to the time window
+        third.refresh_from_db()
+        InteractionLog.objects.filter(submission=third.submission).update(
+            event_data={},
+            timestamp=third.started_at + timedelta(minutes=1),
+        )
+        return sessions
+
+    def test_matches_per_session_computation(self):
+        sessions = self.seed_edge_cases()
+        _, counts = aggregate_integrity_counts(
+            VivaSession.objects.filter(submission__assignment=self.assignment)
+        )
+        recompute_integrity_flags(self.assignment)
+        for sess in sessions:
+            sess.refresh_from_db()
+            expected = compute_integrity_flags(sess)
+            self.assertEqual(sess.integrity.flags, expected)
+            self.assertEqual(counts[sess.id]["blur_count"], 3)
+        self.assertEqual(counts[sessions[0].id]["long_gap_count"], 1)
+        self.assertEqual(counts[sessions[1].id]["large_paste_count"], 2)
+
+    def test_query_count_does_not_grow_with_sessions(self):
+        seed_cohort(self.assignment, 10)
+        sessions_qs = VivaSession.objects.filter(submission__assignment=self.assignment)
+        with CaptureQueriesContext(connection) as small:
+            aggregate_integrity_counts(sessions_qs)
+        seed_cohort(self.assignment, 200, start=10)
+        with CaptureQueriesContext(connection) as large:
+            aggregate_integrity_counts(sessions_qs)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertLessEqual(len(large.captured_queries), 3)
+
+
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(slug="cached", title="Cached viva")
+        self.sessions = seed_cohort(self.assignment, 5)
+
+    def test_unchanged_reload_skips_the_loader(self):
+        first = cached_dashboard_data(self.assignment, [])
+        with CaptureQueriesContext(connection) as ctx:
+            second = cached_dashboard_data(self.assignment, [])
+        self.assertEqual(first["students"], second["students"])
+        # Only the version and payload lookups in the cache table
+        self.assertLessEqual(len(ctx.captured_queries), 2)
+
+    def test_writes_invalidate_the_cached_payload(self):
+        cached_dashboard_data(self.assignment, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Submission.objects.create(assignment=self.assignment, user_id="late-student")
+        data = cached_dashboard_data(self.assignment, [])
+        self.assertIn("late-student", [s["user_id"] for s in data["students"]])
+
+    def test_version_is_bumped_only_when_the_write_commits(self):
+        before = get_dashboard_version(self.assignment.id)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Submission.objects.create(assignment=self.assignment, user_id="late-student")
+            self.assertEqual(get_dashboard_version(self.assignment.id), before)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_dashboard_version(self.assignment.id), before + 1)
+
+    def test_each_dashboard_model_bumps_the_version(self):
+        sess = self.sessions[0]
+        writes = [
+            lambda: VivaMessage.objects.create(session=sess, sender="student", text="Another answer"),
+            lambda: InteractionLog.objects.create(submission=sess.submission, event_type="blur"),
+            lambda: VivaFeedback.objects.filter(session=sess).first().save(),
+            lambda: AssignmentResource.objects.create(assignment=self.assignment, comment="Notes"),
+            lambda: sess.save(),
+            lambda: sess.submission.save(),
+        ]
+        for write in writes:
+            before = get_dashboard_version(self.assignment.id)
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+            self.assertNotEqual(get_dashboard_version(self.assignment.id), before)
+
+    def test_integrity_record_writes_ride_on_the_write_that_caused_them(self):
+        sess = self.sessions[0]
+        before = get_dashboard_version(self.assignment.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            msg = VivaMessage.objects.create(session=sess, sender="student", text="Another answer")
+            record_integrity_message(sess, msg)
+        self.assertEqual(get_dashboard_version(self.assignment.id), before + 1)
+
+        # bulk_update sends no signals, so the re-render bumps explicitly
+        with self.captureOnCommitCallbacks(execute=True):
+            rerender_integrity_flags(self.assignment)
+        self.assertEqual(get_dashboard_version(self.assignment.id), before + 2)
+
+    def test_llm_telemetry_does_not_bump_the_version(self):
+        sess = self.sessions[0]
+        before = get_dashboard_version(self.assignment.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            VivaLLMCall.objects.create(session=sess, model="m", latency_ms=900)
+        self.assertEqual(get_dashboard_version(self.assignment.id), before)
+
+
+class FakeResponse:
+    def __init__(self, payload, links=None, status_code=200):
+        self.payload = payload
+        self.links = links or {}
+        self.status_code = status_code
+        self.text = ""
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        pass
+
+
+class NrpsRosterCacheTests(TestCase):
+    url = "https://canvas.test/api/lti/courses/1/names_and_roles"
+
+    def setUp(self):
+        cache.clear()
+        ToolConfig.objects.create(
+            platform="Canvas",
+            issuer="https://canvas.test",
+            jwks_url="https://canvas.test/jwks",
+            authorize_url="https://canvas.test/authorize",
+            redirect_uri="https://tool.test/launch/",
+            token_url="https://canvas.test/token",
+            client_id="client",
+            deployment_id="deploy",
+        )
+        patcher = mock.patch("tool.views.helpers.service_tokens.get_token", return_value="token")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pages(self):
+        return {
+            self.url: FakeResponse(
+                {"members": [{"user_id": "a", "roles": ["Learner"]}]},
+                links={"next": {"url": self.url + "?page=2"}},
+            ),
+            self.url + "?page=2": FakeResponse(
+                {"members": [{"user_id": "b", "roles": ["Learner"]}]},
+                links={"differences": {"url": self.url + "?since=1"}},
+            ),
+            self.url + "?since=1": FakeResponse(
+                {"members": [
+                    {"user_id": "a", "status": "Deleted"},
+                    {"user_id": "c", "roles": ["Learner"]},
+                ]},
+                links={"differences": {"url": self.url + "?since=2"}},
+            ),
+        }
+
+    def test_cold_fetch_follows_every_page(self):
+        pages = self.pages()
+        with mock.patch("tool.views.helpers.requests.get", side_effect=lambda url, **kw: pages[url]) as get:
+            members = helpers.fetch_nrps_roster(self.url)
+            self.assertEqual([m["user_id"] for m in members], ["a", "b"])
+            self.assertEqual(get.call_count, 2)
+
+            # Warm and fresh: no platform calls at all
+            self.assertEqual(helpers.fetch_nrps_roster(self.url), members)
+            self.assertEqual(get.call_count, 2)
+
+    def test_stale_entry_is_served_while_differences_refresh(self):
+        pages = self.pages()
+        with mock.patch("tool.views.helpers.requests.get", side_effect=lambda url, **kw: pages[url]):
+            helpers.refresh_nrps_roster(self.url)
+            key = helpers._roster_cache_key(self.url)
+            entry = cache.get(key)
+            entry["fetched_at"] -= 10_000
+            cache.set(key, entry)
+
+            with mock.patch("tool.views.helpers._refresh_nrps_roster_in_background") as refresh:
+                members = helpers.fetch_nrps_roster(self.url)
+            self.assertEqual([m["user_id"] for m in members], ["a", "b"])
+            refresh.assert_called_once_with(self.url)
+
+            entry = helpers.refresh_nrps_roster(self.url)
+        self.assertEqual(sorted(m["user_id"] for m in entry["members"]), ["b", "c"])
+        self.assertEqual(entry["differences_url"], self.url + "?since=2")
+
+
+class StubTokenEndpoint:
+    """Local client-credentials endpoint that counts the token requests it serves."""
+
+    def __init__(self, expires_in=3600, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.requests = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                form = {k: v[0] for k, v in parse_qs(body).items()}
+                endpoint.requests.append(form)
+                if endpoint.delay:
+                    time.sleep(endpoint.delay)
+                payload = json.dumps({
+                    "access_token": f"token-{len(endpoint.requests)}",
+                    "token_type": "Bearer",
+                    "expires_in": endpoint.expires_in,
+                    "scope": form.get("scope"),
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/token"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ServiceTokenManagerTests(SimpleTestCase):
+    AGS_SCOPE = "https://purl.imsglobal.org/spec/lti-ags/scope/score"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.public_key = key.public_key()
+        cls.key_file = tempfile.NamedTemporaryFile(suffix=".pem")
+        cls.key_file.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+        cls.key_file.flush()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.key_file.close()
+        super().tearDownClass()
+
+    def start(self, **kwargs):
+        endpoint = StubTokenEndpoint(**kwargs)
+        self.addCleanup(endpoint.close)
+        platform = SimpleNamespace(token_url=endpoint.url, client_id="client")
+        return endpoint, platform, ServiceTokenManager(private_key_path=self.key_file.name, timeout=5)
+
+    def test_token_is_reused_per_scope_set(self):
+        endpoint, platform, tokens = self.start()
+
+        first = tokens.get_token(platform, [NRPS_SCOPE])
+        self.assertEqual(tokens.get_token(platform, [NRPS_SCOPE]), first)
+        self.assertEqual(len(endpoint.requests), 1)
+
+        tokens.get_token(platform, [self.AGS_SCOPE, NRPS_SCOPE])
+        tokens.get_token(platform, [NRPS_SCOPE, self.AGS_SCOPE])
+        self.assertEqual(len(endpoint.requests), 2)
+
+        assertion = jwt.decode(
+            endpoint.requests[0]["client_assertion"],
+            self.public_key,
+            algorithms=["RS256"],
+            audience=endpoint.url,
+        )
+        self.assertEqual(assertion["iss"], "client")
+        self.assertEqual(endpoint.requests[0]["scope"], NRPS_SCOPE)
+
+    def test_token_is_refreshed_inside_the_expiry_margin(self):
+        endpoint, platform, tokens = self.start(expires_in=30)
+
+        self.assertEqual(tokens.get_token(platform, [NRPS_SCOPE]), "token-1")
+        self.assertEqual(tokens.get_token(platform, [NRPS_SCOPE]), "token-2")
+
+        tokens.invalidate(platform)
+        self.assertEqual(tokens.get_token(platform, [NRPS_SCOPE]), "token-3")
+
+    def test_concurrent_callers_share_one_request(self):
+        endpoint, platform, tokens = self.start(delay=0.2)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(tokens.get_token(platform, [NRPS_SCOPE])))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ["token-1"] * 8)
+        self.assertEqual(len(endpoint.requests), 1)
+
+
+def rsa_jwk(kid):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    public.update({"kid": kid, "alg": "RS256", "use": "sig"})
+    return key, public
+
+
+class JwksCacheTests(TestCase):
+    url = "https://canvas.test/api/lti/security/jwks"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.old_key, cls.old_jwk = rsa_jwk("old")
+        cls.new_key, cls.new_jwk = rsa_jwk("new")
+
+    def setUp(self):
+        cache.clear()
+        self.published = [self.old_jwk]
+        patcher = mock.patch(
+            "tool.jwks.requests.get",
+            side_effect=lambda url, **kw: FakeResponse({"keys": list(self.published)}),
+        )
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def token(self, key, kid):
+        return jwt.encode({"sub": "student"}, key, algorithm="RS256", headers={"kid": kid})
+
+    def verify(self, jwks, key, kid):
+        token = self.token(key, kid)
+        return jwt.decode(token, jwks.get_signing_key(self.url, token), algorithms=["RS256"])
+
+    def test_keys_are_fetched_once_for_many_launches(self):
+        jwks = JwksCache(ttl=3600, refresh_interval=60)
+        for _ in range(50):
+            self.assertEqual(self.verify(jwks, self.old_key, "old")["sub"], "student")
+        self.assertEqual(self.get.call_count, 1)
+
+        # A new worker picks the persisted key set up without a fetch
+        self.assertEqual(self.verify(JwksCache(), self.old_key, "old")["sub"], "student")
+        self.assertEqual(self.get.call_count, 1)
+
+    def test_unknown_kid_refetches_at_most_once_per_interval(self):
+        jwks = JwksCache(ttl=3600, refresh_interval=60)
+        self.verify(jwks, self.old_key, "old")
+
+        for _ in range(5):
+            with self.assertRaises(JwksError):
+                self.verify(jwks, self.new_key, "new")
+        self.assertEqual(self.get.call_count, 1)
+
+        # Once the interval has passed, a rotated key is picked up
+        jwks.refresh_interval = 0
+        self.published = [self.old_jwk, self.new_jwk]
+        self.assertEqual(self.verify(jwks, self.new_key, "new")["sub"], "student")
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_last_known_keys_survive_a_platform_outage(self):
+        jwks = JwksCache(ttl=0, refresh_interval=0, persist=False)
+        self.verify(jwks, self.old_key, "old")
+
+        self.get.side_effect = requests.ConnectionError("platform down")
+        self.assertEqual(self.verify(jwks, self.old_key, "old")["sub"], "student")
+
+
+def stream_chunks(*pieces):
+    """Chat completion chunks as yielded by the OpenAI client with stream=True."""
+    return (
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+        for piece in pieces
+    )
+
+
+class AsyncChunkStream:
+    """
+    Stand-in for the AsyncStream returned by the async client with
+    stream=True. With `hold` (a threading.Event) the last chunk is only sent
+    once it is set, or after two seconds.
+    """
+
+    def __init__(self, chunks, hold=None, delay=0):
+        self.chunks = list(chunks)
+        self.hold = hold
+        self.delay = delay
+        self.finished = False
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        for i, chunk in enumerate(self.chunks):
+            if self.hold is not None and i == len(self.chunks) - 1:
+                await asyncio.to_thread(self.hold.wait, 2)
+            yield chunk
+        self.finished = True
+
+    async def close(self):
+        self.closed = True
+
+
+async def read_sse(response):
+    events = []
+    body = b"".join([part async for part in response.streaming_content]).decode()
+    for frame in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+async def asgi_post(path, payload, on_body):
+    """
+    POST through Django's ASGIHandler, the way an ASGI server would, calling
+    on_body(bytes) for each body message as the handler sends it.
+    """
+    body = json.dumps(payload).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # The client never disconnects; the handler cancels this wait
+        await asyncio.Future()
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            on_body(message["body"])
+
+    # As the test client does, keep request signals from closing the test connection
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        await ASGIHandler()(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+
+class VivaStreamingTests(TestCase):
+    def setUp(self):
+        assignment = Assignment.objects.create(slug="stream", title="Streaming")
+        sub = Submission.objects.create(assignment=assignment, user_id="s1", comment="My essay")
+        self.session = VivaSession.objects.create(submission=sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=sub)
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.AsyncOpenAI")
+        client = patcher.start().return_value
+        self.create = client.chat.completions.create = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+
+    async def post(self, url, **payload):
+        payload.setdefault("session_id", self.session.id)
+        return await AsyncClient().post(url, json.dumps(payload), content_type="application/json")
+
+    def test_parser_emits_question_text_across_chunk_boundaries(self):
+        parser = QuestionStreamParser()
+        pieces = ['```json\n{"quest', 'ion": "Why \\"th', 'is\\"?\\', 'nNext', '", "model_answer": "Because."}']
+        text = "".join(parser.feed(p) for p in pieces)
+        self.assertEqual(text, 'Why "this"?\nNext')
+        self.assertEqual(parser.raw, "".join(pieces))
+
+    async def test_stream_forwards_deltas_then_saves_the_reply(self):
+        stream = AsyncChunkStream(stream_chunks(
+            '{"question": "How did', " you choose", ' your method?", ',
+            '"model_answer": "By comparing options."}',
+        ))
+        self.create.return_value = stream
+        response = await self.post("/viva/send/stream/", text="I used surveys.")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        events = await read_sse(response)
+        self.assertEqual(events[0][0], "start")
+        deltas = "".join(data["text"] for event, data in events if event == "delta")
+        self.assertEqual(deltas, "How did you choose your method?")
+
+        event, done = events[-1]
+        self.assertEqual(event, "done")
+        self.assertEqual(done["ai_text"], "How did you choose your method?")
+        ai_msg = await VivaMessage.objects.aget(id=done["ai_message_id"])
+        self.assertEqual(ai_msg.model_answer, "By comparing options.")
+        self.assertTrue(self.create.call_args.kwargs["stream"])
+        self.assertTrue(stream.closed)
+
+    async def test_stream_records_call_telemetry(self):
+        usage = SimpleNamespace(
+            prompt_tokens=900, completion_tokens=20, prompt_tokens_details=SimpleNamespace(cached_tokens=512)
+        )
+        chunks = list(stream_chunks('{"question": "Why', ' that?"}'))
+        chunks.append(SimpleNamespace(choices=[], usage=usage))
+        self.create.return_value = AsyncChunkStream(chunks)
+        done = (await read_sse(await self.post("/viva/send/stream/", text="Because.")))[-1][1]
+
+        call = await VivaLLMCall.objects.aget(session=self.session)
+        self.assertEqual(call.message_id, done["ai_message_id"])
+        self.assertEqual((call.purpose, call.retries, call.fallback), ("turn", 0, False))
+        self.assertEqual((call.prompt_tokens, call.completion_tokens, call.cached_tokens), (900, 20, 512))
+        self.assertIsNotNone(call.first_token_ms)
+        self.assertGreaterEqual(call.latency_ms, call.first_token_ms)
+
+    async def test_stream_error_saves_fallback_reply(self):
+        self.create.side_effect = RuntimeError("upstream down")
+        events = await read_sse(await self.post("/viva/send/stream/", text="Hello"))
+
+        event, done = events[-1]
+        self.assertEqual((event, done["status"]), ("done", "error"))
+        self.assertEqual((await VivaMessage.objects.aget(id=done["ai_message_id"])).sender, "ai")
+
+    async def test_requests_without_a_reply_get_json(self):
+        response = await self.post("/viva/send/stream/", rating=4)
+        self.assertEqual(response.json()["status"], "ok")
+
+    async def test_deltas_reach_an_asgi_client_before_the_reply_is_complete(self):
+        release = threading.Event()
+        stream = AsyncChunkStream(stream_chunks('{"question": "Why', ' that?"}'), hold=release)
+        self.create.return_value = stream
+        sent = []
+
+        def on_body(body):
+            # Whether the model had finished when this part went out
+            sent.append((body.decode(), stream.finished))
+            if "event: delta" in body.decode():
+                release.set()
+
+        await asgi_post("/viva/send/stream/", {"session_id": self.session.id, "text": "Because."}, on_body)
+
+        deltas = [finished for body, finished in sent if body.startswith("event: delta")]
+        self.assertEqual(len(deltas), 2)
+        self.assertFalse(deltas[0])
+        self.assertTrue(sent[-1][0].startswith("event: done"))
+        self.assertTrue(stream.closed)
+
+    @override_settings(VIVA_HEDGE_MODEL="backup-model", VIVA_HEDGE_AFTER_MS=50, VIVA_HEDGE_MIN_MS=0)
+    async def test_slow_first_token_is_hedged_and_the_first_stream_wins(self):
+        streams = {}
+
+        async def open_stream(model, **kwargs):
+            streams[model] = AsyncChunkStream(
+                stream_chunks('{"question": "From ', f'{model}?"}}'),
+                delay=0 if model == "backup-model" else 2,
+            )
+            return streams[model]
+
+        self.create.side_effect = open_stream
+        started = time.monotonic()
+        events = await read_sse(await self.post("/viva/send/stream/", text="Because."))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+        deltas = "".join(data["text"] for event, data in events if event == "delta")
+        self.assertEqual(deltas, "From backup-model?")
+        done = events[-1][1]
+        self.assertEqual(done["ai_text"], "From backup-model?")
+        self.assertTrue(streams["gpt-4.1-mini"].closed)
+        self.assertTrue(streams["backup-model"].closed)
+
+        calls = {c.purpose: c async for c in VivaLLMCall.objects.filter(session=self.session)}
+        self.assertEqual(set(calls), {"turn", "hedge"})
+        self.assertEqual((calls["turn"].won, calls["hedge"].won), (False, True))
+        self.assertEqual((calls["turn"].error, calls["hedge"].error), ("cancelled", ""))
+        self.assertIsNotNone(calls["hedge"].first_token_ms)
+        self.assertEqual(calls["hedge"].message_id, done["ai_message_id"])
+
+    @override_settings(VIVA_HEDGE_MODEL="backup-model", VIVA_HEDGE_AFTER_MS=5000)
+    async def test_stream_with_a_prompt_first_token_is_not_hedged(self):
+        self.create.return_value = AsyncChunkStream(stream_chunks('{"question": "Why?"}'))
+        await read_sse(await self.post("/viva/send/stream/", text="Because."))
+        self.create.assert_called_once()
+        calls = [c async for c in VivaLLMCall.objects.values_list("purpose", "won")]
+        self.assertEqual(calls, [("turn", True)])
+
+    @override_settings(VIVA_HEDGE_PERCENTILE=90, VIVA_HEDGE_MIN_MS=0)
+    def test_stream_hedge_threshold_tracks_time_to_first_token(self):
+        VivaLLMCall.objects.bulk_create([
+            VivaLLMCall(session=self.session, model="m", first_token_ms=ms, latency_ms=5000)
+            for ms in range(100, 2100, 100)
+        ])
+        cache.delete(HEDGE_FIRST_TOKEN_THRESHOLD_KEY)
+        self.assertEqual(hedge_threshold_ms(first_token=True), 1800)
+
+
+class StructuredVivaTurnTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        assignment = Assignment.objects.create(slug="structured", title="Structured")
+        sub = Submission.objects.create(assignment=assignment, user_id="s1", comment="My essay")
+        self.session = VivaSession.objects.create(submission=sub)
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.AsyncOpenAI")
+        client = patcher.start().return_value
+        self.create = client.chat.completions.create = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+
+    def reply(self, content):
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+        return Client().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "text": "My answer"}),
+            content_type="application/json",
+        ).json()
+
+    def test_one_schema_constrained_call_per_turn(self):
+        data = self.reply('{"question": "Why?"}')
+        self.assertEqual((data["ai_text"], data["ai_model_answer"]), ("Why?", ""))
+
+        self.create.assert_called_once()
+        response_format = self.create.call_args.kwargs["response_format"]
+        self.assertEqual(response_format["type"], "json_schema")
+        self.assertEqual(response_format["json_schema"]["schema"]["required"], ["question"])
+        self.assertEqual(metrics.get(METRIC_VIVA_TURNS), 1)
+        self.assertEqual(metrics.get(METRIC_MODEL_ANSWER_CALLS), 0)
+
+    def test_malformed_payload_is_repaired_locally(self):
+        data = self.reply("What limits your method?")
+        self.assertEqual(data["ai_text"], "What limits your method?")
+
+        data = self.reply("")
+        self.assertEqual(data["ai_text"], "Thanks. Could you clarify that point a little more?")
+
+        self.assertEqual(self.create.call_count, 2)
+        self.assertEqual(metrics.get(METRIC_MODEL_ANSWER_CALLS), 0)
+        self.assertEqual(metrics.get(METRIC_PAYLOAD_REPAIRS), 1)
+
+    async def test_turn_runs_on_the_asgi_handler(self):
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"question": "Why?"}'))]
+        )
+        response = await AsyncClient().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "text": "My answer"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["ai_text"], "Why?")
+        self.assertEqual(await VivaMessage.objects.filter(session=self.session).acount(), 2)
+
+    def test_prompt_prefix_is_shared_across_the_cohort(self):
+        assignment = self.session.submission.assignment
+        AssignmentResource.objects.create(assignment=assignment, comment="Shared rubric")
+        other_sub = Submission.objects.create(assignment=assignment, user_id="s2", comment="Other essay")
+        other = VivaSession.objects.create(submission=other_sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=self.session.submission)
+        VivaSessionSubmission.objects.create(session=other, submission=other_sub)
+
+        mine, theirs = build_turn_messages(self.session), build_turn_messages(other)
+        self.assertEqual(mine[:2], theirs[:2])
+        self.assertIn("Shared rubric", mine[1]["content"])
+        self.assertIn("My essay", mine[2]["content"])
+        self.assertIn("Other essay", theirs[2]["content"])
+
+    def test_cached_prompt_tokens_are_recorded(self):
+        usage = SimpleNamespace(prompt_tokens=1800, prompt_tokens_details=SimpleNamespace(cached_tokens=1536))
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"question": "Why?"}'))],
+            usage=usage,
+        )
+        Client().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "text": "My answer"}),
+            content_type="application/json",
+        )
+        self.reply('{"question": "And then?"}')
+
+        self.assertEqual(metrics.get(METRIC_PROMPT_TOKENS), 1800)
+        self.assertEqual(metrics.get(METRIC_CACHED_PROMPT_TOKENS), 1536)
+        self.assertEqual(metrics.get(METRIC_CACHE_HIT_TURNS), 1)
+        self.assertEqual(metrics.get(METRIC_CACHE_MISS_TURNS), 0)
+
+    def test_turn_metrics_are_written_in_one_batch(self):
+        usage = SimpleNamespace(prompt_tokens=1800, prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"question": "Why?"}'))],
+            usage=usage,
+        )
+        with mock.patch("tool.views.viva.metrics.incr_many", wraps=metrics.incr_many) as incr_many:
+            for _ in range(2):
+                Client().post(
+                    "/viva/send/",
+                    json.dumps({"session_id": self.session.id, "text": "My answer"}),
+                    content_type="application/json",
+                )
+
+        self.assertEqual(incr_many.call_count, 2)
+        self.assertEqual(metrics.get(METRIC_VIVA_TURNS), 2)
+        self.assertEqual(metrics.get(METRIC_PROMPT_TOKENS), 3600)
+        self.assertEqual(metrics.get(METRIC_CACHE_MISS_TURNS), 2)
+
+    def test_failed_turns_are_recorded_and_aggregated(self):
+        self.reply('{"question": "Why?"}')
+        self.create.side_effect = RuntimeError("upstream down")
+        data = self.reply("")
+        self.assertEqual(data["status"], "error")
+
+        calls = VivaLLMCall.objects.filter(session=self.session).order_by("id")
+        self.assertEqual([c.fallback for c in calls], [False, True])
+        self.assertEqual(calls[1].error, "upstream down")
+        self.assertEqual(calls[1].message.text, data["ai_text"])
+
+        usage = cached_dashboard_data(self.session.submission.assignment, [])["llm_usage"]
+        self.assertEqual((usage["turn"]["calls"], usage["turn"]["fallbacks"], usage["turn"]["errors"]), (2, 1, 1))
+
+    @override_settings(LLM_BREAKER_FAILURES=1, LLM_RETRY_BASE_DELAY=0)
+    def test_open_breaker_fails_fast_with_503(self):
+        self.create.side_effect = outage_error()
+        self.reply("")
+        calls = self.create.call_count
+
+        response = Client().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "text": "My answer"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["ai_text"], "Thanks. Could you clarify that point a little more?")
+        self.assertEqual(response["Retry-After"], str(response.json()["retry_in"]))
+        self.assertEqual(self.create.call_count, calls)
+
+    @override_settings(VIVA_HEDGE_MODEL="backup-model", VIVA_HEDGE_AFTER_MS=50, VIVA_HEDGE_MIN_MS=0)
+    def test_slow_turn_is_hedged_and_first_answer_wins(self):
+        async def answer(model, **kwargs):
+            if model != "backup-model":
+                await asyncio.sleep(2)
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=f'{{"question": "From {model}?"}}'))]
+            )
+
+        self.create.side_effect = answer
+        started = time.monotonic()
+        data = self.reply("")
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(data["ai_text"], "From backup-model?")
+
+        calls = {c.purpose: c for c in VivaLLMCall.objects.filter(session=self.session)}
+        self.assertEqual(set(calls), {"turn", "hedge"})
+        self.assertEqual((calls["turn"].won, calls["hedge"].won), (False, True))
+        self.assertEqual(calls["hedge"].model, "backup-model")
+        self.assertEqual(calls["turn"].error, "cancelled")
+        self.assertEqual(calls["turn"].message_id, data["ai_message_id"])
+
+        # The cancelled primary's truncated latency is no sample for the threshold
+        VivaLLMCall.objects.bulk_create([
+            VivaLLMCall(session=self.session, model="m", latency_ms=1000) for _ in range(20)
+        ])
+        cache.delete(HEDGE_THRESHOLD_KEY)
+        VivaLLMCall.objects.filter(purpose="turn", error="cancelled").update(latency_ms=50)
+        self.assertEqual(hedge_threshold_ms(), 1000)
+        usage = cached_dashboard_data(self.session.submission.assignment, [])["llm_usage"]
+        self.assertEqual(usage["turn"]["errors"], 0)
+
+    @override_settings(VIVA_HEDGE_MODEL="backup-model", VIVA_HEDGE_AFTER_MS=100, VIVA_HEDGE_MIN_MS=0, LLM_TURN_DEADLINE=0.5)
+    def test_hedge_only_gets_what_is_left_of_the_turn_deadline(self):
+        async def answer(model, **kwargs):
+            if model == "backup-model":
+                await asyncio.sleep(5)
+            await asyncio.sleep(0.2)
+            raise RuntimeError("primary failed")
+
+        self.create.side_effect = answer
+        started = time.monotonic()
+        data = self.reply("")
+        # Primary failed at 0.2s; waiting on the hedge stops at the 0.5s turn deadline
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(data["status"], "error")
+
+    @override_settings(VIVA_HEDGE_MODEL="backup-model", VIVA_HEDGE_AFTER_MS=5000)
+    def test_fast_turn_is_not_hedged(self):
+        self.assertEqual(self.reply('{"question": "Why?"}')["ai_text"], "Why?")
+        self.create.assert_called_once()
+        self.assertEqual(list(VivaLLMCall.objects.values_list("purpose", "won")), [("turn", True)])
+
+    @override_settings(VIVA_HEDGE_PERCENTILE=90, VIVA_HEDGE_MIN_MS=0)
+    def test_hedge_threshold_tracks_recent_turn_latency(self):
+        VivaLLMCall.objects.bulk_create([
+            VivaLLMCall(session=self.session, model="m", latency_ms=ms) for ms in range(100, 2100, 100)
+        ])
+        self.assertEqual(hedge_threshold_ms(), 1800)
+
+    def test_truncated_payload_keeps_the_question(self):
+        question, model_answer, repaired = repair_viva_payload(
+            '{"question": "How did you \\"validate\\" it?", "model_answer": "By cross-che'
+        )
+        self.assertEqual(question, 'How did you "validate" it?')
+        self.assertEqual(model_answer, "By cross-che")
+        self.assertTrue(repaired)
+
+
+class SubmissionContextCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(
+            slug="context", title="Context", allow_student_resource_toggle=True
+        )
+        self.sub = Submission.objects.create(assignment=self.assignment, user_id="s1", comment="My essay")
+        self.resource = AssignmentResource.objects.create(assignment=self.assignment, comment="Rubric text")
+        self.session = VivaSession.objects.create(submission=self.sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=self.sub)
+        VivaSessionResource.objects.create(session=self.session, resource=self.resource)
+
+    def context(self):
+        session = VivaSession.objects.select_related("submission").get(id=self.session.id)
+        return cached_submission_context(session)
+
+    def test_repeat_turns_reuse_the_assembled_context(self):
+        first = self.context()
+        self.assertIn("Rubric text", first)
+        self.assertIn("My essay", first)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(cached_submission_context(self.session), first)
+        tables = " ".join(q["sql"] for q in ctx.captured_queries)
+        self.assertNotIn("tool_vivasessionresource", tables)
+        self.assertNotIn("tool_vivasessionsubmission", tables)
+
+    def test_toggling_a_resource_invalidates(self):
+        self.assertIn("Rubric text", self.context())
+        response = Client().post(
+            "/viva/toggle_resource/",
+            json.dumps({"session_id": self.session.id, "resource_id": self.resource.id, "included": False}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Rubric text", self.context())
+
+    def test_editing_resource_or_submission_text_invalidates(self):
+        self.context()
+        self.resource.comment = "Updated rubric"
+        self.resource.save()
+        self.sub.comment = "Revised essay"
+        self.sub.save()
+        context = self.context()
+        self.assertIn("Updated rubric", context)
+        self.assertIn("Revised essay", context)
+
+
+def long_essay(topic_paragraph, filler=60):
+    paragraphs = [f"Section {i}: general background on the historical literature and context." * 8 for i in range(filler)]
+    paragraphs.insert(filler - 2, topic_paragraph)
+    return "\n\n".join(paragraphs)
+
+
+class ChunkRetrievalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(slug="retrieval", title="Retrieval")
+        self.essay = long_essay("My regression model used bootstrap resampling to estimate confidence intervals.")
+        self.sub = Submission.objects.create(assignment=self.assignment, user_id="s1", comment=self.essay)
+        self.session = VivaSession.objects.create(submission=self.sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=self.sub)
+
+    def test_extracted_text_is_indexed_on_save(self):
+        index = Submission.objects.get(id=self.sub.id).text_index
+        self.assertEqual(index, build_index(self.essay))
+        self.assertTrue(all(c["end"] - c["start"] <= CHUNK_CHARS for c in index["chunks"]))
+
+    def test_turn_context_follows_the_conversation(self):
+        opening = cached_submission_context(self.session)
+        self.assertIn("Section 0:", opening)
+        self.assertNotIn("Section 40:", opening)
+
+        context = cached_submission_context(self.session, query="Why bootstrap resampling for the intervals?")
+        self.assertIn("bootstrap resampling", context)
+        self.assertIn("(excerpts)", context)
+        self.assertLess(len(context), len(self.essay) / 2)
+
+        VivaMessage.objects.create(session=self.session, sender="student", text="I bootstrapped the intervals.")
+        VivaMessage.objects.create(session=self.session, sender="ai", text="How many bootstrap resampling rounds?")
+        self.assertIn("bootstrap resampling", build_turn_messages(self.session)[2]["content"])
+
+    def test_selection_respects_the_token_budget(self):
+        doc = {"name": "essay", "text": self.essay, "chunks": build_index(self.essay)["chunks"]}
+        selected = select_chunks([doc], "", 400)
+        self.assertLessEqual(sum(len(text) for text in selected[0][1]), 1600)
+        self.assertTrue(selected[0][1][0].startswith("Section 0"))
+
+
+@override_settings(
+    VIVA_PROMPT_TOKENS=3000,
+    VIVA_MATERIALS_TOKENS=1500,
+    VIVA_RESOURCE_TOKENS=500,
+    VIVA_MIN_HISTORY_TOKENS=600,
+)
+class PromptBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        assignment = Assignment.objects.create(slug="budget", title="Budget")
+        sub = Submission.objects.create(assignment=assignment, user_id="s1", comment=long_essay("Key finding."))
+        self.session = VivaSession.objects.create(submission=sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=sub)
+
+    def add_turns(self, count, words):
+        for i in range(count):
+            VivaMessage.objects.create(session=self.session, sender="ai", text=f"Question {i}? " + "why " * words)
+            VivaMessage.objects.create(session=self.session, sender="student", text=f"Answer {i}. " + "because " * words)
+
+    def test_short_vivas_spend_the_materials_budget(self):
+        self.add_turns(2, 10)
+        messages = build_turn_messages(self.session)
+        self.assertEqual(len(messages), 3 + 4)
+        self.assertLessEqual(count_message_tokens(messages), 3000)
+        self.assertGreater(count_message_tokens(messages[2:3]), 1000)
+
+    def test_long_history_is_trimmed_from_the_oldest_end(self):
+        self.add_turns(20, 60)
+        messages = build_turn_messages(self.session)
+        self.assertLessEqual(count_message_tokens(messages), 3000)
+        history = messages[3:]
+        self.assertLess(len(history), 40)
+        self.assertTrue(history[-1]["content"].startswith("Answer 19."))
+
+
+class RollingSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        assignment = Assignment.objects.create(slug="summary", title="Summary")
+        sub = Submission.objects.create(assignment=assignment, user_id="s1", comment="My essay")
+        self.session = VivaSession.objects.create(submission=sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=sub)
+        self.messages = []
+        for i in range(6):
+            self.messages.append(VivaMessage.objects.create(session=self.session, sender="ai", text=f"Question {i}?"))
+            self.messages.append(VivaMessage.objects.create(session=self.session, sender="student", text=f"Answer {i}."))
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.OpenAI")
+        self.create = patcher.start().return_value.chat.completions.create
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Covered methods and sampling."))]
+        )
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+
+    def test_older_turns_are_folded_into_the_summary(self):
+        self.assertTrue(refresh_viva_summary(self.session))
+        session = VivaSession.objects.get(id=self.session.id)
+        self.assertEqual(session.summary, "Covered methods and sampling.")
+        self.assertEqual(session.summary_upto_message_id, self.messages[5].id)
+        self.assertIn("Student: Answer 2.", self.create.call_args.kwargs["messages"][1]["content"])
+
+        messages = build_turn_messages(session)
+        self.assertIn("Covered methods and sampling.", messages[3]["content"])
+        self.assertEqual([m["content"] for m in messages[4:]], [m.text for m in self.messages[6:]])
+
+        # Nothing new to fold yet
+        self.assertFalse(refresh_viva_summary(session))
+        self.create.assert_called_once()
+
+    def test_refresh_starts_in_the_background_every_few_turns(self):
+        def send():
+            Client().post(
+                "/viva/send/",
+                json.dumps({"session_id": self.session.id, "sender": "student", "text": "Answer."}),
+                content_type="application/json",
+            )
+
+        reply = mock.patch("tool.views.viva.agenerate_viva_reply", return_value=("Next?", ""))
+        with reply, mock.patch("tool.views.viva._summarise_in_background") as background:
+            # 12 stored + 2 new messages: well past the trigger
+            send()
+            background.assert_called_once_with(self.session.id)
+
+            # Once the summary has caught up, 6 recent + 2 new stay below it
+            ids = list(VivaMessage.objects.filter(session=self.session).order_by("id").values_list("id", flat=True))
+            VivaSession.objects.filter(id=self.session.id).update(summary_upto_message_id=ids[-7])
+            background.reset_mock()
+            send()
+            background.assert_not_called()
+
+
+class OpeningQuestionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(slug="opening", title="Opening", enable_model_answers=True)
+        self.sub = Submission.objects.create(assignment=self.assignment, user_id="s1", comment="My essay")
+        self.session = VivaSession.objects.create(submission=self.sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=self.sub)
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.OpenAI")
+        self.create = patcher.start().return_value.chat.completions.create
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+        self.create.side_effect = [
+            SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='{"question": "What is your thesis?"}'))]),
+            SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="That cities need trees."))]),
+        ]
+
+    def send(self, text="Ready."):
+        return Client().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "sender": "student", "text": text}),
+            content_type="application/json",
+        ).json()
+
+    def test_viva_start_pregenerates_in_the_background(self):
+        with mock.patch("tool.views.viva._pregenerate_opening_in_background") as background:
+            response = Client().post(
+                f"/viva/start/{self.sub.id}/", "{}", content_type="application/json", HTTP_ACCEPT="application/json"
+            )
+        background.assert_called_once_with(response.json()["session_id"])
+
+    def test_pending_question_answers_the_first_message(self):
+        pending = pregenerate_opening_question(self.session)
+        self.assertTrue(pending.pending)
+        self.assertEqual(pending.model_answer, "That cities need trees.")
+        self.assertEqual(build_turn_messages(self.session)[-1]["role"], "system")
+
+        with mock.patch("tool.views.viva.agenerate_viva_reply") as generate:
+            data = self.send()
+        generate.assert_not_called()
+        self.assertEqual((data["ai_text"], data["ai_model_answer"]), ("What is your thesis?", "That cities need trees."))
+
+        msgs = list(VivaMessage.objects.filter(session=self.session).order_by("id"))
+        self.assertEqual([(m.sender, m.pending) for m in msgs], [("student", False), ("ai", False)])
+        self.assertEqual(
+            set(VivaLLMCall.objects.values_list("purpose", "message_id")),
+            {("opening", data["ai_message_id"]), ("model_answer", data["ai_message_id"])},
+        )
+
+    def test_students_who_type_first_get_a_normal_turn(self):
+        VivaMessage.objects.create(session=self.session, sender="student", text="Hello?")
+        self.assertIsNone(pregenerate_opening_question(self.session))
+        self.create.assert_not_called()
+
+        # A result that lands after the first reply is dropped, not reused
+        VivaMessage.objects.create(session=self.session, sender="ai", text="Why?")
+        VivaMessage.objects.create(session=self.session, sender="ai", text="Stale?", pending=True)
+        with mock.patch("tool.views.viva.agenerate_viva_reply", return_value=("Next?", "")):
+            self.assertEqual(self.send()["ai_text"], "Next?")
+        self.assertFalse(VivaMessage.objects.filter(pending=True).exists())
+
+
+@override_settings(VIVA_MATERIALS_TOKENS=2500, VIVA_BANK_MATERIALS_TOKENS=300, VIVA_BANK_CANDIDATES=2)
+class QuestionBankTests(TestCase):
+    BANK = [
+        {"question": "Why bootstrap resampling?", "model_answer": "To estimate intervals without normality."},
+        {"question": "What limits your sample?", "model_answer": "It came from one city."},
+        {"question": "How would you extend this?", "model_answer": "More regions."},
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(slug="bank", title="Bank", enable_model_answers=True)
+        self.sub = Submission.objects.create(
+            assignment=self.assignment, user_id="s1", comment=long_essay("I used bootstrap resampling.")
+        )
+        self.session = VivaSession.objects.create(submission=self.sub)
+        VivaSessionSubmission.objects.create(session=self.session, submission=self.sub)
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.OpenAI")
+        self.create = patcher.start().return_value.chat.completions.create
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+
+    def store_bank(self):
+        bank = {"hash": text_hash(self.sub.comment), "questions": self.BANK}
+        Submission.objects.filter(id=self.sub.id).update(question_bank=bank)
+
+    def test_bank_is_generated_from_the_submission(self):
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps({"questions": self.BANK})))]
+        )
+        self.assertEqual(generate_question_bank(self.sub), 3)
+        bank = Submission.objects.get(id=self.sub.id).question_bank
+        self.assertEqual([q["question"] for q in bank["questions"]], [q["question"] for q in self.BANK])
+        self.assertEqual(self.create.call_args.kwargs["response_format"]["json_schema"]["name"], "viva_question_bank")
+
+        # Re-extracted text makes the bank stale
+        self.sub.refresh_from_db()
+        self.sub.comment = "A different essay."
+        self.sub.save()
+        self.assertEqual(Submission.objects.get(id=self.sub.id).question_bank, {})
+
+    def test_bank_is_regenerated_only_when_its_inputs_change(self):
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps({"questions": self.BANK})))]
+        )
+        generate_question_bank(self.sub)
+        self.assertEqual(generate_question_bank(self.sub), 3)
+        self.assertEqual(self.create.call_count, 1)
+
+        AssignmentResource.objects.create(assignment=self.assignment, comment="Lecture notes on resampling.")
+        generate_question_bank(self.sub)
+        self.assertEqual(self.create.call_count, 2)
+        self.assertIn("Lecture notes", self.create.call_args.kwargs["messages"][1]["content"])
+
+    def test_requests_during_a_run_are_coalesced_not_dropped(self):
+        runs = []
+
+        def generate(sub):
+            runs.append(sub.id)
+            if len(runs) == 1:
+                # Another upload arrives while this bank is being generated
+                build_question_bank(sub.id)
+                build_question_bank(sub.id)
+
+        with mock.patch("tool.views.viva.generate_question_bank", side_effect=generate):
+            build_question_bank(self.sub.id)
+        self.assertEqual(runs, [self.sub.id, self.sub.id])
+
+    def test_turns_offer_unasked_candidates_with_less_material(self):
+        without_bank = count_message_tokens(build_turn_messages(self.session))
+        self.store_bank()
+        VivaMessage.objects.create(session=self.session, sender="ai", text="Why bootstrap resampling?")
+        VivaMessage.objects.create(session=self.session, sender="student", text="For the intervals.")
+
+        messages = build_turn_messages(self.session)
+        self.assertIn("1. What limits your sample?\n2. How would you extend this?", messages[3]["content"])
+        self.assertNotIn("Why bootstrap", messages[3]["content"])
+        self.assertLess(count_message_tokens(messages), without_bank / 2)
+
+    def test_bank_supplies_opening_question_and_model_answers(self):
+        self.store_bank()
+        opening = pregenerate_opening_question(self.session)
+        self.assertEqual((opening.text, opening.pending), ("Why bootstrap resampling?", True))
+
+        VivaMessage.objects.create(session=self.session, sender="ai", text="What limits your sample?")
+        answers = {a["text"]: a["model_answer"] for a in fill_model_answers(self.session)}
+        self.assertEqual(answers["What limits your sample?"], "It came from one city.")
+        self.create.assert_not_called()
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_uploads_queue_question_banks(self):
+        client = Client()
+        session = client.session
+        session.update({"lti_user_id": "s2", "lti_resource_link_id": self.assignment.slug})
+        session.save()
+        upload = SimpleUploadedFile("essay.txt", b"My essay about trees.")
+        with mock.patch("tool.views.submission.build_question_banks_in_background") as background:
+            client.post("/submit_file/", {"file": upload})
+        (ids,), _ = background.call_args
+        self.assertEqual(list(Submission.objects.filter(id__in=ids).values_list("user_id", flat=True)), ["s2"])
+
+
+class DeferredModelAnswerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assignment = Assignment.objects.create(slug="answers", title="Answers")
+        sub = Submission.objects.create(assignment=self.assignment, user_id="s1", comment="My essay")
+        self.session = VivaSession.objects.create(submission=sub)
+        VivaMessage.objects.create(session=self.session, sender="student", text="Hello")
+        self.question = VivaMessage.objects.create(session=self.session, sender="ai", text="Why?")
+
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        patcher = mock.patch("tool.llm.OpenAI")
+        self.create = patcher.start().return_value.chat.completions.create
+        self.addCleanup(patcher.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+        self.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Because of the evidence."))]
+        )
+
+    def end_viva(self):
+        return Client().post(
+            "/viva/send/",
+            json.dumps({"session_id": self.session.id, "ended": True}),
+            content_type="application/json",
+        )
+
+    def test_disabled_assignments_never_generate_answers(self):
+        self.assignment.enable_model_answers = False
+        self.assignment.save()
+        with mock.patch("tool.views.viva._fill_model_answers_in_background") as background:
+            self.end_viva()
+        background.assert_not_called()
+
+        data = Client().get(f"/viva/model_answers/{self.session.id}/").json()
+        self.assertEqual(data, {"status": "disabled", "model_answers": []})
+        self.create.assert_not_called()
+
+    def test_answers_are_generated_after_the_viva_and_stored(self):
+        with mock.patch("tool.views.viva._fill_model_answers_in_background") as background:
+            self.end_viva()
+        background.assert_called_once_with(self.session.id)
+        self.create.assert_not_called()
+
+        # Views never generate inline: they report pending (restarting the
+        # background run if none holds the lock) until the answer is stored
+        with mock.patch("tool.views.viva._fill_model_answers_in_background") as background:
+            data = Client().get(f"/viva/model_answers/{self.session.id}/").json()
+            self.assertEqual(data["status"], "pending")
+            background.assert_called_once_with(self.session.id)
+
+            cache.add(model_answers_lock_key(self.session.id), 1)
+            data = Client().get(f"/viva/model_answers/{self.session.id}/").json()
+            self.assertEqual(data["status"], "pending")
+            background.assert_called_once()
+            cache.delete(model_answers_lock_key(self.session.id))
+        self.create.assert_not_called()
+
+        fill_model_answers(self.session)
+        for _ in range(2):
+            data = Client().get(f"/viva/model_answers/{self.session.id}/").json()
+            self.assertEqual(data, {"status": "ok", "model_answers": [
+                {"id": self.question.id, "text": "Why?", "model_answer": "Because of the evidence."}
+            ]})
+        self.create.assert_called_once()
+        self.assertEqual(metrics.get(METRIC_MODEL_ANSWER_CALLS), 1)
+
+
+class StubChatEndpoint:
+    """Local OpenAI-compatible chat completions endpoint with keep-alive."""
+
+    def __init__(self):
+        self.connections = set()
+        self.failures = 0  # answer this many requests with a 500 first
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                endpoint.connections.add(self.client_address)
+                if endpoint.failures:
+                    endpoint.failures -= 1
+                    self.send_response(500)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps({
+                    "id": "chatcmpl-test",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "test",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": '{"question": "Why?"}'},
+                        "finish_reason": "stop",
+                    }],
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LLMClientRegistryTests(TestCase):
+    def setUp(self):
+        endpoint = StubChatEndpoint()
+        self.addCleanup(endpoint.close)
+        env = mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test", "OPENAI_BASE_URL": endpoint.url})
+        env.start()
+        self.addCleanup(env.stop)
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+        self.endpoint = endpoint
+
+    def complete(self, client):
+        return client.chat.completions.create(model="test", messages=[{"role": "user", "content": "Hi"}])
+
+    def test_sync_turns_reuse_one_client_and_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.complete(llm_clients.client()).choices[0].message.content, '{"question": "Why?"}')
+        self.assertIs(llm_clients.client(), llm_clients.client())
+        self.assertEqual(len(self.endpoint.connections), 1)
+
+        (stats,) = llm_clients.stats()
+        self.assertEqual((stats["kind"], stats["requests"], stats["connections"]), ("sync", 3, 1))
+
+    def test_async_pool_outlives_per_request_event_loops(self):
+        # Async views under WSGI get a fresh event loop per request
+        for _ in range(3):
+            asyncio.run(llm_clients.arun(self.complete))
+        self.assertEqual(len(self.endpoint.connections), 1)
+
+        (stats,) = llm_clients.stats()
+        self.assertEqual((stats["kind"], stats["requests"]), ("async", 3))
+
+    @override_settings(LLM_RETRY_BASE_DELAY=0)
+    def test_track_counts_retries(self):
+        kwargs = {"model": "test", "messages": [{"role": "user", "content": "Hi"}]}
+        self.endpoint.failures = 1
+        with llm_clients.track() as tracker:
+            llm_clients.complete(**kwargs)
+        self.assertEqual(tracker["attempts"], 2)
+
+        self.endpoint.failures = 1
+        tracker = {"attempts": 0}
+        # async_to_sync so the retry bookkeeping shares this thread's test database
+        async_to_sync(llm_clients.acomplete)(tracker=tracker, **kwargs)
+        self.assertEqual(tracker["attempts"], 2)
+
+
+def outage_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://llm.test/v1/chat/completions"))
+
+
+@override_settings(LLM_RETRY_BASE_DELAY=0, LLM_MAX_RETRIES=2, LLM_BREAKER_FAILURES=3, LLM_BREAKER_RESET=60)
+class LLMResilienceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+        self.client = mock.Mock()
+        self.create = self.client.chat.completions.create
+
+    def complete(self, **kwargs):
+        return llm_clients.complete(self.client, model="test", messages=[], **kwargs)
+
+    def test_retryable_errors_are_retried_with_a_timeout_per_attempt(self):
+        self.create.side_effect = [outage_error(), "reply"]
+        self.assertEqual(self.complete(deadline=10), "reply")
+        self.assertEqual(self.create.call_count, 2)
+        self.assertLessEqual(self.create.call_args.kwargs["timeout"], 10)
+        self.assertEqual(llm_clients.breaker.snapshot()["failures"], 0)
+
+    def test_other_errors_are_raised_at_once(self):
+        self.create.side_effect = RuntimeError("bad request")
+        with self.assertRaises(RuntimeError):
+            self.complete()
+        self.assertEqual(self.create.call_count, 1)
+        self.assertEqual(llm_clients.breaker.snapshot()["state"], "closed")
+
+    def test_breaker_opens_fails_fast_then_recovers(self):
+        self.create.side_effect = outage_error()
+        with self.assertRaises(openai.APIConnectionError):
+            self.complete()
+        self.assertEqual(self.create.call_count, 3)
+        self.assertEqual(llm_clients.breaker.snapshot()["state"], "open")
+
+        with self.assertRaises(CircuitOpenError):
+            self.complete()
+        self.assertEqual(self.create.call_count, 3)
+
+        self.create.side_effect = None
+        self.create.return_value = "reply"
+        with override_settings(LLM_BREAKER_RESET=0):
+            self.assertEqual(llm_clients.breaker.snapshot()["state"], "half_open")
+            self.assertEqual(self.complete(), "reply")
+        self.assertEqual(llm_clients.breaker.snapshot()["state"], "closed")
+        self.assertEqual(cache.get(BREAKER_STATE_KEY)["state"], "closed")
+
+    def test_deadline_covers_reading_a_stream(self):
+        def trickle():
+            for _ in range(10):
+                time.sleep(0.1)
+                yield "chunk"
+
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = trickle()
+        self.create.return_value = stream
+        chunks = []
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            for chunk in self.complete(deadline=0.35, stream=True):
+                chunks.append(chunk)
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertLess(len(chunks), 4)
+        stream.close.assert_called_once()
+        self.assertEqual(llm_clients.breaker.snapshot()["failures"], 1)
+
+    def test_stream_breaking_midway_counts_towards_the_breaker(self):
+        def broken():
+            yield "chunk"
+            raise httpx.RemoteProtocolError("peer closed connection")
+
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = broken()
+        self.create.return_value = stream
+        with self.assertRaises(httpx.RemoteProtocolError):
+            list(self.complete(stream=True))
+        self.assertEqual(llm_clients.breaker.snapshot()["failures"], 1)
+
+    def test_async_deadline_cuts_slow_calls(self):
+        async def slow(**kwargs):
+            await asyncio.sleep(1)
+
+        patcher = mock.patch("tool.llm.AsyncOpenAI")
+        patcher.start().return_value.chat.completions.create = slow
+        self.addCleanup(patcher.stop)
+        with mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"}):
+            started = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                async_to_sync(llm_clients.acomplete)(deadline=0.2, model="test", messages=[])
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertGreaterEqual(llm_clients.breaker.snapshot()["failures"], 1)
+
+    def test_async_deadline_covers_waiting_for_a_chunk(self):
+        stream = AsyncChunkStream(stream_chunks("a", "b"), delay=1)
+        patcher = mock.patch("tool.llm.AsyncOpenAI")
+        patcher.start().return_value.chat.completions.create = mock.AsyncMock(return_value=stream)
+        self.addCleanup(patcher.stop)
+
+        async def read():
+            chunks = await llm_clients.acomplete(deadline=0.2, model="test", messages=[], stream=True)
+            return [chunk async for chunk in chunks]
+
+        with mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"}):
+            started = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                async_to_sync(read)()
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertTrue(stream.closed)
+        self.assertEqual(llm_clients.breaker.snapshot()["failures"], 1)
+
+
+@override_settings(LLM_REQUESTS_PER_MINUTE=600, LLM_TOKENS_PER_MINUTE=0, LLM_QUEUE_TIMEOUT=5)
+class LLMRateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        llm_clients.reset()
+        self.addCleanup(llm_clients.reset)
+        self.client = mock.Mock()
+        self.create = self.client.chat.completions.create
+        self.create.return_value = "reply"
+        self.kwargs = {"model": "test", "messages": [{"role": "user", "content": "Why did you choose this method?"}]}
+
+    def drain(self):
+        LLMRateBucket.objects.create(name="default", requests=0, tokens=0, updated_at=time.time())
+
+    def test_calls_within_budget_do_not_queue(self):
+        for _ in range(3):
+            self.assertEqual(llm_clients.complete(self.client, **self.kwargs), "reply")
+        budget = llm_rate_limiter.snapshot()
+        self.assertLessEqual(budget["requests_available"], 598)
+        self.assertEqual(budget["waiting"], 0)
+        self.assertEqual(metrics.get(METRIC_LLM_QUEUED), 0)
+
+    def test_call_over_budget_waits_for_refill(self):
+        self.drain()  # 600 a minute refills one request every 0.1s
+        self.assertEqual(llm_clients.complete(self.client, **self.kwargs), "reply")
+        self.assertEqual(metrics.get(METRIC_LLM_QUEUED), 1)
+        self.assertGreater(metrics.get(METRIC_LLM_QUEUE_WAIT_MS), 0)
+        self.assertEqual(LLMRateBucket.objects.get().waiting, 0)
+
+    @override_settings(LLM_REQUESTS_PER_MINUTE=60)
+    def test_call_that_cannot_fit_its_queue_time_fails_fast(self):
+        self.drain()
+        started = time.monotonic()
+        with self.assertRaises(RateLimitTimeout) as ctx:
+            llm_clients.complete(self.client, deadline=0.5, **self.kwargs)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(ctx.exception.retry_in, 1)
+        self.create.assert_not_called()
+        self.assertEqual(metrics.get(METRIC_LLM_QUEUE_TIMEOUTS), 1)
+
+    @override_settings(LLM_REQUESTS_PER_MINUTE=0, LLM_COMPLETION_TOKENS_ESTIMATE=100)
+    def test_token_budget_counts_prompt_and_reply_allowance(self):
+        cost = call_cost(self.kwargs)
+        self.assertEqual(cost, count_message_tokens(self.kwargs["messages"]) + 100)
+        with override_settings(LLM_TOKENS_PER_MINUTE=cost + cost // 2, LLM_QUEUE_TIMEOUT=0):
+            llm_clients.complete(self.client, **self.kwargs)
+            with self.assertRaises(RateLimitTimeout):
+                llm_clients.complete(self.client, **self.kwargs)
+        self.assertEqual(self.create.call_count, 1)
+
+    def test_async_calls_share_the_budget(self):
+        self.drain()
+        patcher = mock.patch("tool.llm.AsyncOpenAI")
+        patcher.start().return_value.chat.completions.create = mock.AsyncMock(return_value="reply")
+        self.addCleanup(patcher.stop)
+        with mock.patch.dict("os.environ", {"OPENAI_API_KEY": "test"}):
+            self.assertEqual(async_to_sync(llm_clients.acomplete)(**self.kwargs), "reply")
+        self.assertEqual(metrics.get(METRIC_LLM_QUEUED), 1)
+        self.assertEqual(LLMRateBucket.objects.get().waiting, 0)
 
-# Create your tests here.
@@ -0,0 +1,52 @@
+import math
+import os
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a character estimate
+    tiktoken = None
+
+# Fallback when tiktoken (or its encoding files) is unavailable
+CHARS_PER_TOKEN = 4
+
+# Chat formatting cost per message (role and separators) and for priming
+# the reply, as documented for OpenAI chat models
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+
+def default_model():
+    return os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+
+
+@lru_cache(maxsize=None)
+def encoding_for(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # Encoding files are downloaded on first use; offline hosts estimate
+        print("DEBUG: tiktoken unavailable, estimating token counts:", e)
+        return None
+
+
+def count_tokens(text, model=None):
+    """Tokens in `text` for the model (tiktoken when installed, else ~4 chars/token)."""
+    if not text:
+        return 0
+    encoding = encoding_for(model or default_model())
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model=None):
+    """Prompt tokens for a list of chat messages, including formatting overhead."""
+    total = REPLY_PRIMING_TOKENS
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "", model)
+    return total
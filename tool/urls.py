@@ -17,6 +17,7 @@ urlpatterns = [
 
     # Assignment main view (students + instructors)
     path("assignment/", views.assignment_view, name="assignment_view"),
+    path("assignment/students/<str:user_id>/", views.dashboard_student_detail, name="dashboard_student_detail"),
 
     # NEW — Internal Assignment Editing (no deep linking)
     path("assignment/edit/", views.assignment_edit, name="assignment_edit"),
@@ -39,10 +40,12 @@ urlpatterns = [
     path("viva/start/<int:submission_id>/", views.viva_start, name="viva_start"),
     path("viva/session/<int:session_id>/", views.viva_session, name="viva_session"),
     path("viva/send/", views.viva_send_message, name="viva_send_message"),
+    path("viva/send/stream/", views.viva_send_message_stream, name="viva_send_message_stream"),
     path("viva/toggle_submission/", views.viva_toggle_submission, name="viva_toggle_submission"),
     path("viva/toggle_resource/", views.viva_toggle_resource, name="viva_toggle_resource"),
     path("viva/log/", views.viva_log_event, name="viva_log_event"),
     path("viva/summary/<int:session_id>/", views.viva_summary, name="viva_summary"),
+    path("viva/model_answers/<int:session_id>/", views.viva_model_answers, name="viva_model_answers"),
     path("viva/logs/<int:session_id>/", views.viva_logs, name="viva_logs"),
 
 
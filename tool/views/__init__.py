@@ -1,6 +1,6 @@
 from .launch import index, lti_login, lti_launch, jwks, landing
 from .deeplink import deeplink, deeplink_submit
-from .assignment import assignment_view, assignment_edit, assignment_edit_save
+from .assignment import assignment_view, assignment_edit, assignment_edit_save, dashboard_student_detail
 from .submission import (
     submit_text,
     submit_file,
@@ -11,5 +11,5 @@ from .submission import (
     delete_assignment_resource,
 )
 from .nrps_test import nrps_test
-from .viva import viva_start, viva_session, viva_send_message, viva_toggle_submission, viva_toggle_resource, viva_log_event, viva_summary, viva_logs
+from .viva import viva_start, viva_session, viva_send_message, viva_send_message_stream, viva_toggle_submission, viva_toggle_resource, viva_log_event, viva_summary, viva_model_answers, viva_logs
 from .home import home
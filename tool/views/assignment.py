@@ -1,10 +1,11 @@
 from django.shortcuts import render, redirect
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from .helpers import is_instructor_role, is_admin_role, fetch_nrps_roster
-from ..models import Assignment, Submission, VivaMessage, VivaSession, VivaFeedback, VivaSessionSubmission, InteractionLog, AssignmentResource, VivaSessionResource
+from ..models import Assignment, Submission, VivaMessage, VivaSession, VivaFeedback, VivaSessionSubmission, AssignmentResource, VivaSessionResource
 from datetime import datetime
 from django.utils.timezone import now
-from .viva import compute_integrity_flags
+from .viva import session_integrity_flags, rerender_integrity_flags
+from .dashboard import cached_dashboard_data, build_student_attempts
 import json
 
 
@@ -37,6 +38,12 @@ def assignment_edit_save(request):
 
     resource_link_id = request.session.get("lti_resource_link_id")
     assignment = Assignment.objects.get(slug=resource_link_id)
+    tracking_before = (
+        assignment.keystroke_tracking,
+        assignment.event_tracking,
+        assignment.arrhythmic_typing,
+        assignment.viva_duration_seconds,
+    )
 
     # Basic text fields
     assignment.description = request.POST.get("description", assignment.description)
@@ -84,6 +91,16 @@ def assignment_edit_save(request):
 
     assignment.save()
 
+    # Stored integrity flags depend on these settings
+    tracking_after = (
+        assignment.keystroke_tracking,
+        assignment.event_tracking,
+        assignment.arrhythmic_typing,
+        assignment.viva_duration_seconds,
+    )
+    if tracking_after != tracking_before:
+        rerender_integrity_flags(assignment)
+
     if request.headers.get("x-requested-with") == "XMLHttpRequest":
         return JsonResponse({"status": "ok"})
 
@@ -91,6 +108,37 @@ def assignment_edit_save(request):
 
 
 
+def dashboard_student_detail(request, user_id):
+    """Attempts, transcripts and event timelines for one student (JSON)."""
+    roles = request.session.get("lti_roles", [])
+    if not (is_instructor_role(roles) or is_admin_role(roles)):
+        return HttpResponse("Forbidden", status=403)
+
+    resource_link_id = request.session.get("lti_resource_link_id")
+    try:
+        assignment = Assignment.objects.get(slug=resource_link_id)
+    except Assignment.DoesNotExist:
+        return HttpResponseBadRequest("Invalid assignment")
+
+    included_resource_entries = [
+        {
+            "file_name": resource.file.name if resource.file else "Uploaded file",
+            "comment": resource.comment,
+        }
+        for resource in AssignmentResource.objects.filter(
+            assignment=assignment,
+            included=True,
+        ).order_by("-created_at")
+    ]
+
+    vivas = build_student_attempts(assignment, user_id, included_resource_entries)
+    return JsonResponse({
+        "status": "ok",
+        "user_id": user_id,
+        "vivas": vivas,
+    })
+
+
 def assignment_view(request):
     resource_link_id = request.session.get("lti_resource_link_id")
     roles = request.session.get("lti_roles", [])
@@ -208,17 +256,11 @@ def assignment_view(request):
     # Instructor view
     # --------------------------------------------------------------
     if is_instructor_role(roles) or is_admin_role(roles):
-        submissions = Submission.objects.filter(
-            assignment=assignment,
-            is_placeholder=False,
-        ).order_by("-created_at")
-
         assignment_resources = AssignmentResource.objects.filter(
             assignment=assignment
         ).order_by("-created_at")
         resources_total_size = 0
         resource_payloads = []
-        included_resource_entries = []
         for resource in assignment_resources:
             file_size = resource.file.size if resource.file else 0
             resources_total_size += file_size
@@ -231,205 +273,12 @@ def assignment_view(request):
                 "file_size": file_size,
             }
             resource_payloads.append(payload)
-            if resource.included:
-                included_resource_entries.append({
-                    "file_name": payload["file_name"],
-                    "comment": payload["comment"],
-                })
-
-        # Latest submission per learner
-        submission_map = {}
-        for sub in submissions:
-            key = str(sub.user_id)
-            if key not in submission_map:
-                submission_map[key] = sub
 
         nrps_url = request.session.get("nrps_url")
         roster = fetch_nrps_roster(nrps_url) if nrps_url else []
 
-        # Build sortable_name if missing; fallback to submission names if no roster
-        for m in roster:
-            given = m.get("given_name", "").strip()
-            family = m.get("family_name", "").strip()
-
-            if family or given:
-                m["sortable_name"] = f"{family}, {given}".strip(", ")
-            else:
-                m["sortable_name"] = m.get("name", "")
-
-        roster = sorted(roster, key=lambda m: m["sortable_name"].lower())
-
-        # If NRPS is unavailable, derive a basic roster from submissions
-        if not roster:
-            for sub in submission_map.values():
-                roster.append({
-                    "user_id": sub.user_id,
-                    "sortable_name": sub.user_id,
-                    "roles": ["Learner"],
-                })
-
-        students = []
-        completed_count = 0
-        flagged_count = 0
-        now_ts = now()
-
-        for member in roster:
-            if "learner" not in ",".join(member.get("roles", [])).lower():
-                continue
-
-            uid = str(member.get("user_id"))
-            sub = submission_map.get(uid)
-            sessions_qs = VivaSession.objects.filter(
-                submission__assignment=assignment,
-                submission__user_id=uid
-            ).order_by("-started_at")
-            active_session = sessions_qs.filter(ended_at__isnull=True).first()
-            latest_session = sessions_qs.first()
-            session = active_session or latest_session
-
-            flags = compute_integrity_flags(latest_session) if latest_session else []
-
-            viva_attempts = []
-            if sessions_qs.exists():
-                link_qs = VivaSessionSubmission.objects.filter(
-                    session__in=sessions_qs,
-                    submission__is_placeholder=False,
-                ).select_related("submission")
-                resource_links_qs = VivaSessionResource.objects.filter(
-                    session__in=sessions_qs
-                ).select_related("resource")
-                links_by_session = {}
-                for link in link_qs:
-                    if not link.included:
-                        continue
-                    links_by_session.setdefault(link.session_id, []).append({
-                        "submission_id": link.submission_id,
-                        "file_name": link.submission.file.name if link.submission.file else "",
-                        "comment": link.submission.comment,
-                    })
-                resources_by_session = {}
-                resource_sessions_seen = set()
-                for link in resource_links_qs:
-                    resource_sessions_seen.add(link.session_id)
-                    if not link.included:
-                        continue
-                    res = link.resource
-                    resources_by_session.setdefault(link.session_id, []).append({
-                        "file_name": res.file.name if res.file else "",
-                        "comment": res.comment,
-                    })
-                for sess in sessions_qs:
-                    files = links_by_session.get(sess.id, [])
-                    if sess.id in resource_sessions_seen:
-                        resource_files = resources_by_session.get(sess.id, [])
-                    else:
-                        resource_files = included_resource_entries
-                    logs_qs = InteractionLog.objects.filter(submission=sess.submission).order_by("timestamp")
-                    logs_by_session = logs_qs.filter(event_data__session_id=sess.id)
-                    if logs_by_session.exists():
-                        logs_qs = logs_by_session
-                    else:
-                        logs_qs = logs_qs.filter(timestamp__gte=sess.started_at)
-                        if sess.ended_at:
-                            logs_qs = logs_qs.filter(timestamp__lte=sess.ended_at)
-                    events = [
-                        {
-                            "type": log.event_type,
-                            "timestamp": log.timestamp.isoformat(),
-                            "data": log.event_data,
-                        }
-                        for log in logs_qs
-                    ]
-                    msgs = VivaMessage.objects.filter(
-                        session=sess
-                    ).order_by("timestamp")
-                    messages = [
-                        {
-                            "sender": m.sender,
-                            "text": m.text,
-                            "timestamp": m.timestamp.isoformat(),
-                        }
-                        for m in msgs
-                    ]
-
-                    try:
-                        fb = sess.vivafeedback
-                        feedback = {
-                            "strengths": fb.strengths,
-                            "improvements": fb.improvements,
-                            "misconceptions": fb.misconceptions,
-                            "impression": fb.impression,
-                        }
-                    except Exception:
-                        feedback = None
-
-                    duration_seconds = sess.duration_seconds
-                    if not duration_seconds and sess.ended_at:
-                        duration_seconds = int(
-                            (sess.ended_at - sess.started_at).total_seconds()
-                        )
-
-                    viva_attempts.append({
-                        "session_id": sess.id,
-                        "assignment_title": assignment.title,
-                        "duration_seconds": duration_seconds,
-                        "messages": messages,
-                        "feedback": feedback,
-                        "flags": compute_integrity_flags(sess),
-                        "created_at": sess.started_at.isoformat(),
-                        "status": "completed" if sess.ended_at else "in_progress",
-                        "files": files + resource_files,
-                        "events": events,
-                    })
-
-            viva_payload = viva_attempts[0] if viva_attempts else None
-
-            status = "pending"
-            if session:
-                status = "completed" if session.ended_at else "in_progress"
-                # Remaining time
-                elapsed = (now_ts - session.started_at).total_seconds()
-                remaining = max(0, assignment.viva_duration_seconds - int(elapsed))
-            elif sub:
-                status = "submitted"
-                remaining = assignment.viva_duration_seconds
-            else:
-                remaining = assignment.viva_duration_seconds
-
-            submitted_at = (
-                sub.created_at.isoformat() if sub else None
-            )
-
-            students.append({
-                "user_id": uid,
-                "name": member.get("sortable_name", uid),
-                "submission_id": sub.id if sub else None,
-                "status": status,
-                "remaining_seconds": remaining,
-                "submitted_at": submitted_at,
-                "flags": flags,
-                "viva": viva_payload,
-                "vivas": viva_attempts,
-            })
-
-            if status == "completed":
-                completed_count += 1
-            if flags:
-                flagged_count += 1
-
-        dashboard_data = {
-            "assignment": {
-                "title": assignment.title,
-                "id": assignment.id,
-                "slug": assignment.slug,
-            },
-            "students": students,
-            "stats": {
-                "total": len(students),
-                "completed": completed_count,
-                "flagged": flagged_count,
-            },
-        }
+        dashboard_data = cached_dashboard_data(assignment, roster)
+        students = dashboard_data["students"]
 
         return render(request, "tool/teacher_dashboard.html", {
             "assignment": assignment,
@@ -507,7 +356,7 @@ def assignment_view(request):
             feedback = session.vivafeedback
         except VivaFeedback.DoesNotExist:
             feedback = None
-        flags = compute_integrity_flags(session)
+        flags = session_integrity_flags(session)
     elif latest:
         status = "submitted"
 
@@ -537,7 +386,7 @@ def assignment_view(request):
     active_include_map = {}
     session_meta = {}
     if sessions:
-        all_messages = VivaMessage.objects.filter(session__in=sessions).order_by("timestamp")
+        all_messages = VivaMessage.objects.filter(session__in=sessions, pending=False).order_by("timestamp")
         msgs_by_session = {}
         for m in all_messages:
             sender = (m.sender or "").lower()
@@ -546,6 +395,9 @@ def assignment_view(request):
                 "text": m.text,
                 "ts": m.timestamp.isoformat(),
                 "model_answer": m.model_answer if sender == "ai" and m.model_answer else "",
+                "model_answer_pending": (
+                    assignment.enable_model_answers and sender == "ai" and not m.model_answer
+                ),
             })
         link_qs = VivaSessionSubmission.objects.filter(
             session__in=sessions,
@@ -0,0 +1,510 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, IntegerField, Max, Q, Sum, Window
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast, Lag, Length
+from django.utils.timezone import now
+
+from ..models import Counter, Submission, VivaSession, VivaMessage, VivaFeedback, VivaSessionSubmission, InteractionLog, VivaSessionResource, VivaIntegrityFlags, VivaLLMCall
+from .viva import (
+    CANCELLED_ERROR,
+    INTEGRITY_COUNT_FIELDS,
+    LARGE_PASTE_CHARS,
+    LONG_GAP_SECONDS,
+    evaluate_integrity_flags,
+    render_integrity_flags,
+    select_session_logs,
+    tally_log_counts,
+)
+
+
+# ---------------------------------------------------------
+# Instructor dashboard loaders
+#
+# Records for a set of sessions are fetched in a fixed number of
+# bulk queries and grouped in memory, so the query count does not
+# grow with the size of the roster. The dashboard page only carries
+# summary rows; full attempts are built per student on demand.
+# ---------------------------------------------------------
+def _group_session_records(sessions_qs):
+    logs_by_submission = {}
+    logs_qs = InteractionLog.objects.filter(
+        submission_id__in=sessions_qs.values("submission_id")
+    ).order_by("timestamp", "id")
+    for log in logs_qs:
+        logs_by_submission.setdefault(log.submission_id, []).append(log)
+
+    msgs_by_session = {}
+    msgs_qs = VivaMessage.objects.filter(
+        session__in=sessions_qs, pending=False
+    ).order_by("timestamp", "id")
+    for m in msgs_qs:
+        msgs_by_session.setdefault(m.session_id, []).append(m)
+
+    return logs_by_submission, msgs_by_session
+
+
+def _stored_integrity(session):
+    try:
+        return session.integrity
+    except VivaIntegrityFlags.DoesNotExist:
+        return None
+
+
+def aggregate_integrity_counts(sessions_qs):
+    """Flag inputs for a set of sessions from grouped aggregate queries.
+
+    Event counts come from one conditional-count query over the logs,
+    grouped by the tagged session id. Long response gaps come from a LAG
+    window over the messages where the backend supports it. Sessions with
+    no tagged logs fall back to the per-session time window in Python.
+    Returns (sessions, {session_id: counts}).
+    """
+    sessions = list(
+        sessions_qs.select_related("submission").annotate(
+            last_message_at=Max("vivamessage__timestamp", filter=Q(vivamessage__pending=False))
+        )
+    )
+    if not sessions:
+        return sessions, {}
+    session_ids = sessions_qs.values("id")
+
+    counts_by_session = {
+        sess.id: dict(
+            {field: 0 for field in INTEGRITY_COUNT_FIELDS},
+            last_message_at=sess.last_message_at,
+        )
+        for sess in sessions
+    }
+
+    paste = Q(event_type="paste")
+    no_length = (
+        Q(event_data__length__isnull=True)
+        | Q(event_data__length=None)
+        | Q(event_data__length=0)
+    )
+    log_rows = InteractionLog.objects.filter(
+        submission_id__in=sessions_qs.values("submission_id"),
+        event_data__has_key="session_id",
+    ).annotate(
+        tagged_session=Cast(KeyTextTransform("session_id", "event_data"), IntegerField()),
+        text_length=Length(KeyTextTransform("text", "event_data")),
+    ).filter(
+        tagged_session__in=session_ids,
+    ).values("tagged_session").annotate(
+        blur_count=Count("id", filter=Q(event_type="blur")),
+        paste_count=Count("id", filter=paste),
+        large_paste_count=Count("id", filter=paste & (
+            Q(event_data__length__gt=LARGE_PASTE_CHARS)
+            | (no_length & Q(text_length__gt=LARGE_PASTE_CHARS))
+        )),
+        ai_copy_count=Count("id", filter=Q(event_type="copy", event_data__source="ai")),
+        arrhythmic_count=Count("id", filter=Q(event_type="arrhythmic_typing")),
+    )
+    tagged = set()
+    for row in log_rows:
+        sess_id = row.pop("tagged_session")
+        tagged.add(sess_id)
+        counts_by_session[sess_id].update(row)
+
+    # Legacy logs without a session id: match on the session's time window
+    untagged = [sess for sess in sessions if sess.id not in tagged]
+    if untagged:
+        logs_by_submission = {}
+        logs_qs = InteractionLog.objects.filter(
+            submission_id__in={sess.submission_id for sess in untagged}
+        ).order_by("timestamp", "id")
+        for log in logs_qs:
+            logs_by_submission.setdefault(log.submission_id, []).append(log)
+        for sess in untagged:
+            logs = select_session_logs(sess, logs_by_submission.get(sess.submission_id, []))
+            counts_by_session[sess.id].update(tally_log_counts(logs))
+
+    msgs_qs = VivaMessage.objects.filter(session_id__in=session_ids, pending=False)
+    if connection.features.supports_over_clause:
+        gap = ExpressionWrapper(
+            F("timestamp") - Window(
+                Lag("timestamp"),
+                partition_by=[F("session_id")],
+                order_by=F("timestamp").asc(),
+            ),
+            output_field=DurationField(),
+        )
+        long_gaps = msgs_qs.annotate(gap=gap).filter(
+            gap__gt=timedelta(seconds=LONG_GAP_SECONDS)
+        ).values_list("session_id", flat=True)
+        for sess_id in long_gaps:
+            counts_by_session[sess_id]["long_gap_count"] += 1
+    else:
+        previous = {}
+        for sess_id, ts in msgs_qs.order_by("session_id", "timestamp").values_list("session_id", "timestamp"):
+            last = previous.get(sess_id)
+            if last and (ts - last).total_seconds() > LONG_GAP_SECONDS:
+                counts_by_session[sess_id]["long_gap_count"] += 1
+            previous[sess_id] = ts
+
+    return sessions, counts_by_session
+
+
+def _integrity_records(assignment, sessions, counts_by_session):
+    return [
+        VivaIntegrityFlags(
+            session=sess,
+            flags=render_integrity_flags(sess, assignment, counts_by_session[sess.id]),
+            finalized=bool(sess.ended_at),
+            **counts_by_session[sess.id],
+        )
+        for sess in sessions
+    ]
+
+
+def materialise_integrity_flags(assignment, sessions):
+    """Create integrity records in bulk for sessions that have none yet."""
+    if not sessions:
+        return {}
+    sessions, counts_by_session = aggregate_integrity_counts(
+        VivaSession.objects.filter(id__in=[s.id for s in sessions])
+    )
+    records = _integrity_records(assignment, sessions, counts_by_session)
+    VivaIntegrityFlags.objects.bulk_create(records, ignore_conflicts=True, batch_size=500)
+    return {record.session_id: record for record in records}
+
+
+def recompute_integrity_flags(assignment):
+    """Recount and store flags for every session of an assignment."""
+    sessions, counts_by_session = aggregate_integrity_counts(
+        VivaSession.objects.filter(submission__assignment=assignment)
+    )
+    records = _integrity_records(assignment, sessions, counts_by_session)
+    VivaIntegrityFlags.objects.bulk_create(
+        records,
+        update_conflicts=True,
+        unique_fields=["session"],
+        update_fields=INTEGRITY_COUNT_FIELDS + ["last_message_at", "flags", "finalized"],
+        batch_size=500,
+    )
+    bump_dashboard_version(assignment.id)
+    return len(records)
+
+
+def build_llm_usage(assignment):
+    """
+    Per-purpose LLM call aggregates for an assignment ("turn", "hedge",
+    "model_answer", "summary"), so slow or expensive configurations show up
+    on the dashboard. "won" counts calls whose answer was used; the
+    cancelled loser of a hedged turn is not counted as an error.
+    """
+    rows = (
+        VivaLLMCall.objects.filter(session__submission__assignment=assignment)
+        .values("purpose")
+        .annotate(
+            calls=Count("id"),
+            avg_latency_ms=Avg("latency_ms"),
+            max_latency_ms=Max("latency_ms"),
+            avg_first_token_ms=Avg("first_token_ms"),
+            prompt_tokens=Sum("prompt_tokens"),
+            completion_tokens=Sum("completion_tokens"),
+            cached_tokens=Sum("cached_tokens"),
+            retries=Sum("retries"),
+            fallbacks=Count("id", filter=Q(fallback=True)),
+            errors=Count("id", filter=~Q(error="") & ~Q(error=CANCELLED_ERROR)),
+            won=Count("id", filter=Q(won=True)),
+        )
+    )
+    usage = {}
+    for row in rows:
+        purpose = row.pop("purpose")
+        for key in ("avg_latency_ms", "avg_first_token_ms"):
+            if row[key] is not None:
+                row[key] = round(row[key])
+        for key in ("prompt_tokens", "completion_tokens", "cached_tokens", "retries"):
+            row[key] = row[key] or 0
+        usage[purpose] = row
+    return usage
+
+
+def build_dashboard_data(assignment, roster):
+    submissions = Submission.objects.filter(
+        assignment=assignment,
+        is_placeholder=False,
+    ).order_by("-created_at")
+
+    # Latest submission per learner
+    submission_map = {}
+    for sub in submissions:
+        key = str(sub.user_id)
+        if key not in submission_map:
+            submission_map[key] = sub
+
+    # Build sortable_name if missing; fallback to submission names if no roster
+    roster = list(roster or [])
+    for m in roster:
+        given = m.get("given_name", "").strip()
+        family = m.get("family_name", "").strip()
+
+        if family or given:
+            m["sortable_name"] = f"{family}, {given}".strip(", ")
+        else:
+            m["sortable_name"] = m.get("name", "")
+
+    roster = sorted(roster, key=lambda m: m["sortable_name"].lower())
+
+    # If NRPS is unavailable, derive a basic roster from submissions
+    if not roster:
+        for sub in submission_map.values():
+            roster.append({
+                "user_id": sub.user_id,
+                "sortable_name": sub.user_id,
+                "roles": ["Learner"],
+            })
+
+    sessions_qs = VivaSession.objects.filter(
+        submission__assignment=assignment,
+    ).select_related("submission", "integrity").order_by("-started_at")
+    sessions_by_user = {}
+    for sess in sessions_qs:
+        sessions_by_user.setdefault(str(sess.submission.user_id), []).append(sess)
+
+    # Flags are read from the materialised records; only sessions that
+    # predate them (or were never logged) are counted here, once.
+    integrity_by_session = {}
+    missing = []
+    for user_sessions in sessions_by_user.values():
+        latest = user_sessions[0]
+        record = _stored_integrity(latest)
+        if record:
+            integrity_by_session[latest.id] = record
+        else:
+            missing.append(latest)
+    integrity_by_session.update(materialise_integrity_flags(assignment, missing))
+
+    students = []
+    completed_count = 0
+    flagged_count = 0
+    now_ts = now()
+
+    for member in roster:
+        if "learner" not in ",".join(member.get("roles", [])).lower():
+            continue
+
+        uid = str(member.get("user_id"))
+        sub = submission_map.get(uid)
+        user_sessions = sessions_by_user.get(uid, [])
+        active_session = next((s for s in user_sessions if s.ended_at is None), None)
+        latest_session = user_sessions[0] if user_sessions else None
+        session = active_session or latest_session
+
+        flags = integrity_by_session[latest_session.id].flags if latest_session else []
+
+        status = "pending"
+        if session:
+            status = "completed" if session.ended_at else "in_progress"
+            # Remaining time
+            elapsed = (now_ts - session.started_at).total_seconds()
+            remaining = max(0, assignment.viva_duration_seconds - int(elapsed))
+        elif sub:
+            status = "submitted"
+            remaining = assignment.viva_duration_seconds
+        else:
+            remaining = assignment.viva_duration_seconds
+
+        submitted_at = (
+            sub.created_at.isoformat() if sub else None
+        )
+
+        students.append({
+            "user_id": uid,
+            "name": member.get("sortable_name", uid),
+            "submission_id": sub.id if sub else None,
+            "status": status,
+            "remaining_seconds": remaining,
+            "submitted_at": submitted_at,
+            "flags": flags,
+            "attempt_count": len(user_sessions),
+        })
+
+        if status == "completed":
+            completed_count += 1
+        if flags:
+            flagged_count += 1
+
+    return {
+        "assignment": {
+            "title": assignment.title,
+            "id": assignment.id,
+            "slug": assignment.slug,
+        },
+        "students": students,
+        "stats": {
+            "total": len(students),
+            "completed": completed_count,
+            "flagged": flagged_count,
+        },
+    }
+
+
+def build_student_attempts(assignment, user_id, included_resource_entries):
+    sessions_qs = VivaSession.objects.filter(
+        submission__assignment=assignment,
+        submission__user_id=user_id,
+    ).select_related("submission", "integrity").order_by("-started_at")
+    sessions = list(sessions_qs)
+    if not sessions:
+        return []
+
+    links_by_session = {}
+    link_qs = VivaSessionSubmission.objects.filter(
+        session__in=sessions_qs,
+        submission__is_placeholder=False,
+        included=True,
+    ).select_related("submission")
+    for link in link_qs:
+        links_by_session.setdefault(link.session_id, []).append({
+            "submission_id": link.submission_id,
+            "file_name": link.submission.file.name if link.submission.file else "",
+            "comment": link.submission.comment,
+        })
+
+    resources_by_session = {}
+    resource_sessions_seen = set()
+    resource_links_qs = VivaSessionResource.objects.filter(
+        session__in=sessions_qs
+    ).select_related("resource")
+    for link in resource_links_qs:
+        resource_sessions_seen.add(link.session_id)
+        if not link.included:
+            continue
+        res = link.resource
+        resources_by_session.setdefault(link.session_id, []).append({
+            "file_name": res.file.name if res.file else "",
+            "comment": res.comment,
+        })
+
+    logs_by_submission, msgs_by_session = _group_session_records(sessions_qs)
+
+    feedback_by_session = {
+        fb.session_id: fb
+        for fb in VivaFeedback.objects.filter(session__in=sessions_qs)
+    }
+
+    viva_attempts = []
+    for sess in sessions:
+        files = links_by_session.get(sess.id, [])
+        if sess.id in resource_sessions_seen:
+            resource_files = resources_by_session.get(sess.id, [])
+        else:
+            resource_files = included_resource_entries
+        logs = select_session_logs(sess, logs_by_submission.get(sess.submission_id, []))
+        msgs = msgs_by_session.get(sess.id, [])
+        events = [
+            {
+                "type": log.event_type,
+                "timestamp": log.timestamp.isoformat(),
+                "data": log.event_data,
+            }
+            for log in logs
+        ]
+        messages = [
+            {
+                "sender": m.sender,
+                "text": m.text,
+                "timestamp": m.timestamp.isoformat(),
+            }
+            for m in msgs
+        ]
+
+        stored = _stored_integrity(sess)
+        fb = feedback_by_session.get(sess.id)
+        feedback = {
+            "strengths": fb.strengths,
+            "improvements": fb.improvements,
+            "misconceptions": fb.misconceptions,
+            "impression": fb.impression,
+        } if fb else None
+
+        duration_seconds = sess.duration_seconds
+        if not duration_seconds and sess.ended_at:
+            duration_seconds = int(
+                (sess.ended_at - sess.started_at).total_seconds()
+            )
+
+        viva_attempts.append({
+            "session_id": sess.id,
+            "assignment_title": assignment.title,
+            "duration_seconds": duration_seconds,
+            "messages": messages,
+            "feedback": feedback,
+            "flags": stored.flags if stored else evaluate_integrity_flags(sess, assignment, logs, msgs),
+            "created_at": sess.started_at.isoformat(),
+            "status": "completed" if sess.ended_at else "in_progress",
+            "files": files + resource_files,
+            "events": events,
+        })
+
+    return viva_attempts
+
+
+# ---------------------------------------------------------
+# Versioned dashboard cache
+#
+# Built payloads are cached per assignment under a version counter
+# that model saves bump (see tool/signals.py), so any write makes the
+# next reload rebuild while unchanged reloads skip the database. The
+# counter is a Counter row rather than a cache key: it is bumped
+# atomically and never evicted.
+# ---------------------------------------------------------
+def _dashboard_version_key(assignment_id):
+    return f"dashboard:version:{assignment_id}"
+
+
+def get_dashboard_version(assignment_id):
+    name = _dashboard_version_key(assignment_id)
+    version = Counter.objects.filter(name=name).values_list("value", flat=True).first()
+    if version is None:
+        # Seed from the clock so a recreated counter never revives an old payload
+        version = Counter.objects.get_or_create(name=name, defaults={"value": time.time_ns()})[0].value
+    return version
+
+
+def bump_dashboard_version(assignment_id):
+    if not assignment_id:
+        return
+    name = _dashboard_version_key(assignment_id)
+
+    def bump():
+        if not Counter.objects.filter(name=name).update(value=F("value") + 1):
+            Counter.objects.get_or_create(name=name, defaults={"value": time.time_ns()})
+
+    # Only once the write is visible; bumping inside the writer's transaction
+    # would let a concurrent reload cache pre-commit rows under the new version
+    transaction.on_commit(bump)
+
+
+def cached_dashboard_data(assignment, roster):
+    roster_digest = hashlib.sha1(
+        json.dumps(roster or [], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    version = get_dashboard_version(assignment.id)
+    key = f"dashboard:data:{assignment.id}:{version}:{roster_digest}"
+
+    now_ts = now()
+    cached = cache.get(key)
+    if cached is None:
+        data = build_dashboard_data(assignment, roster)
+        data["llm_usage"] = build_llm_usage(assignment)
+        cache.set(key, {"built_at": now_ts, "data": data}, settings.DASHBOARD_CACHE_TIMEOUT)
+        return data
+
+    # Remaining time keeps counting down while the payload sits in the cache
+    data = cached["data"]
+    elapsed = int((now_ts - cached["built_at"]).total_seconds())
+    for student in data["students"]:
+        if student["status"] in ("completed", "in_progress"):
+            student["remaining_seconds"] = max(0, student["remaining_seconds"] - elapsed)
+    return data
@@ -12,86 +12,124 @@ def is_admin_role(roles):
 def is_student_role(roles):
     return not is_instructor_role(roles) and not is_admin_role(roles)
 
-import time, jwt, requests
+import hashlib
+import threading
+import time, requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
 from tool.models import ToolConfig
-
-
-def fetch_nrps_roster(nrps_url):
-    print("DEBUG: fetch_nrps_roster CALLED with url:", nrps_url)
-
-    if not nrps_url:
-        print("DEBUG: No NRPS URL in session")
-        return None
-
-    # ----------------------------------------------------------
-    # Load platform config (Canvas platform details)
-    # ----------------------------------------------------------
+from tool.service_tokens import NRPS_SCOPE, ServiceTokenError, service_tokens
+
+NRPS_MEDIA_TYPE = "application/vnd.ims.lti-nrps.v2.membershipcontainer+json"
+
+
+def _download_memberships(url, access_token):
+    """Follow every rel="next" page; return (members, differences_url)."""
+    members = []
+    differences_url = None
+    while url:
+        resp = requests.get(
+            url,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Accept": NRPS_MEDIA_TYPE,
+            },
+            timeout=settings.NRPS_TIMEOUT,
+        )
+        resp.raise_for_status()
+        members.extend(resp.json().get("members", []))
+        differences_url = resp.links.get("differences", {}).get("url") or differences_url
+        url = resp.links.get("next", {}).get("url")
+    return members, differences_url
+
+
+def _apply_membership_differences(members, changes):
+    by_user = {str(m.get("user_id")): m for m in members}
+    for change in changes:
+        uid = str(change.get("user_id"))
+        if change.get("status") == "Deleted":
+            by_user.pop(uid, None)
+        else:
+            by_user[uid] = change
+    return list(by_user.values())
+
+
+def _roster_cache_key(nrps_url):
+    return "nrps:roster:" + hashlib.sha1(nrps_url.encode("utf-8")).hexdigest()
+
+
+def refresh_nrps_roster(nrps_url):
+    """Download the roster (or just its differences) and store it in the cache."""
     platform = ToolConfig.objects.first()
     if not platform:
         print("DEBUG: No PlatformConfig in DB")
         return None
 
-    now = int(time.time())
-
-    # ----------------------------------------------------------
-    # Build client_assertion JWT for Canvas token endpoint
-    # ----------------------------------------------------------
-    private_key = open("lti_keys/private.pem", "rb").read()
+    try:
+        access_token = service_tokens.get_token(platform, [NRPS_SCOPE])
+    except ServiceTokenError as e:
+        print("DEBUG: FAILED TO OBTAIN ACCESS TOKEN:", e, e.details)
+        return None
 
-    client_assertion_payload = {
-        "iss": platform.client_id,          # tool's client_id
-        "sub": platform.client_id,          # same as iss
-        "aud": platform.token_url,          # MUST match Canvas token endpoint
-        "iat": now,
-        "exp": now + 60,
-        "jti": str(now),
+    key = _roster_cache_key(nrps_url)
+    entry = cache.get(key)
+    members = None
+    differences_url = None
+    if entry and entry.get("differences_url"):
+        try:
+            changes, differences_url = _download_memberships(entry["differences_url"], access_token)
+            members = _apply_membership_differences(entry["members"], changes)
+        except (requests.RequestException, ValueError) as e:
+            print("DEBUG: NRPS differences refresh failed, reloading roster:", e)
+            members = None
+    if members is None:
+        try:
+            members, differences_url = _download_memberships(nrps_url, access_token)
+        except (requests.RequestException, ValueError) as e:
+            print("DEBUG: NRPS roster fetch failed:", e)
+            return entry
+
+    entry = {
+        "members": members,
+        "differences_url": differences_url,
+        "fetched_at": time.time(),
     }
+    cache.set(key, entry, settings.NRPS_ROSTER_MAX_AGE)
+    return entry
 
-    client_assertion = jwt.encode(
-        client_assertion_payload,
-        private_key,
-        algorithm="RS256",
-    )
-
-    # ----------------------------------------------------------
-    # Step 2: Exchange for service access token
-    # ----------------------------------------------------------
-    token_resp = requests.post(
-        platform.token_url,
-        data={
-            "grant_type": "client_credentials",
-            "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
-            "client_assertion": client_assertion,
-            "scope": "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly",
-        },
-    )
-
-    print("DEBUG: token_resp status =", token_resp.status_code)
-    print("DEBUG: token_resp text =", token_resp.text)
-
-    token_json = token_resp.json()
-    access_token = token_json.get("access_token")
-
-    if not access_token:
-        print("DEBUG: FAILED TO OBTAIN ACCESS TOKEN")
-        return None
 
-    # ----------------------------------------------------------
-    # Step 3: Call the NRPS membership service
-    # ----------------------------------------------------------
-    members_resp = requests.get(
-        nrps_url,
-        headers={"Authorization": f"Bearer {access_token}"}
-    )
+def _refresh_nrps_roster_in_background(nrps_url):
+    lock_key = _roster_cache_key(nrps_url) + ":refreshing"
+    # One refresh at a time across every worker process
+    if not cache.add(lock_key, 1, timeout=settings.NRPS_TIMEOUT * 4):
+        return
 
-    print("DEBUG: members_resp status =", members_resp.status_code)
-    print("DEBUG: members_resp text =", members_resp.text)
+    def run():
+        try:
+            refresh_nrps_roster(nrps_url)
+        finally:
+            cache.delete(lock_key)
+            close_old_connections()
 
-    try:
-        data = members_resp.json()
-        print(data)
-        return data.get("members", [])
-    except:
-        print("DEBUG: JSON ERROR - returning None")
+    threading.Thread(target=run, daemon=True).start()
+
+
+def fetch_nrps_roster(nrps_url):
+    """
+    Roster for a context, served from the cache.
+    Only a cold cache waits on the platform; stale entries are returned
+    immediately while a background refresh runs.
+    """
+    if not nrps_url:
+        print("DEBUG: No NRPS URL in session")
         return None
+
+    entry = cache.get(_roster_cache_key(nrps_url))
+    if entry is None:
+        entry = refresh_nrps_roster(nrps_url)
+        return entry["members"] if entry else None
+
+    if time.time() - entry["fetched_at"] > settings.NRPS_ROSTER_TTL:
+        _refresh_nrps_roster_in_background(nrps_url)
+    return entry["members"]
@@ -7,9 +7,9 @@ from django.shortcuts import render, redirect
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from jwt import PyJWKClient
 from jwcrypto import jwk
 from datetime import datetime
+from tool.jwks import JwksError, jwks_cache
 from tool.models import ToolConfig
 
 
@@ -87,18 +87,19 @@ def lti_launch(request):
     # ------------------------------------------------------
     # Step B: Validate JWT signature (Canvas → Tool)
     # ------------------------------------------------------
-    jwks_client = PyJWKClient(platform.jwks_url)
-
+    # Keys come from the process-wide JWKS cache; Canvas is only contacted
+    # when the cache is cold, expired or sees a kid it does not know.
     try:
-        signing_key = jwks_client.get_signing_key_from_jwt(id_token).key
-    except Exception as e:
+        signing_key = jwks_cache.get_signing_key(platform.jwks_url, id_token)
+    except JwksError as e:
         return HttpResponseBadRequest(f"JWKS key error: {e}")
 
     # Store the kid Canvas used
     try:
         kid = jwt.get_unverified_header(id_token).get("kid")
-        platform.last_seen_kid = kid
-        platform.save(update_fields=["last_seen_kid"])
+        if kid != platform.last_seen_kid:
+            platform.last_seen_kid = kid
+            platform.save(update_fields=["last_seen_kid"])
         print("🔑 Canvas launch kid:", kid)
     except Exception as e:
         print("⚠ Could not read kid header:", e)
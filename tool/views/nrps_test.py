@@ -1,9 +1,8 @@
-import time
-import json
-import jwt
 import requests
+from django.conf import settings
 from django.http import JsonResponse, HttpResponseBadRequest
 from tool.models import ToolConfig
+from tool.service_tokens import NRPS_SCOPE, ServiceTokenError, service_tokens
 
 
 def nrps_test(request):
@@ -22,58 +21,24 @@ def nrps_test(request):
     if not platform:
         return JsonResponse({"error": "PlatformConfig missing"})
 
-    now = int(time.time())
-
-    # ---------------------------------------------------
-    # Step 1: Create client_assertion for Canvas
-    # ---------------------------------------------------
-    private_key = open("lti_keys/private.pem", "rb").read()
-
-    client_assertion_payload = {
-        "iss": platform.client_id,
-        "sub": platform.client_id,
-        "aud": platform.token_url,       # MUST match Canvas token endpoint
-        "iat": now,
-        "exp": now + 60,
-        "jti": str(now),
-    }
-
-    client_assertion = jwt.encode(
-        client_assertion_payload,
-        private_key,
-        algorithm="RS256",
-    )
-
     # ---------------------------------------------------
-    # Step 2: Exchange it for a service access token
+    # Step 1: Obtain a (cached) service access token
     # ---------------------------------------------------
-    token_resp = requests.post(
-        platform.token_url,
-        data={
-            "grant_type": "client_credentials",
-            "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
-            "client_assertion": client_assertion,
-            "scope": "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly",
-        },
-    )
-
-    print("🔍 Token response:", token_resp.text)
-
-    token_json = token_resp.json()
-    access_token = token_json.get("access_token")
-
-    if not access_token:
+    try:
+        access_token = service_tokens.get_token(platform, [NRPS_SCOPE])
+    except ServiceTokenError as e:
         return JsonResponse({
             "error": "Failed to obtain access token",
-            "details": token_json
+            "details": e.details if e.details is not None else str(e),
         })
 
     # ---------------------------------------------------
-    # Step 3: Call NRPS memberships endpoint
+    # Step 2: Call NRPS memberships endpoint
     # ---------------------------------------------------
     members_resp = requests.get(
         nrps_url,
-        headers={"Authorization": f"Bearer {access_token}"}
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=settings.NRPS_TIMEOUT,
     )
 
     print("🔍 Members response:", members_resp.text)
@@ -5,6 +5,7 @@ from django.http import HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
 from .helpers import is_instructor_role, is_admin_role
+from .viva import build_assignment_question_banks_in_background, build_question_banks_in_background
 from ..models import Assignment, Submission, VivaSession, AssignmentResource
 from ..utils import extract_text_from_file
 
@@ -73,6 +74,7 @@ def submit_file(request):
             return JsonResponse({"status": "error", "message": "Total upload size limit is 50MB across all files."}, status=400)
         return redirect("assignment_view")
 
+    created_ids = []
     for uploaded in uploads:
         sub = Submission.objects.create(
             assignment=assignment,
@@ -87,10 +89,14 @@ def submit_file(request):
                 extracted = extract_text_from_file(sub.file.path)
                 sub.comment = extracted[:50000]
                 sub.save()
+                created_ids.append(sub.id)
         except Exception:
             # If extraction fails, continue without blocking the redirect
             pass
 
+    # Prepare viva questions now rather than during the timed viva
+    build_question_banks_in_background(created_ids)
+
     return redirect("assignment_view")
 
 
@@ -185,7 +191,7 @@ def upload_assignment_resource(request):
             if resource.file and resource.file.path:
                 extracted = extract_text_from_file(resource.file.path)
                 resource.comment = extracted[:50000]
-                resource.save(update_fields=["comment"])
+                resource.save(update_fields=["comment", "text_index"])
         except Exception:
             pass
         created.append({
@@ -196,6 +202,9 @@ def upload_assignment_resource(request):
             "file_size": resource.file.size if resource.file else 0,
         })
 
+    # New resources change what the question banks should draw on
+    build_assignment_question_banks_in_background(assignment.id)
+
     return JsonResponse({"status": "ok", "resources": created})
 
 
@@ -232,6 +241,7 @@ def toggle_assignment_resource(request):
     included = str(included_raw).lower() in ["1", "true", "yes", "on"]
     resource.included = included
     resource.save(update_fields=["included"])
+    build_assignment_question_banks_in_background(assignment.id)
 
     return JsonResponse({"status": "ok", "included": resource.included})
 
@@ -261,4 +271,5 @@ def delete_assignment_resource(request, resource_id):
     except Exception:
         pass
     resource.delete()
+    build_assignment_question_banks_in_background(assignment.id)
     return JsonResponse({"status": "ok"})